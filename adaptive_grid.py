@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# adaptive_grid.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+
+from instrumentation import instrumented_map
+
+
+def get_grid_spacing(parameterRange):
+    # The spacing of a range is the mean distance between consecutive points.
+    if len(parameterRange) < 2:
+        return 0
+    return ((float(max(parameterRange)) - float(min(parameterRange))) /
+        float(len(parameterRange) - 1))
+
+
+def get_local_grid(center, steps, bounds):
+    # Build a 3x3x3 grid around the center, clipping each axis to its bounds.
+    axes = list()
+    for value, step, bound in zip(center, steps, bounds):
+        axis = set()
+        for point in [value - step, value, value + step]:
+            point = min(max(point, bound[0]), bound[1])
+            axis.add(round(point, 10))
+        axes.append(sorted(axis))
+
+    grid = list()
+    for d in axes[0]:
+        for theta in axes[1]:
+            for std in axes[2]:
+                grid.append((d, theta, std))
+    return grid
+
+
+def adaptive_grid_search(pool, wrapper, dataParams, rangeD, rangeTheta,
+    rangeStd, extraParams=(), bounds=None, numRounds=4, shrinkFactor=0.5,
+    dominanceMargin=10., maxCenters=3, verbose=True):
+    # Each model is evaluated as wrapper(dataParams + model + extraParams),
+    # which matches the parameter tuples used by the run_analysis_wrapper
+    # functions in the fitting scripts.
+    ranges = [rangeD, rangeTheta, rangeStd]
+    spacings = [get_grid_spacing(r) for r in ranges]
+
+    # By default the search may move one coarse step outside the initial
+    # ranges, but never into negative parameter values.
+    if bounds is None:
+        bounds = list()
+        for r, spacing in zip(ranges, spacings):
+            bounds.append((max(min(r) - spacing, 0), max(r) + spacing))
+
+    likelihoods = dict()
+
+    def evaluate(models):
+        models = [m for m in models if not m in likelihoods]
+        if not models:
+            return 0
+        listParams = list()
+        for model in models:
+            listParams.append(tuple(dataParams) + model + tuple(extraParams))
+        results = instrumented_map(pool, wrapper, listParams)
+        for model, result in zip(models, results):
+            likelihoods[model] = result
+        return len(models)
+
+    # Start with the full coarse grid, clipped to the bounds.
+    coarseGrid = set()
+    for d in rangeD:
+        for theta in rangeTheta:
+            for std in rangeStd:
+                model = list()
+                for value, bound in zip((d, theta, std), bounds):
+                    value = min(max(value, bound[0]), bound[1])
+                    model.append(round(value, 10))
+                coarseGrid.add(tuple(model))
+    evaluate(coarseGrid)
+
+    steps = [spacing * shrinkFactor for spacing in spacings]
+    for r in xrange(numRounds):
+        # Models whose NLL is clearly dominated by the current best are dropped
+        # and never refined again. The best few surviving models become the
+        # centers of the next, finer grids.
+        bestNLL = min(likelihoods.values())
+        survivors = [m for m in likelihoods
+            if likelihoods[m] <= bestNLL + dominanceMargin]
+        survivors.sort(key=lambda m: likelihoods[m])
+        centers = survivors[:maxCenters]
+
+        newModels = list()
+        for center in centers:
+            newModels.extend(get_local_grid(center, steps, bounds))
+        numEvaluated = evaluate(set(newModels))
+
+        if verbose:
+            bestModel = min(likelihoods, key=likelihoods.get)
+            print("Round " + str(r + 1) + ": evaluated " + str(numEvaluated) +
+                " models, best " + str(bestModel) + " with NLL " +
+                str(likelihoods[bestModel]))
+
+        # Nothing new was evaluated, so the grid cannot be refined further.
+        if numEvaluated == 0:
+            break
+        steps = [step * shrinkFactor for step in steps]
+
+    bestModel = min(likelihoods, key=likelihoods.get)
+    gridSearch = collections.namedtuple('GridSearch', ['model', 'NLL',
+        'steps', 'likelihoods'])
+    return gridSearch(bestModel, likelihoods[bestModel], steps, likelihoods)
+
+
+def get_centered_ranges(center, steps, bounds=None):
+    # Ranges of three points around a model, e.g. to center the model grid
+    # used for computing posteriors. With bounds, each range is clipped to
+    # its bounds as in get_local_grid, so it may have fewer points.
+    ranges = list()
+    for i, (value, step) in enumerate(zip(center, steps)):
+        points = [value - step, value, value + step]
+        if bounds is not None:
+            points = sorted(set([round(min(max(point, bounds[i][0]),
+                bounds[i][1]), 10) for point in points]))
+        ranges.append(points)
+    return ranges
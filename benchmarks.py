@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+# benchmarks.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from multiprocessing import cpu_count, Pool
+
+import json
+import numpy as np
+import os
+import pandas as pd
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import ddm
+import handle_fixations
+from handle_fixations import (load_data_from_csv, get_empirical_distributions,
+    simulate_trials)
+
+
+# Size of expdata.csv, which the synthetic datasets are multiples of.
+baseNumSubjects = 25
+baseTrialsPerSubject = 1340
+
+# Parameters used to generate the synthetic data and in all benchmarks.
+benchmarkD = 0.005
+benchmarkTheta = 0.3
+benchmarkStd = 0.08
+
+# A metric is reported as a regression when it is worse than its baseline
+# value by more than this factor.
+regressionThreshold = 1.2
+
+# Results of a reference run, against which new results are compared.
+baselineFile = "benchmark_baseline.json"
+
+
+def get_synthetic_dists(seed=0):
+    # Fixation and transition duration distributions, in ms, shaped roughly
+    # like the empirical ones.
+    randomState = np.random.RandomState(seed)
+    distTransition = randomState.gamma(4, 10, 1000).astype(int) + 10
+    distFirstFix = dict()
+    distSecondFix = dict()
+    distThirdFix = dict()
+    distOtherFix = dict()
+    for valueDiff in xrange(4):
+        distFirstFix[valueDiff] = randomState.gamma(4, 50, 1000).astype(int)
+        distSecondFix[valueDiff] = randomState.gamma(4, 110, 1000).astype(int)
+        distThirdFix[valueDiff] = randomState.gamma(4, 90, 1000).astype(int)
+        distOtherFix[valueDiff] = randomState.gamma(4, 80, 1000).astype(int)
+    return (0.65, distTransition, distFirstFix, distSecondFix, distThirdFix,
+        distOtherFix)
+
+
+def generate_synthetic_data(dataDir, scale=1, seed=0):
+    # Write expdata and fixations CSV files, in the format read by
+    # load_data_from_csv, with scale times as many subjects as expdata.csv.
+    # The trials are simulated from the model.
+    randomState = np.random.RandomState(seed)
+    numSubjects = baseNumSubjects * scale
+    numTrials = numSubjects * baseTrialsPerSubject
+    orientations = np.arange(-15, 20, 5)
+    distLeft = randomState.choice(orientations, numTrials)
+    distRight = randomState.choice(orientations, numTrials)
+    same = distLeft == distRight
+    while np.any(same):
+        distRight[same] = randomState.choice(orientations, np.sum(same))
+        same = distLeft == distRight
+    valueLeft = np.absolute((np.absolute(distLeft)-15)/5)
+    valueRight = np.absolute((np.absolute(distRight)-15)/5)
+
+    ones = np.ones(numTrials)
+    simul = simulate_trials(*(get_synthetic_dists(seed) + (valueLeft,
+        valueRight, benchmarkD * ones, benchmarkTheta * ones,
+        benchmarkStd * ones)), seed=seed)
+
+    parcode = np.array(["s" + str(i) for i in xrange(numSubjects)]).repeat(
+        baseTrialsPerSubject)
+    trial = np.tile(np.arange(baseTrialsPerSubject), numSubjects)
+    expdataFile = os.path.join(dataDir, "expdata_" + str(scale) + "x.csv")
+    df = pd.DataFrame({'parcode': parcode, 'trial': trial, 'rt': simul.rt,
+        'choice': simul.choice, 'dist_left': distLeft,
+        'dist_right': distRight, 'valid': 1})
+    df.to_csv(expdataFile, sep=',', index=False, columns=['parcode', 'trial',
+        'rt', 'choice', 'dist_left', 'dist_right', 'valid'])
+    fixationsFile = os.path.join(dataDir, "fixations_" + str(scale) + "x.csv")
+    df = pd.DataFrame({'parcode': parcode[simul.fixTrial],
+        'trial': trial[simul.fixTrial], 'fix_item': simul.fixItem,
+        'fix_time': simul.fixTime})
+    df.to_csv(fixationsFile, sep=',', index=False, columns=['parcode',
+        'trial', 'fix_item', 'fix_time'])
+    return expdataFile, fixationsFile
+
+
+def get_peak_memory():
+    # Peak resident memory of this process in MB (ru_maxrss is in kB on
+    # Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_isolated(func, args=()):
+    # Run a benchmark in a new worker process, so that its peak memory is not
+    # masked by earlier benchmarks.
+    pool = Pool(1)
+    result = pool.apply(func, args)
+    pool.close()
+    pool.join()
+    return result
+
+
+def bench_loading(expdataFile, fixationsFile):
+    startMemory = get_peak_memory()
+    startTime = time.time()
+    data = load_data_from_csv(expdataFile, fixationsFile)
+    loadTime = time.time() - startTime
+
+    startTime = time.time()
+    get_empirical_distributions(data.rt, data.choice, data.distLeft,
+        data.distRight, data.fixItem, data.fixTime)
+    empiricalTime = time.time() - startTime
+
+    results = dict()
+    results['load_data_from_csv_seconds'] = loadTime
+    results['get_empirical_distributions_seconds'] = empiricalTime
+    results['peak_memory_mb'] = get_peak_memory()
+    results['memory_growth_mb'] = get_peak_memory() - startMemory
+    return results
+
+
+def get_benchmark_trial(rt):
+    # A trial of the given RT, alternating left and right fixations of 400 ms
+    # separated by 40 ms transitions.
+    fixItem = list()
+    fixTime = list()
+    item = 1
+    remaining = rt
+    while remaining > 0:
+        fixItem.append(item)
+        fixTime.append(min(400, remaining))
+        remaining -= fixTime[-1]
+        if remaining > 0:
+            fixItem.append(0)
+            fixTime.append(min(40, remaining))
+            remaining -= fixTime[-1]
+        item = 3 - item
+    return rt, -1, 3, 1, np.array(fixItem), np.array(fixTime)
+
+
+def bench_likelihood(rtLengths=(500, 1000, 2000, 4000), repeats=3):
+    # Latency of a single likelihood evaluation, as a function of the RT. The
+    # best of a few repeats is reported.
+    results = dict()
+    for rt in rtLengths:
+        trial = get_benchmark_trial(rt)
+        times = list()
+        for i in xrange(repeats):
+            startTime = time.time()
+            handle_fixations.analysis_per_trial(*(trial[:5] +
+                (trial[5].copy(), benchmarkD, benchmarkTheta)),
+                std=benchmarkStd)
+            times.append(time.time() - startTime)
+        results['handle_fixations_rt' + str(rt) + '_seconds'] = min(times)
+
+        times = list()
+        for i in xrange(repeats):
+            startTime = time.time()
+            ddm.analysis_per_trial(rt, -1, 3, 1, benchmarkD, benchmarkStd)
+            times.append(time.time() - startTime)
+        results['ddm_rt' + str(rt) + '_seconds'] = min(times)
+    return results
+
+
+def bench_simulations(numTrials=20, seed=0):
+    # Simulated trials per second, for numTrials trials per trial condition.
+    np.random.seed(seed)
+    dists = get_synthetic_dists(seed)
+    orientations = range(-15,20,5)
+    trialConditions = list()
+    for oLeft in orientations:
+        for oRight in orientations:
+            if oLeft != oRight:
+                trialConditions.append((oLeft, oRight))
+    totalTrials = numTrials * len(trialConditions)
+    results = dict()
+
+    startTime = time.time()
+    handle_fixations.run_simulations(*(dists + (numTrials, trialConditions,
+        benchmarkD, benchmarkTheta)), std=benchmarkStd)
+    results['handle_fixations_simulations_per_second'] = (totalTrials /
+        (time.time() - startTime))
+
+    conditions = np.tile(np.array(trialConditions), (numTrials, 1))
+    ones = np.ones(totalTrials)
+    startTime = time.time()
+    simulate_trials(*(dists + (np.absolute((np.absolute(conditions[:,0])-15)/5),
+        np.absolute((np.absolute(conditions[:,1])-15)/5), benchmarkD * ones,
+        benchmarkTheta * ones, benchmarkStd * ones)), seed=seed)
+    results['simulate_trials_simulations_per_second'] = (totalTrials /
+        (time.time() - startTime))
+
+    values = range(0,4,1)
+    ddmConditions = [(vLeft, vRight) for vLeft in values for vRight in values]
+    startTime = time.time()
+    ddm.run_simulations(numTrials, ddmConditions, benchmarkD, benchmarkStd)
+    results['ddm_simulations_per_second'] = (numTrials * len(ddmConditions) /
+        (time.time() - startTime))
+    return results
+
+
+def likelihood_wrapper(params):
+    trial = params[:6]
+    return handle_fixations.analysis_per_trial(*(trial[:5] +
+        (trial[5].copy(),) + params[6:]))
+
+
+def bench_worker_scaling(workerCounts=(1, 2, 4, 8), numTrials=64):
+    # Throughput of pool.map over likelihood evaluations, with the speedup
+    # relative to a single worker.
+    listParams = [get_benchmark_trial(rt) + (benchmarkD, benchmarkTheta,
+        benchmarkStd) for rt in np.linspace(500, 3000, numTrials).astype(int)]
+    results = dict()
+    for numWorkers in workerCounts:
+        pool = Pool(numWorkers)
+        startTime = time.time()
+        pool.map(likelihood_wrapper, listParams)
+        elapsed = time.time() - startTime
+        pool.close()
+        pool.join()
+        results['workers' + str(numWorkers) + '_trials_per_second'] = (
+            numTrials / elapsed)
+    for numWorkers in workerCounts:
+        results['workers' + str(numWorkers) + '_speedup'] = (
+            results['workers' + str(numWorkers) + '_trials_per_second'] /
+            results['workers' + str(workerCounts[0]) + '_trials_per_second'])
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold=regressionThreshold):
+    # Times and memory should not grow, and rates should not drop, by more
+    # than the threshold factor.
+    regressions = list()
+    for group in sorted(results.keys()):
+        if group == 'environment' or group not in baseline:
+            continue
+        for name in sorted(results[group].keys()):
+            if name not in baseline[group]:
+                continue
+            value = results[group][name]
+            base = baseline[group][name]
+            if name.endswith('_seconds') or name.endswith('_mb'):
+                worse = value > base * threshold
+            else:
+                worse = value < base / threshold
+            if worse:
+                regressions.append((group, name, base, value))
+    return regressions
+
+
+def main(large=False, saveBaseline=False):
+    results = dict()
+    results['environment'] = {'python': platform.python_version(),
+        'numpy': np.__version__, 'platform': platform.platform(),
+        'cpus': cpu_count(),
+        'date': time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    print("Benchmarking likelihoods...")
+    results['likelihood'] = run_isolated(bench_likelihood)
+    print("Benchmarking simulations...")
+    results['simulations'] = run_isolated(bench_simulations)
+    print("Benchmarking worker scaling...")
+    results['worker_scaling'] = bench_worker_scaling()
+
+    # The 10x and 100x datasets take a long time to generate and load.
+    scales = [1, 10, 100] if large else [1]
+    dataDir = tempfile.mkdtemp()
+    try:
+        for scale in scales:
+            print("Benchmarking loading at " + str(scale) + "x...")
+            expdataFile, fixationsFile = generate_synthetic_data(dataDir, scale)
+            results['loading_' + str(scale) + 'x'] = run_isolated(
+                bench_loading, (expdataFile, fixationsFile))
+    finally:
+        shutil.rmtree(dataDir)
+
+    with open("benchmark_results.json", "w") as jsonFile:
+        json.dump(results, jsonFile, indent=2, sort_keys=True)
+    for group in sorted(results.keys()):
+        for name in sorted(results[group].keys()):
+            print(group + "." + name + ": " + str(results[group][name]))
+
+    if os.path.exists(baselineFile) and not saveBaseline:
+        with open(baselineFile, "r") as jsonFile:
+            baseline = json.load(jsonFile)
+        regressions = compare_with_baseline(results, baseline)
+        for group, name, base, value in regressions:
+            print("REGRESSION " + group + "." + name + ": " + str(base) +
+                " -> " + str(value))
+        if not regressions:
+            print("No regressions against " + baselineFile + ".")
+    if saveBaseline:
+        shutil.copyfile("benchmark_results.json", baselineFile)
+        print("Saved baseline to " + baselineFile + ".")
+
+
+if __name__ == '__main__':
+    main("--large" in sys.argv[1:], "--save-baseline" in sys.argv[1:])
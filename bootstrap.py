@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+# bootstrap.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from scipy.optimize import basinhopping, minimize
+
+import collections
+import csv
+import numpy as np
+import os
+import sys
+import threading
+
+import optimize
+from executors import create_executor, print_counters
+from handle_fixations import analysis_per_trial_gradient
+from multiresolution import (referenceTimeStep, get_log_step_correction,
+    scale_parameters)
+from posterior_engine import get_trial_list
+from trial_sampling import get_trial_sets_hash
+
+
+# Columns of the checkpoint file: the estimate and NLL of each replicate,
+# followed by the settings of the run which determine the replicates.
+checkpointFields = ["replicate", "d", "theta", "std", "NLL", "seed", "d0",
+    "theta0", "std0", "stateStep", "timeStep", "trialSetsHash"]
+
+# Per-trial likelihoods and gradients already computed in this process, per
+# (subject, trial, x, stateStep, timeStep). Every replicate starts from the
+# full-data optimum, so its first evaluation is shared with all the others.
+trialLikelihoods = dict()
+maxTrialLikelihoods = 100000
+
+
+def get_bootstrap_trials(trialSets, seed):
+    # Resample the trials of each subject with replacement, keeping the number
+    # of trials per subject. Returns, per subject, each drawn trial and the
+    # number of times it was drawn.
+    randomState = np.random.RandomState(seed)
+    bootstrapTrials = dict()
+    for subject in sorted(trialSets.keys()):
+        trials = sorted(trialSets[subject])
+        draws = randomState.randint(0, len(trials), len(trials))
+        counts = np.bincount(draws, minlength=len(trials))
+        bootstrapTrials[subject] = [(trials[i], counts[i])
+            for i in xrange(len(trials)) if counts[i] > 0]
+    return bootstrapTrials
+
+
+def get_replicate_data(rt, choice, valueLeft, valueRight, fixItem, fixTime,
+    bootstrapTrials):
+    # Each distinct drawn trial is sent once, with its data, so that workers on
+    # other hosts need nothing else. Returns (subject, trial) keys, trial
+    # tuples and draw counts.
+    keys = list()
+    counts = list()
+    for subject in sorted(bootstrapTrials.keys()):
+        for trial, count in bootstrapTrials[subject]:
+            keys.append((subject, trial))
+            counts.append(count)
+    trials = get_trial_list(rt, choice, valueLeft, valueRight, fixItem,
+        fixTime, [(subject, [trial]) for subject, trial in keys])
+    return keys, trials, np.array(counts)
+
+
+def get_trial_likelihood(key, trial, x, stateStep=0.1, timeStep=10):
+    cacheKey = key + (tuple(x), stateStep, timeStep)
+    if cacheKey in trialLikelihoods:
+        return trialLikelihoods[cacheKey]
+    if len(trialLikelihoods) >= maxTrialLikelihoods:
+        trialLikelihoods.clear()
+    d, std = scale_parameters(x[0], x[2], timeStep)
+    trialLikelihoods[cacheKey] = analysis_per_trial_gradient(*(trial +
+        (d, x[1], std)), timeStep=timeStep, stateStep=stateStep)
+    return trialLikelihoods[cacheKey]
+
+
+def get_weighted_nll(x, keys, trials, counts, stateStep=0.1, timeStep=10):
+    # NLL of a bootstrap replicate and its gradient with respect to x, as in
+    # optimize.run_analysis_gradient. A trial drawn n times is evaluated once
+    # and counted n times.
+    stepCorrection = get_log_step_correction(timeStep)
+    ratio = float(timeStep) / float(referenceTimeStep)
+    scaling = np.array([ratio, 1, np.sqrt(ratio)])
+
+    logLikelihood = 0
+    gradient = np.zeros(3)
+    for key, trial, count in zip(keys, trials, counts):
+        likelihood, trialGradient = get_trial_likelihood(key, trial, x,
+            stateStep, timeStep)
+        if likelihood != 0:
+            logLikelihood += count * (np.log(likelihood) - stepCorrection)
+            gradient += count * trialGradient * scaling
+    return -logLikelihood, -gradient
+
+
+def fit_replicate(replicate, keys, trials, counts, x0, bounds, stateStep=0.1,
+    timeStep=10):
+    # Local fit of one replicate, warm-started from the full-data optimum,
+    # which the replicate optima are close to.
+    res = minimize(get_weighted_nll, x0, args=(keys, trials, counts,
+        stateStep, timeStep), method="L-BFGS-B", bounds=bounds, jac=True)
+    return replicate, list(res.x), res.fun
+
+
+def get_run_settings(trialSets, x0, seed, stateStep, timeStep):
+    # Everything besides the replicate number which determines a replicate's
+    # estimate, in the order of the checkpoint columns.
+    return ([int(seed)] + [float(value) for value in x0] +
+        [float(stateStep), int(timeStep), get_trial_sets_hash(trialSets)])
+
+
+def load_checkpoint(fileName, settings):
+    # Replicates completed in a previous run, as a dict mapping each replicate
+    # to its (d, theta, std) estimate and NLL. Replicates from a run with
+    # other settings would be mixed with this one's, so they are an error.
+    estimates = dict()
+    if not os.path.isfile(fileName):
+        return estimates
+    with open(fileName, "rb") as csvFile:
+        for row in csv.DictReader(csvFile):
+            rowSettings = [int(row['seed']), float(row['d0']),
+                float(row['theta0']), float(row['std0']),
+                float(row['stateStep']), int(row['timeStep']),
+                row['trialSetsHash']]
+            if rowSettings != settings:
+                raise ValueError("Checkpoint file " + fileName + " was "
+                    "written with other settings: " + str(rowSettings) +
+                    " instead of " + str(settings) + ".")
+            estimates[int(row['replicate'])] = ([float(row['d']),
+                float(row['theta']), float(row['std'])], float(row['NLL']))
+    return estimates
+
+
+def save_replicate(fileName, replicate, x, NLL, settings):
+    # Rows are appended as replicates complete, so an interrupted run can be
+    # resumed from the ones already saved.
+    newFile = not os.path.isfile(fileName)
+    with open(fileName, "ab") as csvFile:
+        csvWriter = csv.writer(csvFile, delimiter=',', quotechar='|',
+            quoting=csv.QUOTE_MINIMAL)
+        if newFile:
+            csvWriter.writerow(checkpointFields)
+        csvWriter.writerow([replicate] + list(x) + [NLL] + settings)
+
+
+def get_percentile_intervals(estimates, confidence=0.95):
+    # Percentile interval of each parameter over the replicate estimates.
+    estimates = np.array(estimates)
+    alpha = 100 * (1 - confidence) / 2.
+    return [(np.percentile(estimates[:, i], alpha),
+        np.percentile(estimates[:, i], 100 - alpha))
+        for i in xrange(estimates.shape[1])]
+
+
+def run_bootstrap(pool, rt, choice, valueLeft, valueRight, fixItem, fixTime,
+    trialSets, x0, numReplicates=100, seed=0, bounds=None,
+    checkpointFile="bootstrap.csv", confidence=0.95, stateStep=0.1,
+    timeStep=10):
+    # Refit the model on numReplicates resamples of trialSets, in parallel.
+    # Replicate i is drawn with seed + i, so the replicates do not depend on
+    # which of them were completed before an interruption. Returns the
+    # estimates and NLLs of all replicates and the percentile intervals.
+    if bounds is None:
+        bounds = optimize.searchBounds
+    settings = get_run_settings(trialSets, x0, seed, stateStep, timeStep)
+    estimates = load_checkpoint(checkpointFile, settings)
+    replicates = [replicate for replicate in xrange(numReplicates)
+        if replicate not in estimates]
+    if estimates:
+        print("Loaded " + str(numReplicates - len(replicates)) +
+            " replicates from " + checkpointFile + ".")
+
+    lock = threading.Lock()
+    def save_result(result):
+        replicate, x, NLL = result
+        with lock:
+            save_replicate(checkpointFile, replicate, x, NLL, settings)
+            estimates[replicate] = (x, NLL)
+            print("Replicate " + str(replicate) + ": " + str(x))
+
+    results = list()
+    for replicate in replicates:
+        keys, trials, counts = get_replicate_data(rt, choice, valueLeft,
+            valueRight, fixItem, fixTime, get_bootstrap_trials(trialSets,
+            seed + replicate))
+        results.append(pool.apply_async(fit_replicate, (replicate, keys,
+            trials, counts, list(x0), bounds, stateStep, timeStep),
+            callback=save_result))
+    for result in results:
+        result.get()
+
+    replicates = range(numReplicates)
+    bootstrap = collections.namedtuple('Bootstrap', ['estimates', 'NLLs',
+        'intervals'])
+    return bootstrap(np.array([estimates[r][0] for r in replicates]),
+        np.array([estimates[r][1] for r in replicates]),
+        get_percentile_intervals([estimates[r][0] for r in replicates],
+        confidence))
+
+
+def main(argv):
+    # Usage: python bootstrap.py [NUM_REPLICATES] [D THETA STD]
+    # Without a full-data optimum, one is found as in optimize.py first. The
+    # fit and the replicates use all the trials of each subject, so the
+    # intervals are those of the full-data estimates.
+    numReplicates = int(argv[0]) if len(argv) >= 1 else 100
+    optimize.load_global_data()
+    optimize.set_trial_subsets(trialsPerSubject=None)
+
+    if len(argv) >= 4:
+        x0 = [float(value) for value in argv[1:4]]
+    else:
+        minimizer_kwargs = dict(method="L-BFGS-B", bounds=optimize.searchBounds,
+            jac=True)
+        x0 = list(basinhopping(optimize.run_analysis_gradient,
+            optimize.initialGuess, minimizer_kwargs=minimizer_kwargs).x)
+    print("Full-data optimum: " + str(x0))
+
+    pool = create_executor()
+    res = run_bootstrap(pool, optimize.rt, optimize.choice, optimize.valueLeft,
+        optimize.valueRight, optimize.fixItem, optimize.fixTime,
+        optimize.trialSubsets, x0, numReplicates)
+    pool.close()
+    pool.join()
+    print_counters()
+
+    for name, (lower, upper) in zip(["d", "theta", "std"], res.intervals):
+        print("95% interval for " + name + ": [" + str(lower) + ", " +
+            str(upper) + "]")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,11 +3,10 @@
 # cis_trans_fitting.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from multiprocessing import Pool
-
 import numpy as np
 import sys
 
+from executors import create_executor
 from handle_fixations import (load_data_from_csv, analysis_per_trial,
     get_empirical_distributions, run_simulations)
 from group_fitting import save_simulations_to_csv
@@ -68,8 +67,7 @@ def main(argv):
     useCisTrials = argv[0]
     useTransTrials = argv[1]
 
-    numThreads = 9
-    pool = Pool(numThreads)
+    pool = create_executor()
 
     # Load experimental data from CSV file.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# cma_optimize.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from scipy.optimize import basinhopping
+
+import collections
+import numpy as np
+import sys
+import time
+
+import optimize
+from executors import create_executor
+from optimize import initialGuess, searchBounds
+
+
+def cma_es(pool, objective, x0, bounds, sigma0=0.3, popSize=None,
+    maxGenerations=100, tolFun=1., tolX=1e-3, penaltyWeight=1e4, seed=0,
+    verbose=True, callback=None):
+    # Covariance matrix adaptation evolution strategy. Each generation's
+    # proposals are evaluated concurrently with pool.map. The search runs in
+    # coordinates normalized to the unit box given by the bounds; proposals
+    # outside the box are evaluated at the nearest point inside it, with a
+    # penalty on their distance to the box.
+    randomState = np.random.RandomState(seed)
+    lower = np.array([b[0] for b in bounds], dtype=float)
+    upper = np.array([b[1] for b in bounds], dtype=float)
+    span = upper - lower
+    n = len(x0)
+
+    # Strategy parameters, following the usual defaults.
+    if popSize is None:
+        popSize = 4 + int(3 * np.log(n))
+    mu = popSize // 2
+    weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    weights /= np.sum(weights)
+    muEff = 1. / np.sum(weights ** 2)
+    cc = (4. + muEff / n) / (n + 4. + 2. * muEff / n)
+    cs = (muEff + 2.) / (n + muEff + 5.)
+    c1 = 2. / ((n + 1.3) ** 2 + muEff)
+    cmu = min(1. - c1, 2. * (muEff - 2. + 1. / muEff) /
+        ((n + 2.) ** 2 + muEff))
+    damps = 1. + 2. * max(0, np.sqrt((muEff - 1.) / (n + 1.)) - 1.) + cs
+    chiN = np.sqrt(n) * (1. - 1. / (4. * n) + 1. / (21. * n ** 2))
+
+    mean = (np.array(x0, dtype=float) - lower) / span
+    sigma = sigma0
+    C = np.eye(n)
+    pc = np.zeros(n)
+    ps = np.zeros(n)
+
+    bestX = None
+    bestNLL = np.inf
+    history = list()
+    for g in xrange(maxGenerations):
+        # Sample the proposals for this generation.
+        eigenvalues, B = np.linalg.eigh(C)
+        D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        z = randomState.randn(popSize, n)
+        y = np.dot(z * D, B.T)
+        x = mean + sigma * y
+        xInside = np.clip(x, 0, 1)
+        points = lower + xInside * span
+
+        values = np.array(pool.map(objective, [tuple(p) for p in points]))
+        fitness = values + penaltyWeight * np.sum((x - xInside) ** 2, axis=1)
+        order = np.argsort(fitness)
+
+        if values[order[0]] < bestNLL:
+            bestNLL = values[order[0]]
+            bestX = points[order[0]]
+        history.append((g, bestX, bestNLL))
+        if verbose:
+            print("Generation " + str(g) + ": best " + str(bestX) +
+                " with NLL " + str(bestNLL))
+        if callback is not None:
+            callback(bestX, bestNLL)
+
+        # Move the mean towards the best proposals.
+        oldMean = mean
+        selected = x[order[:mu]]
+        mean = np.dot(weights, selected)
+        yw = (mean - oldMean) / sigma
+
+        # Update the evolution paths.
+        CInvSqrt = np.dot(B / D, B.T)
+        ps = ((1. - cs) * ps + np.sqrt(cs * (2. - cs) * muEff) *
+            np.dot(CInvSqrt, yw))
+        hSigma = (np.linalg.norm(ps) /
+            np.sqrt(1. - (1. - cs) ** (2 * (g + 1))) / chiN <
+            1.4 + 2. / (n + 1.))
+        pc = (1. - cc) * pc + hSigma * np.sqrt(cc * (2. - cc) * muEff) * yw
+
+        # Update the covariance matrix and the step size.
+        yk = (selected - oldMean) / sigma
+        C = ((1. - c1 - cmu) * C +
+            c1 * (np.outer(pc, pc) + (1 - hSigma) * cc * (2. - cc) * C) +
+            cmu * np.dot(yk.T * weights, yk))
+        sigma *= np.exp((cs / damps) * (np.linalg.norm(ps) / chiN - 1.))
+
+        # Stop once the proposals agree on the NLL and the search distribution
+        # has shrunk below the tolerance.
+        if (np.max(values) - np.min(values) < tolFun and
+            sigma * np.max(D) < tolX):
+            break
+
+    result = collections.namedtuple('CMAResult', ['x', 'NLL', 'generations',
+        'history'])
+    return result(bestX, bestNLL, len(history), history)
+
+
+def compare_with_basinhopping(pool, verbose=True):
+    # Record the wall-clock time at which each optimizer reaches each NLL,
+    # then compare the times needed by both to reach the same NLL.
+    traces = dict()
+
+    startTime = time.time()
+    traces['cma'] = list()
+    def record_cma(x, NLL):
+        traces['cma'].append((time.time() - startTime, NLL))
+    cma_es(pool, optimize.run_analysis, initialGuess, searchBounds,
+        popSize=9, verbose=verbose, callback=record_cma)
+
+    startTime = time.time()
+    traces['basinhopping'] = list()
+    def record_basinhopping(x):
+        NLL, gradient = optimize.run_analysis_gradient(x)
+        if not traces['basinhopping']:
+            best = NLL
+        else:
+            best = min(NLL, traces['basinhopping'][-1][1])
+        traces['basinhopping'].append((time.time() - startTime, best))
+        return NLL, gradient
+    minimizer_kwargs = dict(method="L-BFGS-B", bounds=searchBounds, jac=True)
+    basinhopping(record_basinhopping, initialGuess,
+        minimizer_kwargs=minimizer_kwargs)
+
+    # The target is the best NLL reached by both optimizers.
+    target = max(traces['cma'][-1][1], traces['basinhopping'][-1][1])
+    timesToTarget = dict()
+    for name, trace in traces.iteritems():
+        for elapsed, NLL in trace:
+            if NLL <= target:
+                timesToTarget[name] = elapsed
+                break
+        print(name + ": reached NLL " + str(target) + " after " +
+            str(timesToTarget[name]) + " seconds, best NLL " +
+            str(trace[-1][1]) + " after " + str(trace[-1][0]) + " seconds")
+    return timesToTarget
+
+
+def main(benchmark=False):
+    # Data must be loaded before the pool is created, so that the workers
+    # inherit it. Cluster workers on other hosts load it themselves.
+    optimize.load_global_data_and_subsets()
+    pool = create_executor(setup=optimize.load_global_data_and_subsets)
+
+    if benchmark:
+        compare_with_basinhopping(pool)
+        return
+
+    # One proposal per worker in each generation.
+    res = cma_es(pool, optimize.run_analysis, initialGuess, searchBounds,
+        popSize=pool._processes)
+    print("Optimal d: " + str(res.x[0]))
+    print("Optimal theta: " + str(res.x[1]))
+    print("Optimal std: " + str(res.x[2]))
+    print("Min NLL: " + str(res.NLL))
+
+
+if __name__ == '__main__':
+    main("--benchmark" in sys.argv[1:])
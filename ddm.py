@@ -3,7 +3,6 @@
 # ddm.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from multiprocessing import Pool
 from scipy.stats import norm
 
 import collections
@@ -11,10 +10,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+import instrumentation
+from executors import create_executor
+
 
 def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
-    barrier=1, plotResults=False):
-    stateStep = 0.1
+    stateStep=0.1, barrier=1, plotResults=False):
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
 
     # Get the total time for this trial.
     maxTime = int(rt // timeStep)
@@ -27,7 +30,8 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
         barrierUp[t] = float(barrier) / float(1+decay*(t+1))
         barrierDown[t] = float(-barrier) / float(1+decay*(t+1))
 
-    # The vertical axis (RDV space) is divided into states.
+    # The vertical axis (RDV space) is divided into states. The state step
+    # must divide the barrier, so that the zero state is part of the grid.
     states = np.arange(-barrier, barrier + stateStep, stateStep)
     idx = np.where(np.logical_and(states<0.01, states>-0.01))[0]
     states[idx] = 0
@@ -52,6 +56,13 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
     # calculated from the model parameter d and from the item values.
     mean = d * (valueLeft - valueRight)
 
+    if instrumentation.enabled:
+        instrumentation.count('trials_evaluated')
+        instrumentation.count('timesteps_propagated', maxTime)
+        instrumentation.count('states_touched', maxTime * states.size)
+        instrumentation.stop_timer('setup', startTime)
+        propagationStart = instrumentation.start_timer()
+
     # Iterate over the time of this trial.
     for time in xrange(maxTime):
         prStatesNew = np.zeros(states.size)
@@ -84,11 +95,15 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
             (norm.cdf(changeDown, mean, std))))
 
         # Renormalize to cope with numerical approximations.
+        if instrumentation.enabled:
+            renormalizationStart = instrumentation.start_timer()
         sumIn = np.sum(prStates)
         sumCurrent = np.sum(prStatesNew) + tempUpCross + tempDownCross
         prStatesNew = (prStatesNew * float(sumIn)) / float(sumCurrent)
         tempUpCross = (tempUpCross * float(sumIn)) / float(sumCurrent)
         tempDownCross = (tempDownCross * float(sumIn)) / float(sumCurrent)
+        if instrumentation.enabled:
+            instrumentation.stop_timer('renormalization', renormalizationStart)
 
         # Update the probabilities of each state and the probabilities of
         # crossing each barrier at this timestep.
@@ -100,6 +115,10 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
         if plotResults:
             traces[:,time] = prStates
 
+    # Propagation time includes renormalization.
+    if instrumentation.enabled:
+        instrumentation.stop_timer('propagation', propagationStart)
+
     # Compute the likelihood contribution of this trial based on the final
     # choice.
     likelihood = 0
@@ -110,6 +129,11 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, d, std, timeStep=10,
         if probDownCrossing[-1] > 0:
             likelihood = probDownCrossing[-1]
 
+    if instrumentation.enabled:
+        if likelihood == 0:
+            instrumentation.count('zero_likelihood_trials')
+        instrumentation.stop_timer('likelihood', startTime)
+
     if plotResults:
         fig1 = plt.figure()
         xAxis = np.arange(0, maxTime * timeStep, timeStep)
@@ -181,8 +205,7 @@ def run_analysis_wrapper(params):
 
 
 def main():
-    numThreads = 9
-    pool = Pool(numThreads)
+    pool = create_executor()
 
     # Parameters for generating simulations.
     d = 0.006
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# discretization.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import numpy as np
+
+from handle_fixations import analysis_per_trial
+from multiresolution import get_log_step_correction, scale_parameters
+
+
+# Candidate discretizations as (stateStep, timeStep), from coarsest to finest.
+# The error of each candidate is estimated against the grid with half its state
+# and time steps, so half of each state step must also divide the barrier.
+# Estimating the error of a candidate costs about 9 times as much as evaluating
+# the sample trials with it, mostly for the finer grid, so the finest candidate
+# is the default (0.1, 10), whose check runs on a (0.05, 5) grid. Time steps
+# are never below the reference time step, so that the step correction is not
+# negative, which pruning relies on.
+candidateSteps = [(0.5, 40), (0.25, 20), (0.2, 20), (0.1, 10)]
+
+# Maximum mean absolute error allowed in the log likelihood of a trial.
+defaultTolerance = 0.1
+
+
+def get_sample_trials(rt, choice, valueLeft, valueRight, fixItem, fixTime,
+    numTrials=20, seed=0):
+    # A fixed set of trials used to estimate the discretization error.
+    trials = list()
+    for subject in sorted(rt.keys()):
+        for trial in sorted(rt[subject].keys()):
+            trials.append((rt[subject][trial], choice[subject][trial],
+                valueLeft[subject][trial], valueRight[subject][trial],
+                fixItem[subject][trial], fixTime[subject][trial]))
+    randomState = np.random.RandomState(seed)
+    idx = randomState.permutation(len(trials))[:numTrials]
+    return [trials[i] for i in idx]
+
+
+def get_log_likelihoods(trials, d, theta, std, stateStep, timeStep, barrier=1):
+    # Log likelihood of each trial, comparable across discretizations.
+    scaledD, scaledStd = scale_parameters(d, std, timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
+    logLikelihoods = list()
+    for rt, choice, valueLeft, valueRight, fixItem, fixTime in trials:
+        likelihood = analysis_per_trial(rt, choice, valueLeft, valueRight,
+            fixItem, np.array(fixTime), scaledD, theta, std=scaledStd,
+            timeStep=timeStep, stateStep=stateStep, barrier=barrier)
+        if likelihood != 0:
+            logLikelihoods.append(np.log(likelihood) - stepCorrection)
+        else:
+            logLikelihoods.append(np.nan)
+    return np.array(logLikelihoods)
+
+
+def estimate_error(trials, d, theta, std, stateStep, timeStep, barrier=1):
+    # Richardson extrapolation: assuming the error is first order in the step
+    # sizes, halving both steps removes half of it, so the error of the coarse
+    # grid is about twice the difference between the two grids.
+    coarse = get_log_likelihoods(trials, d, theta, std, stateStep, timeStep,
+        barrier)
+    fine = get_log_likelihoods(trials, d, theta, std, stateStep / 2.,
+        timeStep / 2., barrier)
+    differences = np.absolute(coarse - fine)
+    differences = differences[np.isfinite(differences)]
+    if differences.size == 0:
+        return np.inf
+    return 2 * np.mean(differences)
+
+
+def choose_discretization(trials, d, theta, std, barrier=1,
+    tolerance=defaultTolerance, verbose=False):
+    # Pick the coarsest candidate whose estimated error is within the
+    # tolerance, checking the candidates from coarsest to finest and stopping
+    # at the first one that passes. If none does, the finest candidate is used
+    # and a warning is printed with its estimated error. This should be done
+    # once, before a search, with a fixed reference model, so that all the
+    # models of the search are scored on the same grid.
+    for stateStep, timeStep in candidateSteps:
+        error = estimate_error(trials, d, theta, std, stateStep, timeStep,
+            barrier)
+        if verbose:
+            print("Estimated error for (" + str(stateStep) + ", " +
+                str(timeStep) + "): " + str(error))
+        if error <= tolerance:
+            return stateStep, timeStep
+
+    stateStep, timeStep = candidateSteps[-1]
+    print("Warning: the estimated error for (" + str(stateStep) + ", " +
+        str(timeStep) + "), the finest candidate, is " + str(error) +
+        ", above the tolerance of " + str(tolerance) + ".")
+    return stateStep, timeStep
@@ -0,0 +1,430 @@
+#!/usr/bin/python
+
+# distributed_grid.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+
+import collections
+import csv
+import numpy as np
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import profile_likelihood
+from executors import (defaultClusterHost, get_cluster_authkey,
+    get_worker_authkey)
+from group_fitting import run_analysis
+from handle_fixations import get_dataset_hash, load_data_from_csv
+
+
+# A broker serves (model, subjects) tasks over TCP to workers, which may run
+# on other nodes. Each worker evaluates its tasks on its own copy of the
+# dataset, which must have the same hash as the broker's. A task leased by a
+# worker which does not report back within leaseTimeout seconds is served
+# again, up to maxAttempts times in total. The broker listens on the host in
+# ADDM_CLUSTER_HOST (localhost by default) with the authkey of executors.py.
+defaultPort = 50123
+defaultLeaseTimeout = 600.
+defaultMaxAttempts = 3
+
+
+class GridBroker(object):
+    # Task bookkeeping, kept in the broker's server process and accessed by
+    # the coordinator and the workers through proxies.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.datasetHash = None
+        self.leaseTimeout = defaultLeaseTimeout
+        self.maxAttempts = defaultMaxAttempts
+        self.tasks = dict()
+        self.pending = collections.deque()
+        self.leases = dict()
+        self.attempts = dict()
+        self.results = dict()
+        self.failed = dict()
+        self.numRetries = 0
+
+    def configure(self, datasetHash, leaseTimeout, maxAttempts):
+        with self.lock:
+            self.datasetHash = datasetHash
+            self.leaseTimeout = leaseTimeout
+            self.maxAttempts = maxAttempts
+
+    def get_dataset_hash(self):
+        return self.datasetHash
+
+    def add_tasks(self, tasks):
+        # tasks is a dict from task id to task.
+        with self.lock:
+            for taskId, task in tasks.iteritems():
+                self.tasks[taskId] = task
+                self.attempts[taskId] = 0
+                self.pending.append(taskId)
+
+    def release(self, taskId, error):
+        # Serve a task again, unless it has used all its attempts.
+        if self.attempts[taskId] >= self.maxAttempts:
+            self.failed[taskId] = error
+        else:
+            self.numRetries += 1
+            self.pending.append(taskId)
+
+    def expire_leases(self):
+        now = time.time()
+        for taskId, (workerId, leaseTime) in self.leases.items():
+            if now - leaseTime > self.leaseTimeout:
+                del self.leases[taskId]
+                self.release(taskId, "Lease expired on worker " +
+                    str(workerId))
+
+    def get_task(self, workerId):
+        # A (task id, task) pair, an empty tuple if the worker should wait
+        # for leased tasks which may be served again, or None when all tasks
+        # are finished.
+        with self.lock:
+            self.expire_leases()
+            if self.pending:
+                taskId = self.pending.popleft()
+                self.attempts[taskId] += 1
+                self.leases[taskId] = (workerId, time.time())
+                return taskId, self.tasks[taskId]
+            if self.leases:
+                return ()
+            return None
+
+    def put_result(self, workerId, taskId, result):
+        # Late results of expired leases are kept if no other worker has
+        # reported the task yet.
+        with self.lock:
+            if taskId in self.results:
+                return
+            self.results[taskId] = result
+            self.leases.pop(taskId, None)
+            self.failed.pop(taskId, None)
+            if taskId in self.pending:
+                self.pending.remove(taskId)
+
+    def put_error(self, workerId, taskId, error):
+        with self.lock:
+            if taskId in self.results or taskId not in self.leases:
+                return
+            del self.leases[taskId]
+            self.release(taskId, error)
+
+    def get_status(self):
+        with self.lock:
+            self.expire_leases()
+            return {'numTasks': len(self.tasks),
+                'numDone': len(self.results), 'numLeased': len(self.leases),
+                'numPending': len(self.pending), 'numFailed': len(self.failed),
+                'numRetries': self.numRetries}
+
+    def get_leases(self):
+        # The worker holding each leased task.
+        with self.lock:
+            return dict([(taskId, workerId)
+                for taskId, (workerId, leaseTime) in self.leases.iteritems()])
+
+    def get_results(self):
+        with self.lock:
+            return dict(self.results)
+
+    def get_failed(self):
+        with self.lock:
+            return dict(self.failed)
+
+
+# The broker of the server process.
+broker = None
+
+
+def get_broker():
+    global broker
+    if broker is None:
+        broker = GridBroker()
+    return broker
+
+
+class BrokerServer(BaseManager):
+    pass
+
+
+BrokerServer.register('get_broker', callable=get_broker)
+
+
+class BrokerClient(BaseManager):
+    pass
+
+
+BrokerClient.register('get_broker')
+
+
+def get_values(distLeft, distRight):
+    valueLeft = dict()
+    valueRight = dict()
+    for subject in distLeft.keys():
+        valueLeft[subject] = dict()
+        valueRight[subject] = dict()
+        for trial in distLeft[subject].keys():
+            valueLeft[subject][trial] = np.absolute((np.absolute(
+                distLeft[subject][trial])-15)/5)
+            valueRight[subject][trial] = np.absolute((np.absolute(
+                distRight[subject][trial])-15)/5)
+    return valueLeft, valueRight
+
+
+def evaluate_task(data, valueLeft, valueRight, task):
+    # NLL of a model over a group of subjects, on the trials that
+    # run_analysis selects for the given trial subset parameters.
+    model, subjects, trialsPerSubject, seed, useOddTrials, useEvenTrials = task
+    subsetData = list()
+    for values in [data.rt, data.choice, valueLeft, valueRight, data.fixItem,
+        data.fixTime]:
+        subsetData.append(dict([(subject, values[subject])
+            for subject in subjects]))
+    return run_analysis(*(tuple(subsetData) + tuple(model) + (useOddTrials,
+        useEvenTrials, False, None, trialsPerSubject, seed)))
+
+
+def run_grid_worker(host, port=defaultPort, expdataFile="expdata.csv",
+    fixationsFile="fixations.csv", authkey=None, workerId=None,
+    pollInterval=1., connectTimeout=60.):
+    # Pull tasks from the broker until all are finished. Returns False if the
+    # local dataset does not match the broker's.
+    if workerId is None:
+        workerId = os.uname()[1] + ":" + str(os.getpid())
+    if authkey is None:
+        authkey = get_worker_authkey()
+    datasetHash = get_dataset_hash(expdataFile, fixationsFile)
+    data = load_data_from_csv(expdataFile, fixationsFile)
+    valueLeft, valueRight = get_values(data.distLeft, data.distRight)
+
+    # Workers may be started before the broker.
+    client = BrokerClient(address=(host, port), authkey=authkey)
+    startTime = time.time()
+    while True:
+        try:
+            client.connect()
+            break
+        except socket.error:
+            if time.time() - startTime > connectTimeout:
+                raise
+            time.sleep(pollInterval)
+    remoteBroker = client.get_broker()
+    if remoteBroker.get_dataset_hash() != datasetHash:
+        print("Worker " + workerId + ": local dataset " + datasetHash +
+            " does not match the broker's dataset.")
+        return False
+
+    while True:
+        try:
+            item = remoteBroker.get_task(workerId)
+        except (EOFError, IOError):
+            break
+        if item is None:
+            break
+        if item == ():
+            time.sleep(pollInterval)
+            continue
+        taskId, task = item
+        try:
+            result = evaluate_task(data, valueLeft, valueRight, task)
+        except Exception:
+            remoteBroker.put_error(workerId, taskId, traceback.format_exc())
+            continue
+        remoteBroker.put_result(workerId, taskId, result)
+    return True
+
+
+def get_tasks(models, subjectGroups, trialsPerSubject=200, seed=0,
+    useOddTrials=True, useEvenTrials=True):
+    # One task per model and group of subjects.
+    tasks = dict()
+    for model in models:
+        for subjects in subjectGroups:
+            tasks[len(tasks)] = (tuple(model), tuple(subjects),
+                trialsPerSubject, seed, useOddTrials, useEvenTrials)
+    return tasks
+
+
+def run_distributed_grid(models, subjectGroups, trialsPerSubject=200, seed=0,
+    useOddTrials=True, useEvenTrials=True, expdataFile="expdata.csv",
+    fixationsFile="fixations.csv", host=None, port=defaultPort, authkey=None,
+    leaseTimeout=defaultLeaseTimeout, maxAttempts=defaultMaxAttempts,
+    numLocalWorkers=0, pollInterval=1., verbose=True):
+    # Serve the tasks of a grid and wait for all of them to finish or fail.
+    # Workers started elsewhere with 'python distributed_grid.py worker HOST'
+    # join at any time; numLocalWorkers more are started on this host. The
+    # NLL of each model is the sum over its subject groups. Models with a
+    # failed task get no NLL.
+    if host is None:
+        host = os.environ.get("ADDM_CLUSTER_HOST", defaultClusterHost)
+    if authkey is None:
+        authkey = get_cluster_authkey(host)
+    server = BrokerServer(address=(host, port), authkey=authkey)
+    server.start()
+    remoteBroker = server.get_broker()
+    remoteBroker.configure(get_dataset_hash(expdataFile, fixationsFile),
+        leaseTimeout, maxAttempts)
+    tasks = get_tasks(models, subjectGroups, trialsPerSubject, seed,
+        useOddTrials, useEvenTrials)
+    remoteBroker.add_tasks(tasks)
+    if verbose:
+        print("Broker serving " + str(len(tasks)) + " tasks on port " +
+            str(server.address[1]) + "...")
+
+    workers = list()
+    for i in xrange(numLocalWorkers):
+        worker = Process(target=run_grid_worker, args=(host or 'localhost',
+            server.address[1], expdataFile, fixationsFile, authkey))
+        worker.start()
+        workers.append(worker)
+
+    while True:
+        status = remoteBroker.get_status()
+        if status['numDone'] + status['numFailed'] == status['numTasks']:
+            break
+        time.sleep(pollInterval)
+    results = remoteBroker.get_results()
+    failed = remoteBroker.get_failed()
+    for worker in workers:
+        worker.join()
+    server.shutdown()
+
+    NLLs = dict()
+    failedModels = set()
+    for taskId, task in tasks.iteritems():
+        model = task[0]
+        if taskId in failed:
+            failedModels.add(model)
+            if verbose:
+                print("Task " + str(taskId) + " failed: " + failed[taskId])
+        elif model not in failedModels:
+            NLLs[model] = NLLs.get(model, 0) + results[taskId]
+    for model in failedModels:
+        NLLs.pop(model, None)
+    if verbose:
+        print("Finished " + str(status['numDone']) + " tasks with " +
+            str(status['numRetries']) + " retries and " +
+            str(status['numFailed']) + " failures.")
+
+    grid = collections.namedtuple('DistributedGrid', ['NLLs', 'failedModels',
+        'status'])
+    return grid(NLLs, sorted(failedModels), status)
+
+
+def get_slice_models():
+    # The slices of generate_parameter_plots: a fine range of each parameter
+    # crossed with coarse ranges of the other two.
+    coarseRangeD = [0.0008, 0.001, 0.0012]
+    coarseRangeTheta = [0.3, 0.5, 0.7]
+    coarseRangeStd = [0.03, 0.06, 0.09]
+    fineRangeD = np.arange(0.0001, 0.001, 0.0001)
+    fineRangeTheta = np.arange(0.1, 1.0, 0.1)
+    fineRangeStd = np.arange(0.02, 0.11, 0.01)
+    return sorted(set(profile_likelihood.get_slice_models([fineRangeD,
+        fineRangeTheta, fineRangeStd], [coarseRangeD, coarseRangeTheta,
+        coarseRangeStd])))
+
+
+def kill_leasing_worker(workers, authkey, host=defaultClusterHost,
+    port=defaultPort, pollInterval=0.1, connectTimeout=60.):
+    # Terminate the first of the given local workers seen holding a lease.
+    # Gives up when the broker shuts down first.
+    client = BrokerClient(address=(host, port), authkey=authkey)
+    startTime = time.time()
+    while True:
+        try:
+            client.connect()
+            break
+        except socket.error:
+            if time.time() - startTime > connectTimeout:
+                print("Could not connect to the broker.")
+                return
+            time.sleep(pollInterval)
+    remoteBroker = client.get_broker()
+    pids = dict([(worker.pid, worker) for worker in workers])
+    while True:
+        try:
+            leases = remoteBroker.get_leases()
+        except (EOFError, IOError):
+            print("Broker shut down before any worker was killed.")
+            return
+        for workerId in leases.values():
+            pid = int(workerId.split(":")[-1])
+            if pid in pids:
+                pids[pid].terminate()
+                print("Killed worker " + workerId + ".")
+                return
+        time.sleep(pollInterval)
+
+
+def save_grid_to_csv(NLLs, fileName="distributed_grid.csv"):
+    with open(fileName, "wb") as csvFile:
+        csvWriter = csv.writer(csvFile, delimiter=',', quotechar='|',
+            quoting=csv.QUOTE_MINIMAL)
+        csvWriter.writerow(["d", "theta", "std", "NLL"])
+        for model in sorted(NLLs.keys()):
+            csvWriter.writerow(list(model) + [NLLs[model]])
+
+
+def main(argv):
+    # Coordinator: python distributed_grid.py [--local-test]
+    # Worker: python distributed_grid.py worker HOST [EXPDATA FIXATIONS]
+    if argv and argv[0] == "worker":
+        files = argv[2:4] if len(argv) >= 4 else ["expdata.csv",
+            "fixations.csv"]
+        if not run_grid_worker(argv[1], defaultPort, files[0], files[1],
+            get_worker_authkey()):
+            sys.exit(1)
+        return
+
+    data = load_data_from_csv("expdata.csv", "fixations.csv")
+    subjects = sorted(data.rt.keys())
+    if "--local-test" in argv:
+        # A few models and workers on this host. One worker is killed while
+        # it holds a lease, so its task is served again after the lease
+        # expires.
+        models = get_slice_models()[:4]
+        subjectGroups = [[subject] for subject in subjects[:2]]
+        authkey = get_cluster_authkey(defaultClusterHost)
+        workers = list()
+        for i in xrange(3):
+            workers.append(Process(target=run_grid_worker, args=(
+                defaultClusterHost, defaultPort, "expdata.csv",
+                "fixations.csv", authkey)))
+        for worker in workers:
+            worker.start()
+        killer = threading.Thread(target=kill_leasing_worker,
+            args=(workers, authkey))
+        killer.start()
+        grid = run_distributed_grid(models, subjectGroups, trialsPerSubject=10,
+            host=defaultClusterHost, authkey=authkey, leaseTimeout=10.)
+        killer.join()
+        for worker in workers:
+            worker.join()
+        if not any([worker.exitcode < 0 for worker in workers]):
+            print("Local test failed: no worker was killed.")
+            sys.exit(1)
+        if grid.status['numRetries'] < 1 or grid.status['numFailed'] > 0:
+            print("Local test failed: expected a retry and no failures.")
+            sys.exit(1)
+    else:
+        models = get_slice_models()
+        subjectGroups = [[subject] for subject in subjects]
+        grid = run_distributed_grid(models, subjectGroups,
+            trialsPerSubject=100)
+    save_grid_to_csv(grid.NLLs)
+    bestModel = min(grid.NLLs, key=grid.NLLs.get)
+    print("Best model: " + str(bestModel) + " with NLL " +
+        str(grid.NLLs[bestModel]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
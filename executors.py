@@ -0,0 +1,519 @@
+#!/usr/bin/python
+
+# executors.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from multiprocessing import cpu_count, Process, TimeoutError
+from multiprocessing.managers import BaseManager
+from multiprocessing.pool import Pool, ThreadPool
+
+import Queue
+import binascii
+import cPickle
+import importlib
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+# Executors share the interface of multiprocessing.Pool (map, apply_async,
+# close, join and the _processes attribute), so the drivers can use any of
+# them. Backends:
+#   serial: tasks run in the calling process, one at a time.
+#   thread: a pool of threads, for engines that release the GIL.
+#   process: a pool of worker processes, which inherit the parent's globals.
+#   cluster: workers, possibly on other hosts, pulling tasks from a TCP work
+#       queue served by the parent. Started with
+#       'ADDM_CLUSTER_AUTHKEY=KEY python executors.py worker HOST PORT' from
+#       the repository directory.
+# The backend and the number of workers are read from the ADDM_BACKEND and
+# ADDM_WORKERS environment variables unless given.
+backends = ['serial', 'thread', 'process', 'cluster']
+defaultBackend = 'process'
+
+# Cluster settings, which can be set with ADDM_CLUSTER_HOST,
+# ADDM_CLUSTER_PORT and ADDM_CLUSTER_AUTHKEY. The work queue only accepts
+# connections from this host unless another interface is given ('' for all of
+# them). Port 0 picks a free port.
+defaultClusterHost = 'localhost'
+defaultClusterPort = 0
+
+# Cluster workers send a heartbeat every heartbeatInterval seconds. A task
+# held by a worker not heard from for leaseTimeout seconds is served again, up
+# to maxAttempts times in total.
+defaultHeartbeatInterval = 5.
+defaultLeaseTimeout = 30.
+defaultMaxAttempts = 3
+
+# Maps, tasks and wall time spent in maps, per backend, in this process.
+counters = dict()
+
+
+def get_num_workers(backend):
+    # All cores by default, or the number in ADDM_WORKERS.
+    if backend == 'serial':
+        return 1
+    if os.environ.get("ADDM_WORKERS"):
+        return int(os.environ["ADDM_WORKERS"])
+    return cpu_count()
+
+
+def is_loopback(host):
+    if not host:
+        return False
+    try:
+        return socket.gethostbyname(host).startswith("127.")
+    except socket.error:
+        return False
+
+
+def get_cluster_authkey(host):
+    # Tasks and results are pickles, so anyone holding the authkey can run
+    # code on the server and on its workers. Without ADDM_CLUSTER_AUTHKEY a
+    # random key is used, and printed if workers on other hosts can connect,
+    # since they need it in their ADDM_CLUSTER_AUTHKEY.
+    authkey = os.environ.get("ADDM_CLUSTER_AUTHKEY")
+    if authkey:
+        return authkey
+    authkey = binascii.hexlify(os.urandom(16))
+    if not is_loopback(host):
+        print("Listening on " + (host or "all interfaces") + ". Start the "
+            "remote workers with ADDM_CLUSTER_AUTHKEY=" + authkey + ".")
+    return authkey
+
+
+def get_worker_authkey():
+    # Workers started by hand must be given the server's authkey.
+    authkey = os.environ.get("ADDM_CLUSTER_AUTHKEY")
+    if not authkey:
+        print("Set ADDM_CLUSTER_AUTHKEY to the authkey of the server.")
+        sys.exit(1)
+    return authkey
+
+
+def count_tasks(backend, numTasks, wallTime=None):
+    if backend not in counters:
+        counters[backend] = {'maps': 0, 'tasks': 0, 'mapTime': 0.}
+    counters[backend]['tasks'] += numTasks
+    if wallTime is not None:
+        counters[backend]['maps'] += 1
+        counters[backend]['mapTime'] += wallTime
+
+
+def get_counters():
+    # Per backend: number of maps, number of tasks (from maps and
+    # apply_async), time spent in maps and mean task throughput of maps.
+    stats = dict()
+    for backend, c in counters.iteritems():
+        stats[backend] = dict(c)
+        stats[backend]['tasksPerSecond'] = (c['tasks'] / c['mapTime']
+            if c['mapTime'] > 0 else 0)
+    return stats
+
+
+def print_counters():
+    for backend, c in sorted(get_counters().iteritems()):
+        print("Executor " + backend + ": " + str(c['maps']) + " maps, " +
+            str(c['tasks']) + " tasks, " + str(c['mapTime']) + " s in maps, "
+            + str(c['tasksPerSecond']) + " tasks/s")
+
+
+class TaskResult(object):
+    # Result of apply_async for the serial and cluster executors, with the
+    # interface of multiprocessing's AsyncResult.
+    def __init__(self, callback=None):
+        self.event = threading.Event()
+        self.callback = callback
+
+    def set(self, success, value):
+        self.success = success
+        self.value = value
+        if success and self.callback is not None:
+            self.callback(value)
+        self.event.set()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def successful(self):
+        return self.ready() and self.success
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise TimeoutError
+        if not self.success:
+            raise self.value
+        return self.value
+
+
+class SerialExecutor(object):
+    backend = 'serial'
+
+    def __init__(self, initializer=None, initargs=()):
+        self._processes = 1
+        if initializer is not None:
+            initializer(*initargs)
+
+    def map(self, func, iterable, chunksize=None):
+        startTime = time.time()
+        results = map(func, iterable)
+        count_tasks(self.backend, len(results), time.time() - startTime)
+        return results
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        count_tasks(self.backend, 1)
+        result = TaskResult(callback)
+        try:
+            value = func(*args, **kwds)
+        except Exception as e:
+            result.set(False, e)
+        else:
+            result.set(True, value)
+        return result
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+class CountedPool(object):
+    # Adds the counters to the multiprocessing pools.
+    def map(self, func, iterable, chunksize=None):
+        startTime = time.time()
+        results = super(CountedPool, self).map(func, iterable, chunksize)
+        count_tasks(self.backend, len(results), time.time() - startTime)
+        return results
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        count_tasks(self.backend, 1)
+        return super(CountedPool, self).apply_async(func, args, kwds,
+            callback)
+
+
+class ThreadExecutor(CountedPool, ThreadPool):
+    backend = 'thread'
+
+
+class ProcessExecutor(CountedPool, Pool):
+    backend = 'process'
+
+
+# The cluster work queue, which is created in the server process.
+workQueue = None
+
+
+class WorkQueue(object):
+    # Tasks and results of the cluster work queue. Taking a task records its
+    # lease in the same call, so the parent knows which worker holds every
+    # task, even if the worker dies right after taking it.
+    def __init__(self):
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+
+    def put_task(self, task):
+        self.tasks.put(task)
+
+    def get_task(self, workerId):
+        task = self.tasks.get()
+        if task is not None:
+            self.results.put(('lease', workerId, task[0], None))
+        return task
+
+    def put_result(self, item):
+        self.results.put(item)
+
+    def get_result(self, timeout=None):
+        # None if there is no result within the timeout.
+        try:
+            return self.results.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+def get_work_queue():
+    global workQueue
+    if workQueue is None:
+        workQueue = WorkQueue()
+    return workQueue
+
+
+class ClusterServer(BaseManager):
+    pass
+
+
+ClusterServer.register('get_work_queue', callable=get_work_queue)
+
+
+class ClusterClient(BaseManager):
+    pass
+
+
+ClusterClient.register('get_work_queue')
+
+
+def get_main_module_name():
+    # Functions defined in the driver script are pickled as members of
+    # __main__, which on a remote worker must be the same script, imported by
+    # name.
+    mainFile = getattr(sys.modules['__main__'], '__file__', None)
+    if mainFile is None:
+        return None
+    return os.path.splitext(os.path.basename(mainFile))[0]
+
+
+def send_heartbeats(queue, workerId, stop, heartbeatInterval):
+    # Tell the parent that this worker is alive until it stops.
+    while not stop.wait(heartbeatInterval):
+        try:
+            queue.put_result(('heartbeat', workerId, None, None))
+        except (EOFError, IOError):
+            break
+
+
+def run_worker(host, port, authkey, importMain=True,
+    heartbeatInterval=defaultHeartbeatInterval):
+    # Run the tasks of a cluster work queue until it is closed. Tasks and
+    # results are pickled explicitly, so that the driver script can be
+    # imported as __main__ before a task is unpickled. Workers started on the
+    # parent's host are forked and already have its __main__ and the globals
+    # loaded by the driver. Workers on other hosts run the executor's setup
+    # function instead, before their first task.
+    client = ClusterClient(address=(host, port), authkey=authkey)
+    client.connect()
+    queue = client.get_work_queue()
+    workerId = socket.gethostname() + ":" + str(os.getpid())
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=send_heartbeats, args=(queue,
+        workerId, stop, heartbeatInterval))
+    heartbeat.daemon = True
+    heartbeat.start()
+    lastSetup = None
+    while True:
+        try:
+            task = queue.get_task(workerId)
+        except (EOFError, IOError):
+            break
+        if task is None:
+            break
+        taskId, mainModuleName, setup, payload = task
+        try:
+            if importMain and mainModuleName is not None:
+                sys.modules['__main__'] = importlib.import_module(
+                    mainModuleName)
+            if importMain and setup is not None and setup != lastSetup:
+                func, args = cPickle.loads(setup)
+                func(*args)
+                lastSetup = setup
+            func, args, kwds = cPickle.loads(payload)
+            value = cPickle.dumps(func(*args, **kwds),
+                cPickle.HIGHEST_PROTOCOL)
+            queue.put_result(('done', workerId, taskId, value))
+        except Exception:
+            queue.put_result(('failed', workerId, taskId,
+                traceback.format_exc()))
+    stop.set()
+
+
+class ClusterExecutor(object):
+    # Tasks are served to the workers from a TCP work queue. Workers on the
+    # same host are started here; more can join from other hosts at any time.
+    # Remote workers do not run the initializer, since its arguments are
+    # usually shared memory, so they must get all their data from the task
+    # arguments or load it with setup(*setupargs), which each of them runs
+    # before its first task. In particular they have no pruning incumbent and
+    # never prune, while local workers share the parent's. A task whose worker
+    # sends no heartbeat for leaseTimeout seconds is served again, up to
+    # maxAttempts times in total.
+    backend = 'cluster'
+
+    def __init__(self, numWorkers, numLocalWorkers=None, host=None,
+        port=None, authkey=None, initializer=None, initargs=(), setup=None,
+        setupargs=(), heartbeatInterval=defaultHeartbeatInterval,
+        leaseTimeout=defaultLeaseTimeout, maxAttempts=defaultMaxAttempts):
+        if host is None:
+            host = os.environ.get("ADDM_CLUSTER_HOST", defaultClusterHost)
+        if port is None:
+            port = int(os.environ.get("ADDM_CLUSTER_PORT",
+                defaultClusterPort))
+        if authkey is None:
+            authkey = get_cluster_authkey(host)
+        if numLocalWorkers is None:
+            numLocalWorkers = numWorkers
+        if initializer is not None:
+            initializer(*initargs)
+        self._processes = numWorkers
+        self.setup = None
+        if setup is not None:
+            self.setup = cPickle.dumps((setup, setupargs),
+                cPickle.HIGHEST_PROTOCOL)
+        self.heartbeatInterval = heartbeatInterval
+        self.leaseTimeout = leaseTimeout
+        self.maxAttempts = maxAttempts
+        self.server = ClusterServer(address=(host, port), authkey=authkey)
+        self.server.start()
+        self.address = self.server.address
+        self.queue = self.server.get_work_queue()
+        self.mainModuleName = get_main_module_name()
+        self.taskIds = itertools.count()
+        # Per task: its result, its message (to serve it again), the worker
+        # holding it and the number of times it was served. Per worker: the
+        # time it was last heard from.
+        self.pending = dict()
+        self.messages = dict()
+        self.leases = dict()
+        self.attempts = dict()
+        self.lastSeen = dict()
+        self.lock = threading.Lock()
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+        self.workers = list()
+        for i in xrange(numLocalWorkers):
+            worker = Process(target=run_worker, args=(host or 'localhost',
+                self.address[1], authkey, False, heartbeatInterval))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        print("Cluster work queue listening on " + (host or "all interfaces")
+            + ", port " + str(self.address[1]) + ".")
+
+    def collect(self):
+        # Hand each result to the task waiting for it, and serve again the
+        # tasks of workers which stopped sending heartbeats.
+        while True:
+            item = self.queue.get_result(self.heartbeatInterval)
+            now = time.time()
+            if item is not None:
+                kind, workerId, taskId, value = item
+                if kind == 'stop':
+                    break
+                self.lastSeen[workerId] = now
+                if kind == 'lease':
+                    with self.lock:
+                        if taskId in self.pending:
+                            self.leases[taskId] = workerId
+                elif kind == 'done':
+                    self.finish(taskId, True, cPickle.loads(value))
+                elif kind == 'failed':
+                    self.finish(taskId, False, RuntimeError("Task failed on "
+                        "cluster worker " + workerId + ":\n" + value))
+            self.expire_leases(now)
+
+    def finish(self, taskId, success, value):
+        # A task served again may finish twice; the first result is kept.
+        with self.lock:
+            result = self.pending.pop(taskId, None)
+            self.messages.pop(taskId, None)
+            self.leases.pop(taskId, None)
+            self.attempts.pop(taskId, None)
+        if result is not None:
+            result.set(success, value)
+
+    def expire_leases(self, now):
+        expired = list()
+        with self.lock:
+            for taskId, workerId in self.leases.items():
+                if now - self.lastSeen[workerId] > self.leaseTimeout:
+                    expired.append((taskId, workerId))
+                    del self.leases[taskId]
+        for taskId, workerId in expired:
+            if self.attempts[taskId] >= self.maxAttempts:
+                self.finish(taskId, False, RuntimeError("Task " +
+                    str(taskId) + " was lost with cluster worker " +
+                    workerId + " after " + str(self.maxAttempts) +
+                    " attempts."))
+                continue
+            print("Cluster worker " + workerId + " was lost; serving task " +
+                str(taskId) + " again.")
+            with self.lock:
+                self.attempts[taskId] += 1
+                message = self.messages[taskId]
+            self.queue.put_task(message)
+
+    def submit(self, func, args, kwds, callback=None):
+        taskId = next(self.taskIds)
+        result = TaskResult(callback)
+        payload = cPickle.dumps((func, args, kwds), cPickle.HIGHEST_PROTOCOL)
+        message = (taskId, self.mainModuleName, self.setup, payload)
+        with self.lock:
+            self.pending[taskId] = result
+            self.messages[taskId] = message
+            self.attempts[taskId] = 1
+        self.queue.put_task(message)
+        return result
+
+    def map(self, func, iterable, chunksize=None):
+        startTime = time.time()
+        results = [self.submit(func, (args,), {}) for args in iterable]
+        values = [result.get() for result in results]
+        count_tasks(self.backend, len(values), time.time() - startTime)
+        return values
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        count_tasks(self.backend, 1)
+        return self.submit(func, args, kwds, callback)
+
+    def close(self):
+        # One stop marker per expected worker.
+        for i in xrange(max(self._processes, len(self.workers))):
+            self.queue.put_task(None)
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+        self.queue.put_result(('stop', None, None, None))
+        self.collector.join()
+        self.server.shutdown()
+
+    def terminate(self):
+        for worker in self.workers:
+            worker.terminate()
+        self.server.shutdown()
+
+
+def create_executor(backend=None, numWorkers=None, initializer=None,
+    initargs=(), setup=None, setupargs=()):
+    # Executor for the given backend, with the given number of workers, or
+    # those in the environment (see above) by default. Drivers whose tasks
+    # read module globals they loaded, rather than their arguments, must give
+    # a setup function which loads the same globals on cluster workers from
+    # other hosts. Other workers inherit them.
+    if backend is None:
+        backend = os.environ.get("ADDM_BACKEND", defaultBackend)
+    if backend not in backends:
+        raise ValueError("Unknown executor backend: " + str(backend))
+    if numWorkers is None:
+        numWorkers = get_num_workers(backend)
+    if backend == 'serial':
+        return SerialExecutor(initializer, initargs)
+    if backend == 'thread':
+        return ThreadExecutor(numWorkers, initializer, initargs)
+    if backend == 'process':
+        return ProcessExecutor(numWorkers, initializer, initargs)
+    return ClusterExecutor(numWorkers, initializer=initializer,
+        initargs=initargs, setup=setup, setupargs=setupargs)
+
+
+def main(argv):
+    # Start a cluster worker: python executors.py worker HOST PORT
+    if len(argv) != 3 or argv[0] != "worker":
+        print("Usage: python executors.py worker HOST PORT")
+        sys.exit(1)
+    run_worker(argv[1], int(argv[2]), get_worker_authkey())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,7 +7,6 @@ import matplotlib
 matplotlib.use('Agg')
 
 from matplotlib.backends.backend_pdf import PdfPages
-from multiprocessing import Pool
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
@@ -15,40 +14,15 @@ import numpy as np
 import operator
 import pandas as pd
 
-from handle_fixations import load_data_from_csv, analysis_per_trial
-
-
-def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
-    std, verbose=True):
-    trialsPerSubject = 100
-    logLikelihood = 0
-    subjects = rt.keys()
-    for subject in subjects:
-        if verbose:
-            print("Running subject " + subject + "...")
-        trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
-        for trial in trialSet:
-            likelihood = analysis_per_trial(rt[subject][trial],
-                choice[subject][trial], valueLeft[subject][trial],
-                valueRight[subject][trial], fixItem[subject][trial],
-                fixTime[subject][trial], d, theta, std=std)
-            if likelihood != 0:
-                logLikelihood += np.log(likelihood)
-
-    if verbose:
-        print("Negative log likelihood for " + str(d) + ", " + str(theta) + ", "
-            + str(std) + ": " + str(-logLikelihood))
-    return -logLikelihood
-
-
-def run_analysis_wrapper(params):
-    return run_analysis(*params)
+from executors import create_executor
+from handle_fixations import load_data_from_csv
+from profile_likelihood import (parameterNames, evaluate_models, get_slice,
+    get_slice_models, get_surface, get_surface_models, plot_surface)
+from trial_sampling import get_trial_subsets
 
 
 def main():
-    numThreads = 3
-    pool = Pool(numThreads)
+    pool = create_executor()
 
     # Load experimental data from CSV file.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
@@ -81,61 +55,28 @@ def main():
     fineRangeTheta = np.arange(0.1, 1.0, 0.1)
     fineRangeStd = np.arange(0.02, 0.11, 0.01)
 
-    likelihoods = dict()
-
-    # Coarse grid search for d.
-    models = list()
-    list_params = list()
-    for d in fineRangeD:
-        for theta in coarseRangeTheta:
-            for std in coarseRangeStd:
-                if not (d, theta, std) in likelihoods:
-                    models.append((d, theta, std))
-                    params = (rt, choice, valueLeft, valueRight, fixItem,
-                        fixTime, d, theta, std)
-                    list_params.append(params)
-
-    print("Starting pool of workers for d search...")
-    results = pool.map(run_analysis_wrapper, list_params)
-
-    for i in xrange(0, len(results)):
-        likelihoods[models[i]] = results[i]
-
-    # Coarse grid search for theta.
-    models = list()
-    list_params = list()
-    for d in coarseRangeD:
-        for theta in fineRangeTheta:
-            for std in coarseRangeStd:
-                if not (d, theta, std) in likelihoods:
-                    models.append((d, theta, std))
-                    params = (rt, choice, valueLeft, valueRight, fixItem,
-                        fixTime, d, theta, std)
-                    list_params.append(params)
-
-    print("Starting pool of workers for theta search...")
-    results = pool.map(run_analysis_wrapper, list_params)
-
-    for i in xrange(0, len(results)):
-        likelihoods[models[i]] = results[i]
-
-    # Coarse grid search for std.
-    models = list()
-    list_params = list()
-    for d in coarseRangeD:
-        for theta in coarseRangeTheta:
-            for std in fineRangeStd:
-                if not (d, theta, std) in likelihoods:
-                    models.append((d, theta, std))
-                    params = (rt, choice, valueLeft, valueRight, fixItem,
-                        fixTime, d, theta, std)
-                    list_params.append(params)
-
-    print("Starting pool of workers for std search...")
-    results = pool.map(run_analysis_wrapper, list_params)
-
-    for i in xrange(0, len(results)):
-        likelihoods[models[i]] = results[i]
+    # All points are evaluated on the same trials, so the curves are not
+    # affected by trial sampling noise, and points shared by several slices
+    # are evaluated once.
+    trialSets = get_trial_subsets(rt, 100, seed=0)
+    print("Computing likelihood slices...")
+    likelihoods = evaluate_models(pool, rt, choice, valueLeft, valueRight,
+        fixItem, fixTime, get_slice_models([fineRangeD, fineRangeTheta,
+        fineRangeStd], [coarseRangeD, coarseRangeTheta, coarseRangeStd]),
+        trialSets)
+
+    # Surfaces over each pair of parameters, with the third one fixed at the
+    # middle of its coarse range.
+    surfaces = list()
+    fixedModel = (coarseRangeD[1], coarseRangeTheta[1], coarseRangeStd[1])
+    fineRanges = [fineRangeD, fineRangeTheta, fineRangeStd]
+    print("Computing likelihood surfaces...")
+    for axes in [(0, 1), (0, 2), (1, 2)]:
+        surfaces.append((axes, get_surface_models(axes, fineRanges[axes[0]],
+            fineRanges[axes[1]], fixedModel)))
+    evaluate_models(pool, rt, choice, valueLeft, valueRight, fixItem,
+        fixTime, [model for axes, models in surfaces for model in models],
+        trialSets, likelihoods)
 
     # Create pdf file to save figures.
     pp = PdfPages("figures.pdf")
@@ -152,9 +93,8 @@ def main():
     c = 0
     for theta in coarseRangeTheta:
         for std in coarseRangeStd:
-            d_likelihoods = list()
-            for d in fineRangeD:
-                d_likelihoods.append(likelihoods[(d, theta, std)])
+            d_likelihoods = get_slice(likelihoods, 0, fineRangeD,
+                (None, theta, std))
             ax.plot(fineRangeD, d_likelihoods,
                 color=colors[c], label=(str(theta) + ", " + str(std)))
             c += 1
@@ -171,9 +111,8 @@ def main():
     c = 0
     for d in coarseRangeD:
         for std in coarseRangeStd:
-            theta_likelihoods = list()
-            for theta in fineRangeTheta:
-                theta_likelihoods.append(likelihoods[(d, theta, std)])
+            theta_likelihoods = get_slice(likelihoods, 1, fineRangeTheta,
+                (d, None, std))
             ax.plot(fineRangeTheta, theta_likelihoods,
                 color=colors[c], label=(str(d) + ", " + str(std)))
             c += 1
@@ -190,9 +129,8 @@ def main():
     c = 0
     for d in coarseRangeD:
         for theta in coarseRangeTheta:
-            std_likelihoods = list()
-            for std in fineRangeStd:
-                std_likelihoods.append(likelihoods[(d, theta, std)])
+            std_likelihoods = get_slice(likelihoods, 2, fineRangeStd,
+                (d, theta, None))
             ax.plot(fineRangeStd, std_likelihoods,
                 color=colors[c], label=(str(d) + ", " + str(theta)))
             c += 1
@@ -206,9 +144,8 @@ def main():
     # Generate zoomed-in d plots.
     for theta in coarseRangeTheta:
         for std in coarseRangeStd:
-            d_likelihoods = list()
-            for d in fineRangeD:
-                d_likelihoods.append(likelihoods[(d, theta, std)])
+            d_likelihoods = get_slice(likelihoods, 0, fineRangeD,
+                (None, theta, std))
             fig = plt.figure()
             plt.plot(fineRangeD, d_likelihoods)
             plt.title(str(theta) + ", " + str(std))
@@ -219,9 +156,8 @@ def main():
     # Generate zoomed-in theta plots.
     for d in coarseRangeD:
         for std in coarseRangeStd:
-            theta_likelihoods = list()
-            for theta in fineRangeTheta:
-                theta_likelihoods.append(likelihoods[(d, theta, std)])
+            theta_likelihoods = get_slice(likelihoods, 1, fineRangeTheta,
+                (d, None, std))
             fig = plt.figure()
             plt.plot(fineRangeTheta, theta_likelihoods)
             plt.title(str(d) + ", " + str(std))
@@ -232,9 +168,8 @@ def main():
     # Generate zoomed-in std plots.
     for d in coarseRangeD:
         for theta in coarseRangeTheta:
-            std_likelihoods = list()
-            for std in fineRangeStd:
-                std_likelihoods.append(likelihoods[(d, theta, std)])
+            std_likelihoods = get_slice(likelihoods, 2, fineRangeStd,
+                (d, theta, None))
             fig = plt.figure()
             plt.plot(fineRangeStd, std_likelihoods)
             plt.title(str(d) + ", " + str(theta))
@@ -242,8 +177,17 @@ def main():
             plt.ylabel("Negative log likelihood")
             pp.savefig(fig)
 
+    # Generate surface heatmaps.
+    for axes, models in surfaces:
+        surface = get_surface(likelihoods, axes, fineRanges[axes[0]],
+            fineRanges[axes[1]], fixedModel)
+        otherAxis = 3 - axes[0] - axes[1]
+        fig = plot_surface(surface, axes, fineRanges[axes[0]],
+            fineRanges[axes[1]], parameterNames[otherAxis] + " = " +
+            str(fixedModel[otherAxis]))
+        pp.savefig(fig)
+
     pp.close()
-   
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,14 +4,23 @@
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
 from deap import base, creator, tools
-from multiprocessing import Pool
 
+import Queue
 import numpy as np
 import operator
 import random
 import sys
+import traceback
 
+import tracing
+
+from executors import create_executor
 from handle_fixations import load_data_from_csv, analysis_per_trial
+from multiresolution import (defaultSchedule, get_log_step_correction,
+    scale_parameters)
+from pruning import (PRUNED, create_incumbent, exceeds_bound, init_incumbent,
+    reset_incumbent, update_incumbent)
+from trial_sampling import get_trial_subsets
 
 
 # Global variables.
@@ -22,36 +31,67 @@ valueRight = dict()
 fixItem = dict()
 fixTime = dict()
 
+# Fixed trial subsets per subject, so that the fitness of an individual does
+# not depend on when it is evaluated.
+trialSubsets = dict()
+
 
-def evaluate(individual):
+def evaluate(individual, pruneMargin=None, stateStep=0.1, timeStep=10):
     trialsPerSubject = 200
-    d = individual[0]
+    d, std = scale_parameters(individual[0], individual[2], timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
     theta = individual[1]
-    std = individual[2]
 
     logLikelihood = 0
     subjects = rt.keys()
     for subject in subjects:
-        trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
+        trialSet = trialSubsets[subject][:trialsPerSubject]
         for trial in trialSet:
             likelihood = analysis_per_trial(rt[subject][trial],
                 choice[subject][trial], valueLeft[subject][trial],
                 valueRight[subject][trial], fixItem[subject][trial],
-                fixTime[subject][trial], d, theta, std=std, plotResults=False)
+                fixTime[subject][trial], d, theta, std=std, timeStep=timeStep,
+                stateStep=stateStep, plotResults=False)
             if likelihood != 0:
-                logLikelihood += np.log(likelihood)
+                logLikelihood += np.log(likelihood) - stepCorrection
+            # Abandon this individual once its partial NLL passes the
+            # incumbent.
+            if (pruneMargin is not None and
+                exceeds_bound(-logLikelihood, pruneMargin)):
+                print("NLL for " + str(individual) + ": pruned")
+                return PRUNED,
+
+    if pruneMargin is not None:
+        update_incumbent(-logLikelihood)
     print("NLL for " + str(individual) + ": " + str(-logLikelihood))
     return -logLikelihood,
 
 
-def main():
+def evaluate_safely(evaluate, individual):
+    # Python 2 pools have no error callback, so a failed asynchronous
+    # evaluation reports its traceback instead of raising.
+    try:
+        return True, evaluate(individual)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def get_cache_key(individual):
+    # Individuals which agree to 5 significant digits share their fitness.
+    return tuple([float("%.5g" % value) for value in individual])
+
+
+def load_global_data():
+    # Load the data and trial subsets read by evaluate, and create the DEAP
+    # types of the individuals. Called before the pool is created, so that the
+    # workers inherit them, and as setup by cluster workers on other hosts.
     global rt
     global choice
     global valueLeft
     global valueRight
     global fixItem
     global fixTime
+    global trialSubsets
 
     # Load experimental data from CSV file and update global variables.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
@@ -74,6 +114,16 @@ def main():
             valueRight[subject][trial] = np.absolute((np.absolute(
                 distRight[subject][trial])-15)/5)
 
+    trialSubsets = get_trial_subsets(rt, 200, seed=0)
+
+    if not hasattr(creator, "Individual"):
+        creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
+        creator.create("Individual", list, fitness=creator.FitnessMin)
+
+
+def main(multiresolution=False, steadyState=False, trace=False):
+    load_global_data()
+
     # Constants.
     dMin, dMax = 0.0002, 0.08
     thetaMin, thetaMax = 0, 1
@@ -81,16 +131,19 @@ def main():
     crossoverRate = 0.5
     mutationRate = 0.3
     numGenerations = 30
-
-    creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
-    creator.create("Individual", list, fitness=creator.FitnessMin)
+    numElites = 2
+    pruneMargin = 100.
 
     toolbox = base.Toolbox()
 
-    # Create thread pool.
-    numThreads = 8
-    pool = Pool(numThreads)
-    toolbox.register("map", pool.map)
+    # Create the worker pool. Tracing is enabled first, so that the workers
+    # inherit it.
+    if trace:
+        tracing.enable()
+    incumbent = create_incumbent()
+    pool = create_executor(initializer=init_incumbent, initargs=(incumbent,),
+        setup=load_global_data)
+    toolbox.register("map", tracing.traced_map, pool)
 
     # Create individual.
     toolbox.register("attr_d", random.uniform, dMin, dMax)
@@ -108,62 +161,168 @@ def main():
     toolbox.register("mutate", tools.mutGaussian, mu=0,
         sigma=[0.0005, 0.05, 0.005], indpb=0.4)
     toolbox.register("select", tools.selTournament, tournsize=3)
-    toolbox.register("evaluate", evaluate)
 
-    # Evaluate the entire population.
-    fitnesses = toolbox.map(toolbox.evaluate, pop)
+    def is_valid(ind):
+        return not (ind[0] <= dMin or ind[0] >= dMax or ind[1] <= thetaMin or
+            ind[1] >= thetaMax or ind[2] <= stdMin or ind[2] >= stdMax)
+
+    def evaluate_individuals(individuals):
+        # Individuals outside the bounds get the worst fitness. The others are
+        # evaluated on the pool, once per distinct parameter vector, unless
+        # their fitness is already cached.
+        newKeys = list()
+        newInds = list()
+        for ind in individuals:
+            key = get_cache_key(ind)
+            if is_valid(ind) and not key in fitnessCache and not key in newKeys:
+                newKeys.append(key)
+                newInds.append(ind)
+        fitnesses = toolbox.map(toolbox.evaluate, newInds)
+        for key, fit in zip(newKeys, fitnesses):
+            fitnessCache[key] = fit
+        for ind in individuals:
+            if is_valid(ind):
+                ind.fitness.values = fitnessCache[get_cache_key(ind)]
+            else:
+                ind.fitness.values = sys.float_info.max,
+
+    def make_offspring():
+        # Steady-state reproduction: one child from two tournament winners.
+        child1, child2 = map(toolbox.clone, toolbox.select(pop, 2))
+        if random.random() < crossoverRate:
+            toolbox.mate(child1, child2)
+        if random.random() < mutationRate:
+            toolbox.mutate(child1)
+        del child1.fitness.values
+        return child1
+
+    # In multi-resolution mode the generations are split across levels of the
+    # discretization schedule, from coarsest to finest. Each level starts from
+    # the population of the previous one, re-evaluated at the new resolution.
+    if multiresolution:
+        schedule = defaultSchedule
+    else:
+        schedule = [defaultSchedule[-1]]
+    generationsPerLevel = numGenerations // len(schedule)
+
     bestFit = sys.float_info.max
     bestInd = None
-    for ind, fit in zip(pop, fitnesses):
-        ind.fitness.values = fit
-        # Get best individual.
-        if fit < bestFit:
-            bestInd = ind
-
-    for g in range(numGenerations):
-        print("Generation " + str(g) + "...")
-
-        # Select the next generation individuals.
-        offspring = toolbox.select(pop, len(pop))
-        # Clone the selected individuals.
-        offspring = map(toolbox.clone, offspring)
-
-        # Apply crossover and mutation on the offspring.
-        for child1, child2 in zip(offspring[::2], offspring[1::2]):
-            if random.random() < crossoverRate:
-                toolbox.mate(child1, child2)
-                del child1.fitness.values
-                del child2.fitness.values
-
-        for mutant in offspring:
-            if random.random() < mutationRate:
-                toolbox.mutate(mutant)
-                del mutant.fitness.values
-
-        # Evaluate the individuals which are valid but have an invalid fitness.
-        invalidInd = list()
-        for ind in offspring:
-            if (ind[0] <= dMin or ind[0] >= dMax or ind[1] <= thetaMin or
-                ind[1] >= thetaMax or ind[2] <= stdMin or ind[2] >= stdMax):
-                ind.fitness.values = sys.float_info.max,
-            elif not ind.fitness.valid:
-                invalidInd.append(ind)
-        fitnesses = map(toolbox.evaluate, invalidInd)
-        for ind, fit in zip(invalidInd, fitnesses):
-            ind.fitness.values = fit
+    for stateStep, timeStep in schedule:
+        print("Using state step " + str(stateStep) + " and time step " +
+            str(timeStep) + "...")
+        reset_incumbent()
+        toolbox.register("evaluate", evaluate, pruneMargin=pruneMargin,
+            stateStep=stateStep, timeStep=timeStep)
+
+        # Fitnesses and elites from other levels are not comparable.
+        fitnessCache = dict()
+        if numElites > 0:
+            hallOfFame = tools.HallOfFame(numElites)
 
-        # The population is entirely replaced by the offspring.
-        pop[:] = offspring
+        # Report how much the NLL of the best individual changes between
+        # levels.
+        if bestInd is not None:
+            newFit = evaluate(bestInd, stateStep=stateStep,
+                timeStep=timeStep)[0]
+            print("NLL discrepancy for " + str(bestInd) + ": " +
+                str(newFit - bestFit))
+            bestFit = newFit
 
-        # Update best individual.
+        # Evaluate the entire population.
+        evaluate_individuals(pop)
         for ind in pop:
+            # Get best individual.
             if ind.fitness.values[0] < bestFit:
                 bestFit = ind.fitness.values[0]
                 bestInd = ind
+        if numElites > 0:
+            hallOfFame.update(pop)
+
+        if steadyState:
+            # Keep every worker busy: as soon as an evaluation finishes, its
+            # individual replaces the worst one in the population if it is
+            # better, and a new offspring is submitted in its place.
+            numEvaluations = generationsPerLevel * len(pop)
+            results = Queue.Queue()
+
+            def submit():
+                child = make_offspring()
+                key = get_cache_key(child)
+                if not is_valid(child):
+                    results.put((child, (True, (sys.float_info.max,))))
+                elif key in fitnessCache:
+                    results.put((child, (True, fitnessCache[key])))
+                else:
+                    pool.apply_async(evaluate_safely, (toolbox.evaluate,
+                        child), callback=lambda res, child=child:
+                        results.put((child, res)))
+
+            numSubmitted = 0
+            while numSubmitted < min(pool._processes, numEvaluations):
+                submit()
+                numSubmitted += 1
+            for e in xrange(numEvaluations):
+                child, (success, fit) = results.get()
+                if not success:
+                    raise RuntimeError("Evaluation of " + str(child) +
+                        " failed:\n" + fit)
+                child.fitness.values = fit
+                if is_valid(child):
+                    fitnessCache[get_cache_key(child)] = fit
+                worst = max(pop, key=lambda ind: ind.fitness.values[0])
+                if fit[0] < worst.fitness.values[0]:
+                    pop[pop.index(worst)] = child
+                if fit[0] < bestFit:
+                    bestFit = fit[0]
+                    bestInd = child
+                if numSubmitted < numEvaluations:
+                    submit()
+                    numSubmitted += 1
+            continue
+
+        for g in range(generationsPerLevel):
+            print("Generation " + str(g) + "...")
+
+            # Select the next generation individuals.
+            offspring = toolbox.select(pop, len(pop))
+            # Clone the selected individuals.
+            offspring = map(toolbox.clone, offspring)
+
+            # Apply crossover and mutation on the offspring.
+            for child1, child2 in zip(offspring[::2], offspring[1::2]):
+                if random.random() < crossoverRate:
+                    toolbox.mate(child1, child2)
+                    del child1.fitness.values
+                    del child2.fitness.values
+
+            for mutant in offspring:
+                if random.random() < mutationRate:
+                    toolbox.mutate(mutant)
+                    del mutant.fitness.values
+
+            # Evaluate the individuals which have an invalid fitness on the
+            # pool.
+            evaluate_individuals([ind for ind in offspring
+                if not ind.fitness.valid])
+
+            # The population is replaced by the offspring, except that the
+            # best individuals found so far replace the worst offspring.
+            if numElites > 0:
+                hallOfFame.update(offspring)
+                offspring.sort(key=lambda ind: ind.fitness.values[0])
+                offspring[-numElites:] = map(toolbox.clone, hallOfFame)
+            pop[:] = offspring
+
+            # Update best individual.
+            for ind in pop:
+                if ind.fitness.values[0] < bestFit:
+                    bestFit = ind.fitness.values[0]
+                    bestInd = ind
 
     print bestFit
     print bestInd
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main("--multiresolution" in sys.argv[1:],
+        "--steady-state" in sys.argv[1:], "--trace" in sys.argv[1:])
\ No newline at end of file
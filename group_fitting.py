@@ -7,20 +7,38 @@ import matplotlib
 matplotlib.use('Agg')
 
 from matplotlib.backends.backend_pdf import PdfPages
-from multiprocessing import Pool
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy as np
 import operator
 import pandas as pd
+import sys
 
+import instrumentation
+import tracing
+
+from adaptive_grid import (adaptive_grid_search, get_centered_ranges,
+    get_grid_spacing)
+from discretization import choose_discretization, get_sample_trials
+from executors import create_executor, print_counters
 from handle_fixations import (load_data_from_csv, analysis_per_trial,
     get_empirical_distributions, run_simulations)
+from mapreduce_nll import get_trial_sets, run_mapreduce_nll
+from multiresolution import (defaultSchedule, referenceTimeStep,
+    run_multiresolution, get_log_step_correction, scale_parameters)
+from pruning import (PRUNED, create_incumbent, exceeds_bound, init_incumbent,
+    reset_incumbent, update_incumbent)
+from simulation_summaries import (get_choice_curve, get_rt_curve,
+    run_parallel_simulation_summary)
+from trial_sampling import get_trial_subset
 
 
 def generate_choice_curves(choicesData, valueLeftData, valueRightData,
-    choicesSimul, valueLeftSimul, valueRightSimul, numTrials):
+    choicesSimul, valueLeftSimul, valueRightSimul, numTrials,
+    simulSummary=None):
+    # The simulated curve comes from simulSummary if given, and otherwise from
+    # the simulated trials.
     countTotal = np.zeros(7)
     countLeftChosen = np.zeros(7)
 
@@ -49,24 +67,27 @@ def generate_choice_curves(choicesData, valueLeftData, valueRightData,
     plt.errorbar(range(-3,4,1), probLeftChosen, yerr=stdProbLeftChosen,
         color=colors[0], label='Data')
 
-    countTotal = np.zeros(7)
-    countLeftChosen = np.zeros(7)
+    if simulSummary is not None:
+        probLeftChosen, stdProbLeftChosen = get_choice_curve(simulSummary)
+    else:
+        countTotal = np.zeros(7)
+        countLeftChosen = np.zeros(7)
 
-    for trial in xrange(0, numTrials):
-        valueDiff = valueLeftSimul[trial] - valueRightSimul[trial]
-        idx = valueDiff + 3
-        if choicesSimul[trial] == -1:  # Choice was left.
-            countLeftChosen[idx] +=1
-            countTotal[idx] += 1
-        elif choicesSimul[trial] == 1:  # Choice was right.
-            countTotal[idx] += 1
+        for trial in xrange(0, numTrials):
+            valueDiff = valueLeftSimul[trial] - valueRightSimul[trial]
+            idx = valueDiff + 3
+            if choicesSimul[trial] == -1:  # Choice was left.
+                countLeftChosen[idx] +=1
+                countTotal[idx] += 1
+            elif choicesSimul[trial] == 1:  # Choice was right.
+                countTotal[idx] += 1
 
-    stdProbLeftChosen = np.zeros(7)
-    probLeftChosen = np.zeros(7)
-    for i in xrange(0,7):
-        probLeftChosen[i] = countLeftChosen[i] / countTotal[i]
-        stdProbLeftChosen[i] = np.sqrt((probLeftChosen[i] *
-            (1 - probLeftChosen[i])) / countTotal[i])
+        stdProbLeftChosen = np.zeros(7)
+        probLeftChosen = np.zeros(7)
+        for i in xrange(0,7):
+            probLeftChosen[i] = countLeftChosen[i] / countTotal[i]
+            stdProbLeftChosen[i] = np.sqrt((probLeftChosen[i] *
+                (1 - probLeftChosen[i])) / countTotal[i])
 
     plt.errorbar(range(-3,4,1), probLeftChosen, yerr=stdProbLeftChosen,
         color=colors[5], label='Simulations')
@@ -77,7 +98,9 @@ def generate_choice_curves(choicesData, valueLeftData, valueRightData,
 
 
 def generate_rt_curves(rtsData, valueLeftData, valueRightData, rtsSimul,
-    valueLeftSimul, valueRightSimul, numTrials):
+    valueLeftSimul, valueRightSimul, numTrials, simulSummary=None):
+    # The simulated curve comes from simulSummary if given, and otherwise from
+    # the simulated trials.
     rtsPerValueDiff = dict()
     for valueDiff in xrange(-3,4,1):
         rtsPerValueDiff[valueDiff] = list()
@@ -103,21 +126,24 @@ def generate_rt_curves(rtsData, valueLeftData, valueRightData, rtsSimul,
     plt.errorbar(range(-3,4,1), meanRts, yerr=stdRts, label='Data',
         color=colors[0])
 
-    rtsPerValueDiff = dict()
-    for valueDiff in xrange(-3,4,1):
-        rtsPerValueDiff[valueDiff] = list()
+    if simulSummary is not None:
+        meanRts, stdRts = get_rt_curve(simulSummary)
+    else:
+        rtsPerValueDiff = dict()
+        for valueDiff in xrange(-3,4,1):
+            rtsPerValueDiff[valueDiff] = list()
 
-    for trial in xrange(0, numTrials):
-        valueDiff = valueLeftSimul[trial] - valueRightSimul[trial]
-        rtsPerValueDiff[valueDiff].append(rtsSimul[trial])
+        for trial in xrange(0, numTrials):
+            valueDiff = valueLeftSimul[trial] - valueRightSimul[trial]
+            rtsPerValueDiff[valueDiff].append(rtsSimul[trial])
 
-    meanRts = np.zeros(7)
-    stdRts = np.zeros(7)
-    for valueDiff in xrange(-3,4,1):
-        idx = valueDiff + 3
-        meanRts[idx] = np.mean(np.array(rtsPerValueDiff[valueDiff]))
-        stdRts[idx] = (np.std(np.array(rtsPerValueDiff[valueDiff])) /
-            np.sqrt(len(rtsPerValueDiff[valueDiff])))
+        meanRts = np.zeros(7)
+        stdRts = np.zeros(7)
+        for valueDiff in xrange(-3,4,1):
+            idx = valueDiff + 3
+            meanRts[idx] = np.mean(np.array(rtsPerValueDiff[valueDiff]))
+            stdRts[idx] = (np.std(np.array(rtsPerValueDiff[valueDiff])) /
+                np.sqrt(len(rtsPerValueDiff[valueDiff])))
 
     plt.errorbar(range(-3,4,1), meanRts, yerr=stdRts, label='Simulations',
         color=colors[5])
@@ -159,15 +185,41 @@ def save_simulations_to_csv(choice, rt, valueLeft, valueRight, fixItem,
 
 
 def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
-    std, useOddTrials=True, useEvenTrials=True, verbose=True):
-    trialsPerSubject = 200
+    std, useOddTrials=True, useEvenTrials=True, verbose=True, pruneMargin=None,
+    trialsPerSubject=200, seed=None, stateStep=0.1, timeStep=10,
+    trialSubsets=None):
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
+        instrumentation.reset()
+
+    # Pruning relies on every trial adding a non-negative amount to the NLL,
+    # which the step correction only guarantees for time steps of at least
+    # the reference time step.
+    if pruneMargin is not None and timeStep < referenceTimeStep:
+        raise ValueError("Pruning needs time steps of at least " +
+            str(referenceTimeStep) + " ms.")
+
+    # The NLL is reported for the given parameters, which are rescaled to the
+    # time step used for the computation.
+    scaledD, scaledStd = scale_parameters(d, std, timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
     logLikelihood = 0
     subjects = rt.keys()
     for subject in subjects:
         if verbose:
             print("Running subject " + subject + "...")
         trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
+        if trialSubsets is not None:
+            # Subsets drawn by the caller, e.g. stratified ones.
+            trialSet = trialSubsets[subject]
+        elif seed is None:
+            trialSet = np.random.choice(trials, trialsPerSubject,
+                replace=False)
+        else:
+            # With a fixed seed every model is scored on the same trials, and
+            # smaller subsets are contained in larger ones. trialsPerSubject
+            # set to None uses all trials.
+            trialSet = get_trial_subset(trials, trialsPerSubject, seed)
         for trial in trialSet:
             if not useOddTrials and trial % 2 != 0:
                 continue
@@ -176,13 +228,29 @@ def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
             likelihood = analysis_per_trial(rt[subject][trial],
                 choice[subject][trial], valueLeft[subject][trial],
                 valueRight[subject][trial], fixItem[subject][trial],
-                fixTime[subject][trial], d, theta, std=std)
+                fixTime[subject][trial], scaledD, theta, std=scaledStd,
+                timeStep=timeStep, stateStep=stateStep)
             if likelihood != 0:
-                logLikelihood += np.log(likelihood)
-
+                logLikelihood += np.log(likelihood) - stepCorrection
+            # Abandon this model once its partial NLL passes the incumbent.
+            if (pruneMargin is not None and
+                exceeds_bound(-logLikelihood, pruneMargin)):
+                if verbose:
+                    print("NLL for " + str(d) + ", " + str(theta) + ", "
+                        + str(std) + ": pruned")
+                if instrumentation.enabled:
+                    instrumentation.dump_call('group_fitting.run_analysis',
+                        (d, theta, std), -logLikelihood, startTime)
+                return PRUNED
+
+    if pruneMargin is not None:
+        update_incumbent(-logLikelihood)
     if verbose:
         print("NLL for " + str(d) + ", " + str(theta) + ", "
             + str(std) + ": " + str(-logLikelihood))
+    if instrumentation.enabled:
+        instrumentation.dump_call('group_fitting.run_analysis',
+            (d, theta, std), -logLikelihood, startTime)
     return -logLikelihood
 
 
@@ -190,9 +258,16 @@ def run_analysis_wrapper(params):
     return run_analysis(*params)
 
 
-def main():
-    numThreads = 9
-    pool = Pool(numThreads)
+def main(multiresolution=False, aggregateOnly=False, instrument=False,
+    trace=False, autoDiscretization=False):
+    # Instrumentation is enabled before the workers are created, so that they
+    # inherit it.
+    if instrument:
+        instrumentation.enable()
+    if trace:
+        tracing.enable()
+    incumbent = create_incumbent()
+    pool = create_executor(initializer=init_incumbent, initargs=(incumbent,))
 
     # Load experimental data from CSV file.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
@@ -224,28 +299,71 @@ def main():
     rangeTheta = [0.3, 0.5, 0.7]
     rangeStd = [0.03, 0.06, 0.09]
 
-    models = list()
-    listParams = list()
-    for d in rangeD:
-        for theta in rangeTheta:
-            for std in rangeStd:
-                models.append((d, theta, std))
-                params = (rt, choice, valueLeft, valueRight, fixItem, fixTime,
-                    d, theta, std, True, False)
-                listParams.append(params)
-
-    results = pool.map(run_analysis_wrapper, listParams)
+    # The grid is refined adaptively around the best models, starting from
+    # the coarse ranges above. Models which are clearly dominated by the
+    # incumbent are abandoned before all their trials are evaluated.
+    dominanceMargin = 10.
+    bounds = [(0.0001, 0.01), (0., 1.), (0.01, 0.15)]
+    dataParams = (rt, choice, valueLeft, valueRight, fixItem, fixTime)
+    # All models are scored on the same trials, so that their NLLs are
+    # comparable and pruning decisions are not affected by sampling noise.
+    seed = 0
+
+    def fit_level(model, stateStep, timeStep):
+        # Finer levels search a narrower grid around the previous optimum.
+        level = defaultSchedule.index((stateStep, timeStep))
+        spacings = [get_grid_spacing(r) * (0.5 ** level)
+            for r in [rangeD, rangeTheta, rangeStd]]
+        levelRangeD, levelRangeTheta, levelRangeStd = get_centered_ranges(
+            model, spacings, bounds)
+        # NLLs from different levels are not comparable, so the incumbent
+        # starts over.
+        reset_incumbent()
+        search = adaptive_grid_search(pool, run_analysis_wrapper, dataParams,
+            levelRangeD, levelRangeTheta, levelRangeStd,
+            extraParams=(True, False, True, dominanceMargin, 200, seed,
+            stateStep, timeStep), bounds=bounds,
+            dominanceMargin=dominanceMargin)
+        return search.model, search.NLL
+
+    def evaluate_level(model, stateStep, timeStep):
+        # A single model, so its trials are spread over all the workers.
+        trialSets = get_trial_sets(rt, 200, seed, True, False)
+        return run_mapreduce_nll(pool, *(dataParams + ([model], trialSets)),
+            stateStep=stateStep, timeStep=timeStep).NLLs[0]
+
+    if multiresolution:
+        x0 = (rangeD[1], rangeTheta[1], rangeStd[1])
+        levels = run_multiresolution(fit_level, evaluate_level, x0)
+        optimModel, minNLL = levels[-1].x, levels[-1].NLL
+    else:
+        # In automatic mode the coarsest discretization meeting the default
+        # likelihood tolerance is chosen once, for the center of the coarse
+        # grid on fixed sample trials, and used for every model, so that all
+        # NLLs of the search are comparable.
+        steps = (0.1, 10)
+        if autoDiscretization:
+            sampleTrials = get_sample_trials(*dataParams)
+            steps = choose_discretization(sampleTrials, rangeD[1],
+                rangeTheta[1], rangeStd[1], verbose=True)
+            print("Using discretization " + str(steps) + ".")
+        search = adaptive_grid_search(pool, run_analysis_wrapper, dataParams,
+            rangeD, rangeTheta, rangeStd,
+            extraParams=(True, False, True, dominanceMargin, 200, seed) +
+            steps, bounds=bounds,
+            dominanceMargin=dominanceMargin)
+        optimModel, minNLL = search.model, search.NLL
 
     # Get optimal parameters.
-    minNegLogLikeIdx = results.index(min(results))
-    optimD = models[minNegLogLikeIdx][0]
-    optimTheta = models[minNegLogLikeIdx][1]
-    optimStd = models[minNegLogLikeIdx][2]
-    print("Finished coarse grid search!")
+    optimD = optimModel[0]
+    optimTheta = optimModel[1]
+    optimStd = optimModel[2]
+    print("Finished adaptive grid search!")
+    print_counters()
     print("Optimal d: " + str(optimD))
     print("Optimal theta: " + str(optimTheta))
     print("Optimal std: " + str(optimStd))
-    print("Min NLL: " + str(min(results)))
+    print("Min NLL: " + str(minNLL))
 
     # Get empirical distributions from even trials.
     evenDists = get_empirical_distributions(rt, choice, distLeft, distRight,
@@ -266,6 +384,26 @@ def main():
             if oLeft != oRight:
                 trialConditions.append((oLeft, oRight))
 
+    # In aggregate-only mode, the simulated trials are only accumulated into
+    # choice and RT summaries per value difference, so many more of them can
+    # be simulated. Individual trials are then not saved.
+    if aggregateOnly:
+        numTrials = 250000
+        summary = run_parallel_simulation_summary(pool, probLeftFixFirst,
+            distTransition, distFirstFix, distSecondFix, distThirdFix,
+            distOtherFix, numTrials, trialConditions, optimD, optimTheta,
+            optimStd, rtBins=np.arange(0, 10001, 100))
+        pp = PdfPages("figures_" + str(optimD) + "_" + str(optimTheta) + "_" +
+            str(optimStd) + "_" + str(numTrials) + ".pdf")
+        fig1 = generate_choice_curves(choice, valueLeft, valueRight, None,
+            None, None, 0, simulSummary=summary)
+        pp.savefig(fig1)
+        fig2 = generate_rt_curves(rt, valueLeft, valueRight, None, None, None,
+            0, simulSummary=summary)
+        pp.savefig(fig2)
+        pp.close()
+        return
+
     # Generate simulations using the even trials distributions and the
     # estimated parameters.
     simul = run_simulations(probLeftFixFirst, distTransition, distFirstFix,
@@ -308,4 +446,6 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main("--multiresolution" in sys.argv[1:],
+        "--aggregate-only" in sys.argv[1:], "--instrument" in sys.argv[1:],
+        "--trace" in sys.argv[1:], "--auto-discretization" in sys.argv[1:])
\ No newline at end of file
@@ -3,25 +3,36 @@
 # group_posteriors.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from multiprocessing import Pool
-
 import numpy as np
+import sys
+
+import tracing
+
+from adaptive_grid import (adaptive_grid_search, get_centered_ranges,
+    get_grid_spacing)
+from executors import create_executor, print_counters
+from group_fitting import run_analysis_wrapper as fitting_wrapper
+from handle_fixations import (load_data_from_csv, get_empirical_distributions,
+    simulate_trials)
+from posterior_engine import (compute_posteriors, get_likelihood_matrix,
+    get_trial_list)
+
 
-from group_fitting import save_simulations_to_csv
-from handle_fixations import (load_data_from_csv, analysis_per_trial,
-    get_empirical_distributions, run_simulations)
+def simulate_trials_wrapper(params):
+    return simulate_trials(*params)
 
 
 def generate_probabilistic_simulations(probLeftFixFirst, distTransition,
     distFirstFix, distSecondFix, distThirdFix, distOtherFix, posteriors,
-    numSamples=100, numSimulationsPerSample=10):
-    posteriorsList = list()
-    models = dict()
-    i = 0
-    for model, posterior in posteriors.iteritems():
-        posteriorsList.append(posterior)
-        models[i] = model
-        i += 1
+    numSamples=100, numSimulationsPerSample=10, pool=None, numChunks=None,
+    seed=None, outputFile="posterior_predictive.npz"):
+    # Posterior predictive simulations: every simulated trial gets its own
+    # model, drawn from the posteriors. The trials are split into chunks,
+    # simulated in parallel if a pool is given, and saved as columns to a
+    # numpy archive, with the fixations in a flat table indexed by fixTrial.
+    models = posteriors.keys()
+    probs = np.array([posteriors[model] for model in models])
+    probs /= np.sum(probs)
 
     # Parameters for generating simulations.
     orientations = range(-15,20,5)
@@ -31,54 +42,61 @@ def generate_probabilistic_simulations(probLeftFixFirst, distTransition,
             if oLeft != oRight:
                 trialConditions.append((oLeft, oRight))
 
-    rt = dict()
-    choice = dict()
-    valueLeft = dict()
-    valueRight = dict()
-    fixItem = dict()
-    fixTime = dict()
-    fixRDV = dict()
-
-    numModels = len(models.keys())
-    trialCount = 0
-    for i in xrange(numSamples):
-        # Sample model from posteriors distribution.
-        modelIndex = np.random.choice(np.array(range(numModels)),
-            p=np.array(posteriorsList))
-        model = models[modelIndex]
-        d = model[0]
-        theta = model[1]
-        std = model[2]
-
-        # Generate simulations with the sampled model.
-        simul = run_simulations(probLeftFixFirst, distTransition, distFirstFix,
-            distSecondFix, distThirdFix, distOtherFix, numSimulationsPerSample,
-            trialConditions, d, theta, std=std)
-        for trial in simul.rt.keys():
-            rt[trialCount] = simul.rt[trial]
-            choice[trialCount] = simul.choice[trial]
-            fixTime[trialCount] = simul.fixTime[trial]
-            fixItem[trialCount] = simul.fixItem[trial]
-            fixRDV[trialCount] = simul.fixRDV[trial]
-            valueLeft[trialCount] = np.absolute((np.absolute(
-                simul.distLeft[trial])-15)/5)
-            valueRight[trialCount] = np.absolute((np.absolute(
-                simul.distRight[trial])-15)/5)
-            trialCount += 1
-
-    numTrials = len(rt.keys())
-    save_simulations_to_csv(choice, rt, valueLeft, valueRight, fixItem, fixTime,
-        fixRDV, numTrials)
-
-
-def run_analysis_wrapper(params):
-    return analysis_per_trial(*params)
-
-
-def main():
+    # Sample the model of every trial at once.
+    randomState = np.random.RandomState(seed)
+    numRepeats = numSamples * numSimulationsPerSample
+    numTrials = numRepeats * len(trialConditions)
+    modelIdx = randomState.choice(len(models), size=numTrials, p=probs)
+    params = np.array(models)[modelIdx]
+    conditions = np.tile(np.array(trialConditions), (numRepeats, 1))
+    distLeft = conditions[:,0]
+    distRight = conditions[:,1]
+    valueLeft = np.absolute((np.absolute(distLeft)-15)/5)
+    valueRight = np.absolute((np.absolute(distRight)-15)/5)
+
+    if numChunks is None:
+        numChunks = 1 if pool is None else 4 * pool._processes
+    # No empty chunks.
+    numChunks = max(min(numChunks, numTrials), 1)
+    bounds = np.linspace(0, numTrials, numChunks + 1).astype(int)
+    seeds = randomState.randint(2 ** 31 - 1, size=numChunks)
+    listParams = list()
+    for i in xrange(numChunks):
+        chunk = slice(bounds[i], bounds[i+1])
+        listParams.append((probLeftFixFirst, distTransition, distFirstFix,
+            distSecondFix, distThirdFix, distOtherFix, valueLeft[chunk],
+            valueRight[chunk], params[chunk,0], params[chunk,1],
+            params[chunk,2], 10, 1, 0, 0, seeds[i]))
+    if pool is None:
+        results = map(simulate_trials_wrapper, listParams)
+    else:
+        results = tracing.traced_map(pool, simulate_trials_wrapper,
+            listParams)
+
+    # Fixations refer to trials by their index within the whole simulation.
+    simul = dict()
+    simul['rt'] = np.concatenate([r.rt for r in results])
+    simul['choice'] = np.concatenate([r.choice for r in results])
+    simul['distLeft'] = distLeft
+    simul['distRight'] = distRight
+    simul['model'] = modelIdx
+    simul['d'] = params[:,0]
+    simul['theta'] = params[:,1]
+    simul['std'] = params[:,2]
+    simul['fixTrial'] = np.concatenate([r.fixTrial + bounds[i]
+        for i, r in enumerate(results)])
+    for key in ['fixItem', 'fixTime', 'fixRDV']:
+        simul[key] = np.concatenate([getattr(r, key) for r in results])
+    if outputFile is not None:
+        np.savez(outputFile, **simul)
+    return simul
+
+
+def main(trace=False, center=None):
+    if trace:
+        tracing.enable()
     trialsPerSubject = 500
-    numThreads = 9
-    pool = Pool(numThreads)
+    pool = create_executor()
 
     # Load experimental data from CSV file.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
@@ -107,6 +125,20 @@ def main():
     rangeD = [0.0045, 0.005, 0.0055]
     rangeTheta = [0.25, 0.3, 0.35]
     rangeStd = [0.08, 0.085, 0.09]
+
+    # Center the model grid on the given model, e.g. the optimum found by
+    # group_fitting, keeping the spacing of the ranges above. Without one,
+    # the best model of an adaptive grid search is used. Its models are all
+    # scored on the same trials, so the center does not change between runs.
+    if center is None:
+        dataParams = (rt, choice, valueLeft, valueRight, fixItem, fixTime)
+        search = adaptive_grid_search(pool, fitting_wrapper, dataParams,
+            rangeD, rangeTheta, rangeStd,
+            extraParams=(True, True, False, None, 200, 0), verbose=False)
+        center = search.model
+    print("Centering the model grid on " + str(tuple(center)) + ".")
+    spacings = [get_grid_spacing(r) for r in [rangeD, rangeTheta, rangeStd]]
+    rangeD, rangeTheta, rangeStd = get_centered_ranges(center, spacings)
     numModels = len(rangeD) * len(rangeTheta) * len(rangeStd)
 
     models = list()
@@ -118,40 +150,30 @@ def main():
                 models.append(model)
                 posteriors[model] = 1./ numModels
 
+    trialSets = list()
     subjects = rt.keys()
     for subject in subjects:
-        print("Running subject " + subject + "...")
         trials = rt[subject].keys()
         trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
-        for trial in trialSet:
-            listParams = list()
-            for model in models:
-                listParams.append((rt[subject][trial], choice[subject][trial],
-                    valueLeft[subject][trial], valueRight[subject][trial],
-                    fixItem[subject][trial], fixTime[subject][trial], model[0],
-                    model[1], model[2]))
-            likelihoods = pool.map(run_analysis_wrapper, listParams)
-
-            # Get the denominator for normalizing the posteriors.
-            i = 0
-            denominator = 0
-            for model in models:
-                denominator += posteriors[model] * likelihoods[i]
-                i += 1
-            if denominator == 0:
-                continue
-
-            # Calculate the posteriors after this trial.
-            i = 0
-            for model in models:
-                if likelihoods[i] != 0:
-                    prior = posteriors[model]
-                    posteriors[model] = likelihoods[i] * prior / denominator
-                i += 1
-
-        for model in posteriors:
-            print("P" + str(model) + " = " + str(posteriors[model]))
-        print("Sum: " + str(sum(posteriors.values())))
+        trialSets.append((subject, trialSet))
+
+    # The likelihoods of all trials under all models are computed in one
+    # batch, and the posteriors are then updated trial by trial in log space.
+    trials = get_trial_list(rt, choice, valueLeft, valueRight, fixItem, fixTime,
+        trialSets)
+    likelihoods = get_likelihood_matrix(pool, trials, models)
+    res = compute_posteriors(likelihoods, models,
+        [posteriors[model] for model in models])
+    posteriors = res.posteriors
+
+    # Print the posteriors after the trials of each subject.
+    numTrials = 0
+    for subject, trialSet in trialSets:
+        numTrials += len(trialSet)
+        print("Posteriors after subject " + subject + ":")
+        for model, logPosterior in zip(models, res.trajectory[numTrials]):
+            print("P" + str(model) + " = " + str(np.exp(logPosterior)))
+        print("Sum: " + str(np.sum(np.exp(res.trajectory[numTrials]))))
 
     # Get empirical distributions for the data.
     dists = get_empirical_distributions(rt, choice, distLeft, distRight,
@@ -164,8 +186,15 @@ def main():
     distOtherFix = dists.distOtherFix
 
     generate_probabilistic_simulations(probLeftFixFirst, distTransition,
-        distFirstFix, distSecondFix, distThirdFix, distOtherFix, posteriors)
+        distFirstFix, distSecondFix, distThirdFix, distOtherFix, posteriors,
+        pool=pool)
+    print_counters()
 
 
 if __name__ == '__main__':
-    main()
+    # The grid center can be given as --center=D,THETA,STD.
+    center = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--center="):
+            center = [float(v) for v in arg[len("--center="):].split(",")]
+    main("--trace" in sys.argv[1:], center)
@@ -6,10 +6,13 @@
 from scipy.stats import norm
 
 import collections
+import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+import instrumentation
+
 
 def load_data_from_csv(expdataFile, fixationsFile):
     # Load experimental data from CSV file.
@@ -66,10 +69,21 @@ def load_data_from_csv(expdataFile, fixationsFile):
     return data(rt, choice, distLeft, distRight, fixItem, fixTime)
 
 
+def get_dataset_hash(expdataFile="expdata.csv", fixationsFile="fixations.csv"):
+    # SHA-1 of the contents of both data files.
+    sha = hashlib.sha1()
+    for fileName in [expdataFile, fixationsFile]:
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
 def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
-    theta, std=0, mu=0, timeStep=10, barrier=1, visualDelay=0, motorDelay=0,
-    plotResults=False):
-    stateStep = 0.1
+    theta, std=0, mu=0, timeStep=10, stateStep=0.1, barrier=1, visualDelay=0,
+    motorDelay=0, plotResults=False):
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
     if std == 0:
         if mu != 0:
             std = mu * d
@@ -104,7 +118,8 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
         barrierUp[t] = float(barrier) / float(1+decay*(t+1))
         barrierDown[t] = float(-barrier) / float(1+decay*(t+1))
 
-    # The vertical axis (RDV space) is divided into states.
+    # The vertical axis (RDV space) is divided into states. The state step
+    # must divide the barrier, so that the zero state is part of the grid.
     states = np.arange(-barrier, barrier + stateStep, stateStep)
     idx = np.where(np.logical_and(states<0.01, states>-0.01))[0]
     states[idx] = 0
@@ -124,6 +139,13 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
         traces = np.zeros((states.size, maxTime))
         traces[:, 0] = prStates
 
+    if instrumentation.enabled:
+        instrumentation.count('trials_evaluated')
+        instrumentation.count('timesteps_propagated', maxTime)
+        instrumentation.count('states_touched', maxTime * states.size)
+        instrumentation.stop_timer('setup', startTime)
+        propagationStart = instrumentation.start_timer()
+
     time = 0
 
     # Iterate over all fixations in this trial.
@@ -171,11 +193,16 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
                 (norm.cdf(changeDown, mean, std))))
 
             # Renormalize to cope with numerical approximations.
+            if instrumentation.enabled:
+                renormalizationStart = instrumentation.start_timer()
             sumIn = np.sum(prStates)
             sumCurrent = np.sum(prStatesNew) + tempUpCross + tempDownCross
             prStatesNew = (prStatesNew * float(sumIn)) / float(sumCurrent)
             tempUpCross = (tempUpCross * float(sumIn)) / float(sumCurrent)
             tempDownCross = (tempDownCross * float(sumIn)) / float(sumCurrent)
+            if instrumentation.enabled:
+                instrumentation.stop_timer('renormalization',
+                    renormalizationStart)
 
             # Update the probabilities of each state and the probabilities of
             # crossing each barrier at this timestep.
@@ -189,6 +216,10 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
 
             time += 1
 
+    # Propagation time includes renormalization.
+    if instrumentation.enabled:
+        instrumentation.stop_timer('propagation', propagationStart)
+
     # Compute the likelihood contribution of this trial based on the final
     # choice.
     likelihood = 0
@@ -199,6 +230,11 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
         if probDownCrossing[-1] > 0:
             likelihood = probDownCrossing[-1]
 
+    if instrumentation.enabled:
+        if likelihood == 0:
+            instrumentation.count('zero_likelihood_trials')
+        instrumentation.stop_timer('likelihood', startTime)
+
     if plotResults:
         fig1 = plt.figure()
         xAxis = np.arange(0, maxTime * timeStep, timeStep)
@@ -223,109 +259,330 @@ def analysis_per_trial(rt, choice, valueLeft, valueRight, fixItem, fixTime, d,
     return likelihood
 
 
-def get_empirical_distributions(rt, choice, distLeft, distRight, fixItem,
-    fixTime, useOddTrials=True, useEvenTrials=True, useCisTrials=True,
-    useTransTrials=True):
-    valueDiffs = range(0,4,1)
+# Transition kernels already computed, per (mean, std, stateStep, barrier).
+transitionKernels = dict()
+maxTransitionKernels = 10000
 
-    countLeftFirst = 0
-    countTotalTrials = 0
-    distTransitionList = list()
-    distFirstFixList = dict()
-    distSecondFixList = dict()
-    distThirdFixList = dict()
-    distOtherFixList = dict()
-    for valueDiff in valueDiffs:
-        distFirstFixList[valueDiff] = list()
-        distSecondFixList[valueDiff] = list()
-        distThirdFixList[valueDiff] = list()
-        distOtherFixList[valueDiff] = list()
-
-    # Get item values.
-    valueLeft = dict()
-    valueRight = dict()
-    subjects = distLeft.keys()
-    for subject in subjects:
-        valueLeft[subject] = dict()
-        valueRight[subject] = dict()
-        trials = distLeft[subject].keys()
-        for trial in trials:
-            valueLeft[subject][trial] = np.absolute((np.absolute(
-                distLeft[subject][trial])-15)/5)
-            valueRight[subject][trial] = np.absolute((np.absolute(
-                distRight[subject][trial])-15)/5)
 
+def get_transition_kernel(mean, std, stateStep=0.1, barrier=1):
+    # The kernel holds, in matrix form, the quantities computed at every time
+    # step of analysis_per_trial for constant barriers, together with their
+    # derivatives with respect to the mean and the std of the RDV change.
+    key = (mean, std, stateStep, barrier)
+    if key in transitionKernels:
+        if instrumentation.enabled:
+            instrumentation.count('kernel_cache_hits')
+        return transitionKernels[key]
+    if instrumentation.enabled:
+        instrumentation.count('kernel_cache_misses')
+        startTime = instrumentation.start_timer()
+    if len(transitionKernels) >= maxTransitionKernels:
+        transitionKernels.clear()
+
+    # The vertical axis (RDV space) is divided into states.
+    states = np.arange(-barrier, barrier + stateStep, stateStep)
+    idx = np.where(np.logical_and(states<0.01, states>-0.01))[0]
+    states[idx] = 0
+
+    # transition[B, A] is the probability of moving from state A to state B,
+    # which is zero for states B outside the barriers.
+    change = states[:, np.newaxis] - states[np.newaxis, :]
+    inside = np.logical_and(states > -barrier, states < barrier)
+    pdf = norm.pdf(change, mean, std)
+    transition = stateStep * pdf * inside[:, np.newaxis]
+    z = (change - mean) / std
+    dTransitionMean = transition * z / std
+    dTransitionStd = transition * (z ** 2 - 1) / std
+
+    # Probabilities of crossing each barrier from each state.
+    changeUp = barrier - states
+    upCross = 1 - norm.cdf(changeUp, mean, std)
+    pdfUp = norm.pdf(changeUp, mean, std)
+    dUpCrossMean = pdfUp
+    dUpCrossStd = pdfUp * (changeUp - mean) / std
+    changeDown = -barrier - states
+    downCross = norm.cdf(changeDown, mean, std)
+    pdfDown = norm.pdf(changeDown, mean, std)
+    dDownCrossMean = -pdfDown
+    dDownCrossStd = -pdfDown * (changeDown - mean) / std
+
+    kernel = collections.namedtuple('Kernel', ['states', 'transition',
+        'upCross', 'downCross', 'dTransitionMean', 'dTransitionStd',
+        'dUpCrossMean', 'dUpCrossStd', 'dDownCrossMean', 'dDownCrossStd'])
+    transitionKernels[key] = kernel(states, transition, upCross, downCross,
+        dTransitionMean, dTransitionStd, dUpCrossMean, dUpCrossStd,
+        dDownCrossMean, dDownCrossStd)
+    if instrumentation.enabled:
+        instrumentation.stop_timer('kernel_construction', startTime)
+    return transitionKernels[key]
+
+
+def get_fixation_steps(fixItem, fixTime, timeStep=10, visualDelay=0,
+    motorDelay=0):
+    # Discount the visual delay from every item fixation and the motor delay
+    # from the last one, then convert fixation durations to time steps.
+    fixTime = np.array(fixTime, dtype=float)
+    isItem = np.logical_or(fixItem == 1, fixItem == 2)
+    fixTime[isItem] = np.maximum(fixTime[isItem] - visualDelay, 0)
+    itemIdx = np.where(isItem)[0]
+    if itemIdx.size > 0:
+        last = itemIdx[-1]
+        fixTime[last] = max(fixTime[last] - motorDelay, 0)
+    return (fixTime // timeStep).astype(int)
+
+
+def analysis_per_trial_gradient(rt, choice, valueLeft, valueRight, fixItem,
+    fixTime, d, theta, std, timeStep=10, stateStep=0.1, barrier=1,
+    visualDelay=0, motorDelay=0):
+    # Same likelihood as analysis_per_trial (with constant barriers), returned
+    # together with the gradient of its log with respect to (d, theta, std).
+    # The gradient is obtained by propagating the derivatives of the state
+    # probabilities (tangent vectors) through the same transition steps.
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
+    fixItem = np.array(fixItem)
+    fixSteps = get_fixation_steps(fixItem, fixTime, timeStep, visualDelay,
+        motorDelay)
+    gradient = np.zeros(3)
+    if np.sum(fixSteps) == 0:
+        return 0, gradient
+
+    states = get_transition_kernel(0, std, stateStep, barrier).states
+    prStates = np.zeros(states.size)
+    prStates[np.where(states==0)[0]] = 1
+    dPrStates = np.zeros((states.size, 3))
+    gradStd = np.array([0., 0., 1.])
+
+    for fItem, fSteps in zip(fixItem, fixSteps):
+        # Mean of the RDV change and its gradient with respect to (d, theta,
+        # std).
+        if fItem == 1:  # Subject is looking left.
+            mean = d * (valueLeft - (theta * valueRight))
+            gradMean = np.array([valueLeft - (theta * valueRight),
+                -d * valueRight, 0.])
+        elif fItem == 2:  # Subject is looking right.
+            mean = d * (-valueRight + (theta * valueLeft))
+            gradMean = np.array([-valueRight + (theta * valueLeft),
+                d * valueLeft, 0.])
+        else:
+            mean = 0
+            gradMean = np.zeros(3)
+        kernel = get_transition_kernel(mean, std, stateStep, barrier)
+
+        for t in xrange(fSteps):
+            prStatesNew = np.dot(kernel.transition, prStates)
+            dPrStatesNew = (np.dot(kernel.transition, dPrStates) +
+                np.outer(np.dot(kernel.dTransitionMean, prStates), gradMean) +
+                np.outer(np.dot(kernel.dTransitionStd, prStates), gradStd))
+            tempUpCross = np.dot(kernel.upCross, prStates)
+            dTempUpCross = (np.dot(kernel.upCross, dPrStates) +
+                np.dot(kernel.dUpCrossMean, prStates) * gradMean +
+                np.dot(kernel.dUpCrossStd, prStates) * gradStd)
+            tempDownCross = np.dot(kernel.downCross, prStates)
+            dTempDownCross = (np.dot(kernel.downCross, dPrStates) +
+                np.dot(kernel.dDownCrossMean, prStates) * gradMean +
+                np.dot(kernel.dDownCrossStd, prStates) * gradStd)
+
+            # Renormalize to cope with numerical approximations.
+            sumIn = np.sum(prStates)
+            dSumIn = np.sum(dPrStates, axis=0)
+            sumCurrent = np.sum(prStatesNew) + tempUpCross + tempDownCross
+            dSumCurrent = (np.sum(dPrStatesNew, axis=0) + dTempUpCross +
+                dTempDownCross)
+            scale = sumIn / sumCurrent
+            dScale = (dSumIn - scale * dSumCurrent) / sumCurrent
+
+            prStates = prStatesNew * scale
+            dPrStates = dPrStatesNew * scale + np.outer(prStatesNew, dScale)
+            upCross = tempUpCross * scale
+            dUpCross = dTempUpCross * scale + tempUpCross * dScale
+            downCross = tempDownCross * scale
+            dDownCross = dTempDownCross * scale + tempDownCross * dScale
+
+    # Compute the likelihood contribution of this trial based on the final
+    # choice.
+    likelihood = 0
+    if choice == -1 and upCross > 0:  # Choice was left.
+        likelihood = upCross
+        gradient = dUpCross / upCross
+    elif choice == 1 and downCross > 0:  # Choice was right.
+        likelihood = downCross
+        gradient = dDownCross / downCross
+
+    if instrumentation.enabled:
+        instrumentation.count('trials_evaluated')
+        instrumentation.count('timesteps_propagated', int(np.sum(fixSteps)))
+        instrumentation.count('states_touched',
+            int(np.sum(fixSteps)) * states.size)
+        if likelihood == 0:
+            instrumentation.count('zero_likelihood_trials')
+        instrumentation.stop_timer('likelihood', startTime)
+    return likelihood, gradient
+
+
+def analysis_per_trial_models(rt, choice, valueLeft, valueRight, fixItem,
+    fixTime, models, timeStep=10, stateStep=0.1, barrier=1, visualDelay=0,
+    motorDelay=0):
+    # Likelihood of one trial under each model (d, theta, std) in a list, with
+    # constant barriers. The state probabilities of all models are propagated
+    # together, one matrix per model stacked along the first axis.
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
+    fixItem = np.array(fixItem)
+    fixSteps = get_fixation_steps(fixItem, fixTime, timeStep, visualDelay,
+        motorDelay)
+    numModels = len(models)
+    likelihoods = np.zeros(numModels)
+    if np.sum(fixSteps) == 0:
+        return likelihoods
+
+    states = get_transition_kernel(0, models[0][2], stateStep, barrier).states
+    prStates = np.zeros((numModels, states.size))
+    prStates[:, np.where(states==0)[0]] = 1
+    upCross = np.zeros(numModels)
+    downCross = np.zeros(numModels)
+
+    for fItem, fSteps in zip(fixItem, fixSteps):
+        if fSteps == 0:
+            continue
+        kernels = list()
+        for d, theta, std in models:
+            if fItem == 1:  # Subject is looking left.
+                mean = d * (valueLeft - (theta * valueRight))
+            elif fItem == 2:  # Subject is looking right.
+                mean = d * (-valueRight + (theta * valueLeft))
+            else:
+                mean = 0
+            kernels.append(get_transition_kernel(mean, std, stateStep,
+                barrier))
+        transition = np.array([kernel.transition for kernel in kernels])
+        upCrossFrom = np.array([kernel.upCross for kernel in kernels])
+        downCrossFrom = np.array([kernel.downCross for kernel in kernels])
+
+        for t in xrange(fSteps):
+            prStatesNew = np.einsum('mij,mj->mi', transition, prStates)
+            tempUpCross = np.sum(upCrossFrom * prStates, axis=1)
+            tempDownCross = np.sum(downCrossFrom * prStates, axis=1)
+
+            # Renormalize to cope with numerical approximations.
+            sumIn = np.sum(prStates, axis=1)
+            sumCurrent = (np.sum(prStatesNew, axis=1) + tempUpCross +
+                tempDownCross)
+            scale = sumIn / sumCurrent
+            prStates = prStatesNew * scale[:, np.newaxis]
+            upCross = tempUpCross * scale
+            downCross = tempDownCross * scale
+
+    # Compute the likelihood contribution of this trial based on the final
+    # choice.
+    if choice == -1:  # Choice was left.
+        likelihoods = np.maximum(upCross, 0)
+    elif choice == 1:  # Choice was right.
+        likelihoods = np.maximum(downCross, 0)
+
+    if instrumentation.enabled:
+        instrumentation.count('trials_evaluated')
+        instrumentation.count('models_evaluated', numModels)
+        instrumentation.count('timesteps_propagated',
+            numModels * int(np.sum(fixSteps)))
+        instrumentation.count('states_touched',
+            numModels * int(np.sum(fixSteps)) * states.size)
+        instrumentation.count('zero_likelihood_trials',
+            int(np.sum(likelihoods == 0)))
+        instrumentation.stop_timer('likelihood', startTime)
+    return likelihoods
+
+
+def get_fixation_table(rt, distLeft, distRight, fixItem, fixTime):
+    # Flatten the fixations of all trials into a table, in the order in which
+    # the subjects and trials are stored. Per trial: trial number, distances,
+    # and the position of its first fixation in the table. Per fixation: its
+    # trial (an index into the per trial arrays), item and duration.
+    trialNumbers = list()
+    trialDistLeft = list()
+    trialDistRight = list()
+    items = list()
+    times = list()
     subjects = rt.keys()
     for subject in subjects:
         trials = rt[subject].keys()
         for trial in trials:
-            if not useOddTrials and trial % 2 != 0:
-                continue
-            if not useEvenTrials and trial % 2 == 0:
-                continue
-            if (not useCisTrials and (distLeft[subject][trial] *
-                distRight[subject][trial] > 0)):
-                continue
-            if (not useTransTrials and (distLeft[subject][trial] *
-                distRight[subject][trial] < 0)):
-                continue
-            if fixItem[subject][trial].shape[0] < 2:
-                continue
-            # Discard trial if it has 1 or less item fixations.
-            items = fixItem[subject][trial]
-            if items[(items==1) | (items==2)].shape[0] <= 1:
-                continue
-            # Get value difference between best and worst items for this trial.
-            valueDiff = np.absolute(valueLeft[subject][trial] -
-                valueRight[subject][trial])
-            # Find the last item fixation in this trial.
-            excludeCount = 0
-            for i in xrange(fixItem[subject][trial].shape[0] - 1, -1, -1):
-                excludeCount += 1
-                if (fixItem[subject][trial][i] == 1 or
-                    fixItem[subject][trial][i] == 2):
-                    break
-            # Iterate over this trial's fixations (skip the last item fixation).
-            fixNumber = 1
-            for i in xrange(fixItem[subject][trial].shape[0] - excludeCount):
-                item = fixItem[subject][trial][i]
-                if item != 1 and item != 2:
-                    distTransitionList.append(fixTime[subject][trial][i])
-                else:
-                    if fixNumber == 1:
-                        fixNumber += 1
-                        if fixTime[subject][trial][i] > 0:
-                            distFirstFixList[valueDiff].append(
-                                fixTime[subject][trial][i])
-                        countTotalTrials +=1
-                        if item == 1:  # First fixation was left.
-                            countLeftFirst += 1
-                    elif fixNumber == 2:
-                        fixNumber += 1
-                        if fixTime[subject][trial][i] > 0:
-                            distSecondFixList[valueDiff].append(
-                                fixTime[subject][trial][i])
-                    elif fixNumber == 3:
-                        fixNumber += 1
-                        if fixTime[subject][trial][i] > 0:
-                            distThirdFixList[valueDiff].append(
-                                fixTime[subject][trial][i])
-                    else:
-                        if fixTime[subject][trial][i] > 0:
-                            distOtherFixList[valueDiff].append(
-                                fixTime[subject][trial][i])
-
-    probLeftFixFirst = float(countLeftFirst) / float(countTotalTrials)
-    distTransition = np.array(distTransitionList)
+            trialNumbers.append(trial)
+            trialDistLeft.append(distLeft[subject][trial])
+            trialDistRight.append(distRight[subject][trial])
+            items.append(np.asarray(fixItem[subject][trial]))
+            times.append(np.asarray(fixTime[subject][trial]))
+
+    numFixations = np.array([item.shape[0] for item in items], dtype=int)
+    starts = np.concatenate([[0], np.cumsum(numFixations)[:-1]]).astype(int)
+    table = collections.namedtuple('FixationTable', ['trial', 'distLeft',
+        'distRight', 'numFixations', 'starts', 'fixTrial', 'fixItem',
+        'fixTime'])
+    return table(np.array(trialNumbers), np.array(trialDistLeft),
+        np.array(trialDistRight), numFixations, starts,
+        np.repeat(np.arange(len(items)), numFixations),
+        np.concatenate(items) if items else np.array([]),
+        np.concatenate(times) if times else np.array([]))
+
+
+def get_empirical_distributions(rt, choice, distLeft, distRight, fixItem,
+    fixTime, useOddTrials=True, useEvenTrials=True, useCisTrials=True,
+    useTransTrials=True, fixationTable=None):
+    # Computed over a flat fixation table, which can be passed in to reuse it
+    # across several splits of the same data.
+    valueDiffs = range(0,4,1)
+    if fixationTable is None:
+        fixationTable = get_fixation_table(rt, distLeft, distRight, fixItem,
+            fixTime)
+    table = fixationTable
+
+    # Select trials.
+    valueLeft = np.absolute((np.absolute(table.distLeft)-15)/5)
+    valueRight = np.absolute((np.absolute(table.distRight)-15)/5)
+    trialValueDiff = np.absolute(valueLeft - valueRight)
+    useTrial = table.numFixations >= 2
+    if not useOddTrials:
+        useTrial &= table.trial % 2 == 0
+    if not useEvenTrials:
+        useTrial &= table.trial % 2 != 0
+    if not useCisTrials:
+        useTrial &= ~(table.distLeft * table.distRight > 0)
+    if not useTransTrials:
+        useTrial &= ~(table.distLeft * table.distRight < 0)
+
+    # Ordinal of each item fixation within its trial, from cumulative counts.
+    isItem = (table.fixItem == 1) | (table.fixItem == 2)
+    numTrials = table.trial.size
+    cumItems = np.cumsum(isItem)
+    itemsBefore = np.concatenate([[0], cumItems])[table.starts]
+    ordinal = cumItems - itemsBefore[table.fixTrial]
+    numItems = np.zeros(numTrials, dtype=int)
+    np.add.at(numItems, table.fixTrial, isItem)
+    # Discard trial if it has 1 or less item fixations.
+    useTrial &= numItems > 1
+
+    # Skip the last item fixation of each trial, and everything after it.
+    position = np.arange(table.fixTrial.size) - table.starts[table.fixTrial]
+    lastItem = -np.ones(numTrials, dtype=int)
+    np.maximum.at(lastItem, table.fixTrial[isItem], position[isItem])
+    use = useTrial[table.fixTrial] & (position < lastItem[table.fixTrial])
+    valueDiff = trialValueDiff[table.fixTrial]
+    positive = table.fixTime > 0
+
+    distTransition = table.fixTime[use & ~isItem]
+    first = use & isItem & (ordinal == 1)
+    probLeftFixFirst = (float(np.sum(table.fixItem[first] == 1)) /
+        float(np.sum(first)))
     distFirstFix = dict()
     distSecondFix = dict()
     distThirdFix = dict()
     distOtherFix = dict()
-    for valueDiff in valueDiffs:
-        distFirstFix[valueDiff] = np.array(distFirstFixList[valueDiff])
-        distSecondFix[valueDiff] = np.array(distSecondFixList[valueDiff])
-        distThirdFix[valueDiff] = np.array(distThirdFixList[valueDiff])
-        distOtherFix[valueDiff] = np.array(distOtherFixList[valueDiff])
+    for vd in valueDiffs:
+        sel = use & isItem & positive & (valueDiff == vd)
+        distFirstFix[vd] = table.fixTime[sel & (ordinal == 1)]
+        distSecondFix[vd] = table.fixTime[sel & (ordinal == 2)]
+        distThirdFix[vd] = table.fixTime[sel & (ordinal == 3)]
+        distOtherFix[vd] = table.fixTime[sel & (ordinal >= 4)]
 
     dists = collections.namedtuple('Dists', ['probLeftFixFirst',
         'distTransition', 'distFirstFix', 'distSecondFix', 'distThirdFix',
@@ -491,3 +748,170 @@ def run_simulations(probLeftFixFirst, distTransition, distFirstFix,
     simul = collections.namedtuple('Simul', ['rt', 'choice', 'distLeft',
         'distRight', 'fixItem', 'fixTime', 'fixRDV'])
     return simul(rt, choice, distLeft, distRight, fixItem, fixTime, fixRDV)
+
+
+def sample_fixation_times(dists, valueDiffs, randomState):
+    # Sample one fixation duration per trial from the distribution for its
+    # value difference.
+    times = np.zeros(valueDiffs.size)
+    for valueDiff in np.unique(valueDiffs):
+        idx = np.where(valueDiffs == valueDiff)[0]
+        times[idx] = randomState.choice(dists[valueDiff], size=idx.size)
+    return times
+
+
+def run_random_walks(RDV, mean, std, numSteps, barrier, randomState):
+    # Advance the RDV of each trial by up to numSteps[i] steps. As in
+    # run_simulations, the barriers are checked before each step, and a walk
+    # stops at the first step where its RDV is at or beyond a barrier. Returns
+    # the new RDVs and, for each walk, that step, or -1 if none.
+    RDV = RDV.copy()
+    hitStep = -np.ones(RDV.size, dtype=int)
+    maxSteps = np.max(numSteps) if numSteps.size > 0 else 0
+    for t in xrange(maxSteps):
+        running = np.logical_and(hitStep < 0, t < numSteps)
+        if not np.any(running):
+            break
+        hit = np.logical_and(running, np.absolute(RDV) >= barrier)
+        hitStep[hit] = t
+        running[hit] = False
+        RDV[running] += randomState.normal(mean[running], std[running])
+    return RDV, hitStep
+
+
+def simulate_trials(probLeftFixFirst, distTransition, distFirstFix,
+    distSecondFix, distThirdFix, distOtherFix, valueLeft, valueRight, d, theta,
+    std, timeStep=10, barrier=1, visualDelay=0, motorDelay=0, seed=None):
+    # Same process as run_simulations, with one entry per trial in the arrays
+    # of item values and parameters. All trials are simulated together, one
+    # fixation at a time, and the random walks within each fixation are
+    # vectorized across trials. Trials aborted during a transition are
+    # simulated again until every trial ends on an item fixation. The
+    # fixations are returned as flat arrays, with the index of their trial in
+    # fixTrial.
+    randomState = np.random.RandomState(seed)
+    valueLeft = np.array(valueLeft, dtype=float)
+    valueRight = np.array(valueRight, dtype=float)
+    d = np.array(d, dtype=float)
+    theta = np.array(theta, dtype=float)
+    std = np.array(std, dtype=float)
+    numTrials = valueLeft.size
+
+    rt = np.zeros(numTrials, dtype=int)
+    choice = np.zeros(numTrials, dtype=int)
+    # Empty arrays to start with, so that no trials give no fixations.
+    fixTrial = [np.array([], dtype=int)]
+    fixItem = [np.array([], dtype=int)]
+    fixTime = [np.array([], dtype=int)]
+    fixRDV = [np.array([], dtype=float)]
+    delaySteps = int(visualDelay // timeStep)
+
+    pending = np.arange(numTrials)
+    while pending.size > 0:
+        # Fixations of the trials in this pass, kept only if they finish.
+        passFixations = list()
+        aborted = list()
+
+        live = pending
+        RDV = np.zeros(live.size)
+        trialTime = np.zeros(live.size)
+        valueDiffs = np.absolute(valueLeft[live] - valueRight[live]).astype(int)
+        currFixItem = np.where(randomState.uniform(size=live.size) <
+            probLeftFixFirst, 1, 2)
+        currFixTime = (sample_fixation_times(distFirstFix, valueDiffs,
+            randomState) - visualDelay)
+        fixNumber = 2
+        while live.size > 0:
+            currRDV = RDV
+
+            # Iterate over the visual delay for the current fixation, then
+            # over the time interval of the fixation itself.
+            mean = np.zeros(live.size)
+            numSteps = delaySteps * np.ones(live.size, dtype=int)
+            RDV, hitStep = run_random_walks(RDV, mean, std[live], numSteps,
+                barrier, randomState)
+            delayHit = hitStep >= 0
+            elapsed = np.where(delayHit, hitStep * timeStep + motorDelay, 0)
+
+            mean = np.where(currFixItem == 1,
+                d[live] * (valueLeft[live] - (theta[live] * valueRight[live])),
+                d[live] * (-valueRight[live] + (theta[live] * valueLeft[live])))
+            numSteps = np.maximum(currFixTime // timeStep, 0).astype(int)
+            numSteps[delayHit] = 0
+            RDV, hitStep = run_random_walks(RDV, mean, std[live], numSteps,
+                barrier, randomState)
+            fixHit = hitStep >= 0
+            elapsed = np.where(fixHit,
+                hitStep * timeStep + visualDelay + motorDelay, elapsed)
+            elapsed = np.where(np.logical_or(delayHit, fixHit), elapsed,
+                numSteps * timeStep + visualDelay)
+
+            # Add this fixation to the data of each trial.
+            passFixations.append((live, currFixItem, elapsed, currRDV))
+            trialTime += elapsed
+
+            # If the RDV hit one of the barriers, the trial is over.
+            finished = np.logical_or(delayHit, fixHit)
+            rt[live[finished]] = trialTime[finished]
+            choice[live[finished]] = np.where(RDV[finished] >= barrier, -1, 1)
+            keep = ~finished
+            live = live[keep]
+            RDV = RDV[keep]
+            trialTime = trialTime[keep]
+            currFixItem = currFixItem[keep]
+            valueDiffs = valueDiffs[keep]
+            if live.size == 0:
+                break
+
+            # Sample and iterate over transition time. If the RDV hits one of
+            # the barriers, the trial is aborted, since a trial must end on an
+            # item fixation.
+            currRDV = RDV
+            transitionTime = randomState.choice(distTransition,
+                size=live.size)
+            numSteps = (transitionTime // timeStep).astype(int)
+            RDV, hitStep = run_random_walks(RDV, np.zeros(live.size),
+                std[live], numSteps, barrier, randomState)
+            transitionHit = hitStep >= 0
+            aborted.append(live[transitionHit])
+            keep = ~transitionHit
+            passFixations.append((live[keep], np.zeros(np.sum(keep),
+                dtype=int), numSteps[keep] * timeStep, currRDV[keep]))
+            live = live[keep]
+            RDV = RDV[keep]
+            trialTime = trialTime[keep] + numSteps[keep] * timeStep
+            valueDiffs = valueDiffs[keep]
+
+            # Sample the next fixation for each trial. As in run_simulations,
+            # the second fixation is drawn from distThirdFix and the later
+            # ones from distOtherFix, so that both give the same simulations.
+            currFixItem = 3 - currFixItem[keep]
+            if fixNumber == 2:
+                dists = distThirdFix
+            else:
+                dists = distOtherFix
+            fixNumber += 1
+            currFixTime = (sample_fixation_times(dists, valueDiffs,
+                randomState) - visualDelay)
+
+        # Keep the fixations of the trials which finished, and simulate the
+        # aborted ones again.
+        if aborted:
+            pending = np.concatenate(aborted)
+        else:
+            pending = np.array([], dtype=int)
+        for trials, items, times, RDVs in passFixations:
+            keep = ~np.isin(trials, pending)
+            fixTrial.append(trials[keep])
+            fixItem.append(items[keep])
+            fixTime.append(times[keep])
+            fixRDV.append(RDVs[keep])
+
+    # Sort the fixations by trial, keeping each trial's fixations in order.
+    fixTrial = np.concatenate(fixTrial)
+    order = np.argsort(fixTrial, kind='mergesort')
+    simul = collections.namedtuple('VectorSimul', ['rt', 'choice',
+        'valueLeft', 'valueRight', 'fixTrial', 'fixItem', 'fixTime', 'fixRDV'])
+    return simul(rt, choice, valueLeft, valueRight, fixTrial[order],
+        np.concatenate(fixItem)[order], np.concatenate(fixTime)[order],
+        np.concatenate(fixRDV)[order])
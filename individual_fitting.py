@@ -7,28 +7,40 @@ import matplotlib
 matplotlib.use('Agg')
 
 from matplotlib.backends.backend_pdf import PdfPages
-from multiprocessing import Pool
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy as np
 import operator
 import pandas as pd
+import sys
 
+import tracing
+
+from adaptive_grid import adaptive_grid_search
+from executors import create_executor
 from handle_fixations import (load_data_from_csv, analysis_per_trial,
     get_empirical_distributions, run_simulations)
 from group_fitting import (generate_choice_curves, generate_rt_curves,
     save_simulations_to_csv)
+from pruning import (PRUNED, create_incumbent, exceeds_bound, init_incumbent,
+    update_incumbent)
+from trial_sampling import get_trial_subset
 
 
 def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
-    std, useOddTrials=True, useEvenTrials=True, verbose=True):
-    trialsPerSubject = 200
+    std, useOddTrials=True, useEvenTrials=True, verbose=True, pruneMargin=None,
+    trialsPerSubject=200, seed=None):
     logLikelihood = 0
     subjects = rt.keys()
     for subject in subjects:
         trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
+        if seed is None:
+            trialSet = np.random.choice(trials, trialsPerSubject,
+                replace=False)
+        else:
+            # With a fixed seed every model is scored on the same trials.
+            trialSet = get_trial_subset(trials, trialsPerSubject, seed)
         for trial in trialSet:
             if not useOddTrials and trial % 2 != 0:
                 continue
@@ -40,7 +52,16 @@ def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
                 fixTime[subject][trial], d, theta, std=std)
             if likelihood != 0:
                 logLikelihood += np.log(likelihood)
-
+            # Abandon this model once its partial NLL passes the incumbent.
+            if (pruneMargin is not None and
+                exceeds_bound(-logLikelihood, pruneMargin)):
+                if verbose:
+                    print("NLL for " + str(d) + ", " + str(theta) + ", "
+                        + str(std) + ": pruned")
+                return PRUNED
+
+    if pruneMargin is not None:
+        update_incumbent(-logLikelihood)
     if verbose:
         print("NLL for " + str(d) + ", " + str(theta) + ", "
             + str(std) + ": " + str(-logLikelihood))
@@ -51,9 +72,11 @@ def run_analysis_wrapper(params):
     return run_analysis(*params)
 
 
-def main():
-    numThreads = 9
-    pool = Pool(numThreads)
+def main(trace=False):
+    if trace:
+        tracing.enable()
+    incumbent = create_incumbent()
+    pool = create_executor(initializer=init_incumbent, initargs=(incumbent,))
 
     subject = "pai"
     rt = dict()
@@ -91,28 +114,29 @@ def main():
     rangeTheta = [0.1, 0.2, 0.3]
     rangeStd = [0.08, 0.09, 0.1]
 
-    models = list()
-    listParams = list()
-    for d in rangeD:
-        for theta in rangeTheta:
-            for std in rangeStd:
-                models.append((d, theta, std))
-                params = (rt, choice, valueLeft, valueRight, fixItem, fixTime,
-                    d, theta, std, True, False)
-                listParams.append(params)
-
-    results = pool.map(run_analysis_wrapper, listParams)
+    # The grid is refined adaptively around the best models, starting from
+    # the coarse ranges above. Models which are clearly dominated by the
+    # incumbent are abandoned before all their trials are evaluated.
+    dominanceMargin = 10.
+    dataParams = (rt, choice, valueLeft, valueRight, fixItem, fixTime)
+    # All models are scored on the same trials, so that their NLLs are
+    # comparable and pruning decisions are not affected by sampling noise.
+    seed = 0
+    search = adaptive_grid_search(pool, run_analysis_wrapper, dataParams,
+        rangeD, rangeTheta, rangeStd,
+        extraParams=(True, False, True, dominanceMargin, 200, seed),
+        bounds=[(0.0001, 0.01), (0., 1.), (0.01, 0.15)],
+        dominanceMargin=dominanceMargin)
 
     # Get optimal parameters.
-    minNegLogLikeIdx = results.index(min(results))
-    optimD = models[minNegLogLikeIdx][0]
-    optimTheta = models[minNegLogLikeIdx][1]
-    optimStd = models[minNegLogLikeIdx][2]
-    print("Finished coarse grid search!")
+    optimD = search.model[0]
+    optimTheta = search.model[1]
+    optimStd = search.model[2]
+    print("Finished adaptive grid search!")
     print("Optimal d: " + str(optimD))
     print("Optimal theta: " + str(optimTheta))
     print("Optimal std: " + str(optimStd))
-    print("Min NLL: " + str(min(results)))
+    print("Min NLL: " + str(search.NLL))
 
     # Get empirical distributions from even trials.
     evenDists = get_empirical_distributions(rt, choice, distLeft, distRight,
@@ -175,4 +199,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main("--trace" in sys.argv[1:])
\ No newline at end of file
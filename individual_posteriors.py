@@ -3,22 +3,25 @@
 # individual_posteriors.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from multiprocessing import Pool
-
 import numpy as np
+import sys
 
-from handle_fixations import (load_data_from_csv, analysis_per_trial,
-    get_empirical_distributions)
-from posteriors import generate_probabilistic_simulations
-
+import tracing
 
-def run_analysis_wrapper(params):
-    return analysis_per_trial(*params)
+from adaptive_grid import (adaptive_grid_search, get_centered_ranges,
+    get_grid_spacing)
+from executors import create_executor
+from group_fitting import run_analysis_wrapper as fitting_wrapper
+from group_posteriors import generate_probabilistic_simulations
+from handle_fixations import load_data_from_csv, get_empirical_distributions
+from posterior_engine import (compute_posteriors, get_likelihood_matrix,
+    get_trial_list)
 
 
-def main():
-    numThreads = 9
-    pool = Pool(numThreads)
+def main(trace=False, center=None):
+    if trace:
+        tracing.enable()
+    pool = create_executor()
 
     subject = "gel"
     rt = dict()
@@ -53,6 +56,20 @@ def main():
     rangeD = [0.004, 0.0045, 0.005]
     rangeTheta = [0.3, 0.35, 0.4]
     rangeStd = [0.08, 0.085, 0.09]
+
+    # Center the model grid on the given model, e.g. the optimum found by
+    # group_fitting, keeping the spacing of the ranges above. Without one,
+    # the best model of an adaptive grid search is used. Its models are all
+    # scored on the same trials, so the center does not change between runs.
+    if center is None:
+        dataParams = (rt, choice, valueLeft, valueRight, fixItem, fixTime)
+        search = adaptive_grid_search(pool, fitting_wrapper, dataParams,
+            rangeD, rangeTheta, rangeStd,
+            extraParams=(True, True, False, None, 200, 0), verbose=False)
+        center = search.model
+    print("Centering the model grid on " + str(tuple(center)) + ".")
+    spacings = [get_grid_spacing(r) for r in [rangeD, rangeTheta, rangeStd]]
+    rangeD, rangeTheta, rangeStd = get_centered_ranges(center, spacings)
     numModels = len(rangeD) * len(rangeTheta) * len(rangeStd)
 
     models = list()
@@ -64,38 +81,28 @@ def main():
                 models.append(model)
                 posteriors[model] = 1./ numModels
 
+    trialSets = list()
     subjects = rt.keys()
     for subject in subjects:
-        trials = rt[subject].keys()
-        for trial in trials:
-            listParams = list()
-            for model in models:
-                listParams.append((rt[subject][trial], choice[subject][trial],
-                    valueLeft[subject][trial], valueRight[subject][trial],
-                    fixItem[subject][trial], fixTime[subject][trial], model[0],
-                    model[1], model[2]))
-            likelihoods = pool.map(run_analysis_wrapper, listParams)
-
-            # Get the denominator for normalizing the posteriors.
-            i = 0
-            denominator = 0
-            for model in models:
-                denominator += posteriors[model] * likelihoods[i]
-                i += 1
-            if denominator == 0:
-                continue
-
-            # Calculate the posteriors after this trial.
-            i = 0
-            for model in models:
-                if likelihoods[i] != 0:
-                    prior = posteriors[model]
-                    posteriors[model] = likelihoods[i] * prior / denominator
-                i += 1
-
-        for model in posteriors:
-            print("P" + str(model) + " = " + str(posteriors[model]))
-        print("Sum: " + str(sum(posteriors.values())))
+        trialSets.append((subject, rt[subject].keys()))
+
+    # The likelihoods of all trials under all models are computed in one
+    # batch, and the posteriors are then updated trial by trial in log space.
+    trials = get_trial_list(rt, choice, valueLeft, valueRight, fixItem, fixTime,
+        trialSets)
+    likelihoods = get_likelihood_matrix(pool, trials, models)
+    res = compute_posteriors(likelihoods, models,
+        [posteriors[model] for model in models])
+    posteriors = res.posteriors
+
+    # Print the posteriors after the trials of each subject.
+    numTrials = 0
+    for subject, trialSet in trialSets:
+        numTrials += len(trialSet)
+        print("Posteriors after subject " + subject + ":")
+        for model, logPosterior in zip(models, res.trajectory[numTrials]):
+            print("P" + str(model) + " = " + str(np.exp(logPosterior)))
+        print("Sum: " + str(np.sum(np.exp(res.trajectory[numTrials]))))
 
     # Get empirical distributions for the data.
     dists = get_empirical_distributions(rt, choice, distLeft, distRight,
@@ -109,8 +116,13 @@ def main():
 
     generate_probabilistic_simulations(probLeftFixFirst, distTransition,
         distFirstFix, distSecondFix, distThirdFix, distOtherFix, posteriors,
-        numSamples=32, numSimulationsPerSample=1)
+        numSamples=32, numSimulationsPerSample=1, pool=pool)
 
 
 if __name__ == '__main__':
-    main()
+    # The grid center can be given as --center=D,THETA,STD.
+    center = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--center="):
+            center = [float(v) for v in arg[len("--center="):].split(",")]
+    main("--trace" in sys.argv[1:], center)
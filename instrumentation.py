@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# instrumentation.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import json
+import os
+import sys
+import time
+
+import tracing
+
+
+# Instrumentation is off unless enabled. The likelihood functions check this
+# flag before recording anything, so it costs one lookup when off. Workers
+# created after enable() is called inherit it.
+enabled = False
+outputFile = None
+
+# Counters and phase timers (in seconds) accumulated in this process since the
+# last record was written.
+counters = dict()
+timers = dict()
+
+
+def enable(fileName="instrumentation.jsonl"):
+    # Records are appended to the file as JSON lines.
+    global enabled
+    global outputFile
+    enabled = True
+    outputFile = fileName
+    reset()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def count(name, value=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+
+def start_timer():
+    return time.time()
+
+
+def stop_timer(name, startTime):
+    if enabled:
+        timers[name] = timers.get(name, 0.) + time.time() - startTime
+
+
+def get_stats():
+    return {'counters': dict(counters), 'timers': dict(timers)}
+
+
+def write_record(record):
+    # Each record is written with a single call on a file opened for
+    # appending, so records from concurrent workers do not interleave.
+    record['pid'] = os.getpid()
+    record['time'] = time.time()
+    with open(outputFile, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def dump_call(function, params, result, startTime):
+    # Write the counters and timers of one run_analysis call, then start over.
+    # Time not spent in the likelihood engine (mostly data access) is reported
+    # separately.
+    if not enabled:
+        return
+    wallTime = time.time() - startTime
+    record = get_stats()
+    record['function'] = function
+    record['params'] = [float(p) for p in params]
+    record['result'] = float(result)
+    record['wallTime'] = wallTime
+    record['timers']['outside_engine'] = wallTime - timers.get('likelihood',
+        0.)
+    write_record(record)
+    reset()
+
+
+def run_task(params):
+    func, args = params
+    startTime = time.time()
+    result = func(args)
+    return result, time.time() - startTime
+
+
+def instrumented_map(pool, func, listParams):
+    # pool.map, recording the wall time of the map and the time spent by the
+    # workers in the tasks. The remainder of the workers' time is spent on
+    # dispatch, pickling and waiting. Tasks are also traced if tracing is
+    # enabled.
+    if not enabled:
+        return tracing.traced_map(pool, func, listParams)
+    startTime = time.time()
+    results = tracing.traced_map(pool, run_task,
+        [(func, params) for params in listParams], func.__name__)
+    wallTime = time.time() - startTime
+    busyTime = sum([elapsed for result, elapsed in results])
+    numWorkers = pool._processes
+    record = dict()
+    record['function'] = 'pool.map'
+    record['numTasks'] = len(listParams)
+    record['numWorkers'] = numWorkers
+    record['wallTime'] = wallTime
+    record['busyTime'] = busyTime
+    record['overheadTime'] = max(wallTime * numWorkers - busyTime, 0.)
+    write_record(record)
+    return [result for result, elapsed in results]
+
+
+def load_records(fileName="instrumentation.jsonl"):
+    records = list()
+    with open(fileName, "r") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def aggregate_records(records):
+    # Sum the counters and timers of all calls, overall and per function and
+    # worker process.
+    def add(total, record):
+        total['calls'] += 1
+        total['wallTime'] += record.get('wallTime', 0.)
+        for key in ['counters', 'timers']:
+            for name, value in record.get(key, dict()).iteritems():
+                total[key][name] = total[key].get(name, 0) + value
+
+    def new_total():
+        return {'calls': 0, 'wallTime': 0., 'counters': dict(),
+            'timers': dict()}
+
+    summary = {'total': new_total(), 'functions': dict(), 'workers': dict()}
+    for record in records:
+        function = record['function']
+        pid = str(record['pid'])
+        if function not in summary['functions']:
+            summary['functions'][function] = new_total()
+        if pid not in summary['workers']:
+            summary['workers'][pid] = new_total()
+        add(summary['functions'][function], record)
+        add(summary['workers'][pid], record)
+        if function != 'pool.map':
+            add(summary['total'], record)
+    return summary
+
+
+def main(argv):
+    # Print the aggregate of a file of records.
+    fileName = argv[0] if argv else "instrumentation.jsonl"
+    summary = aggregate_records(load_records(fileName))
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# mapreduce_nll.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+import numpy as np
+
+import optimize
+from executors import create_executor
+from handle_fixations import analysis_per_trial_models
+from multiresolution import get_log_step_correction, scale_parameters
+from posterior_engine import get_trial_list
+from tracing import traced_map
+from trial_sampling import get_trial_subsets
+
+
+def get_trial_sets(rt, trialsPerSubject=200, seed=0, useOddTrials=True,
+    useEvenTrials=True):
+    # The trials of each subject that run_analysis would evaluate with the
+    # same arguments, in the same order.
+    trialSubsets = get_trial_subsets(rt, trialsPerSubject, seed)
+    trialSets = dict()
+    for subject in trialSubsets.keys():
+        trialSets[subject] = [trial for trial in trialSubsets[subject]
+            if (useOddTrials or trial % 2 == 0) and
+            (useEvenTrials or trial % 2 != 0)]
+    return trialSets
+
+
+def get_partial_log_likelihoods(trials, models, stateStep=0.1, timeStep=10):
+    # Map step: the summed log likelihood of a chunk of trials under each of
+    # the given models. Parameters are rescaled and trials with zero
+    # likelihood left out as in run_analysis.
+    scaledModels = list()
+    for d, theta, std in models:
+        scaledD, scaledStd = scale_parameters(d, std, timeStep)
+        scaledModels.append((scaledD, theta, scaledStd))
+    stepCorrection = get_log_step_correction(timeStep)
+    logLikelihoods = np.zeros(len(models))
+    for trial in trials:
+        likelihoods = analysis_per_trial_models(*(trial + (scaledModels,)),
+            timeStep=timeStep, stateStep=stateStep)
+        valid = likelihoods != 0
+        logLikelihoods[valid] += np.log(likelihoods[valid]) - stepCorrection
+    return logLikelihoods
+
+
+def get_partial_log_likelihoods_wrapper(params):
+    return get_partial_log_likelihoods(*params)
+
+
+def get_tasks(trialLists, numModels, numTasks):
+    # Split the (model x subject x trial) space into about numTasks blocks.
+    # Models are split first; the remaining factor is spread over the trials,
+    # in chunks that never mix subjects. Returns (model slice, subject, trial
+    # slice) triples.
+    numModelBlocks = max(min(numModels, numTasks), 1)
+    modelBounds = np.linspace(0, numModels, numModelBlocks + 1).astype(int)
+    numTrialChunks = max(numTasks // numModelBlocks, 1)
+    totalTrials = sum([len(trials) for trials in trialLists.values()])
+    chunkSize = max(int(np.ceil(totalTrials / float(numTrialChunks))), 1)
+
+    tasks = list()
+    for i in xrange(numModelBlocks):
+        models = slice(modelBounds[i], modelBounds[i+1])
+        for subject in sorted(trialLists.keys()):
+            for start in xrange(0, len(trialLists[subject]), chunkSize):
+                tasks.append((models, subject, slice(start,
+                    start + chunkSize)))
+    return tasks
+
+
+def run_mapreduce_nll(pool, rt, choice, valueLeft, valueRight, fixItem,
+    fixTime, models, trialSets=None, numTasks=None, stateStep=0.1,
+    timeStep=10):
+    # NLL of each model over the given trials of each subject (all trials by
+    # default), with tasks spread over models, subjects and trial chunks so
+    # that all workers are busy whether there is one model or many. Returns
+    # the NLL per model and, for each subject, its NLL per model.
+    if trialSets is None:
+        trialSets = get_trial_subsets(rt, None)
+    if numTasks is None:
+        numTasks = 4 * pool._processes
+    models = [tuple(model) for model in models]
+    trialLists = dict()
+    for subject in trialSets.keys():
+        trialLists[subject] = get_trial_list(rt, choice, valueLeft,
+            valueRight, fixItem, fixTime, [(subject, trialSets[subject])])
+
+    tasks = get_tasks(trialLists, len(models), numTasks)
+    results = traced_map(pool, get_partial_log_likelihoods_wrapper,
+        [(trialLists[subject][trials], models[m], stateStep, timeStep)
+        for m, subject, trials in tasks])
+
+    # Reduce step: add up the partial log likelihoods per subject and model.
+    subjectNLLs = dict()
+    for subject in trialLists.keys():
+        subjectNLLs[subject] = np.zeros(len(models))
+    for (m, subject, trials), logLikelihoods in zip(tasks, results):
+        subjectNLLs[subject][m] -= logLikelihoods
+    NLLs = np.zeros(len(models))
+    for subject in sorted(subjectNLLs.keys()):
+        NLLs += subjectNLLs[subject]
+
+    mapReduceNLL = collections.namedtuple('MapReduceNLL', ['NLLs',
+        'subjectNLLs'])
+    return mapReduceNLL(NLLs, subjectNLLs)
+
+
+def main():
+    # Evaluate the initial guess of optimize.py on the same trials it uses,
+    # spread over all workers.
+    pool = create_executor()
+    optimize.load_global_data()
+    trialSets = get_trial_subsets(optimize.rt, 200, seed=0)
+    res = run_mapreduce_nll(pool, optimize.rt, optimize.choice,
+        optimize.valueLeft, optimize.valueRight, optimize.fixItem,
+        optimize.fixTime, [optimize.initialGuess], trialSets)
+    for subject in sorted(res.subjectNLLs.keys()):
+        print("NLL for subject " + subject + ": " +
+            str(res.subjectNLLs[subject][0]))
+    print("NLL for " + str(optimize.initialGuess) + ": " + str(res.NLLs[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# minibatch_optimize.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+import numpy as np
+import sys
+
+import optimize
+import tracing
+from executors import create_executor
+from handle_fixations import analysis_per_trial_gradient
+from multiresolution import (referenceTimeStep, get_log_step_correction,
+    scale_parameters)
+from optimize import initialGuess, searchBounds
+from trial_sampling import get_trial_subsets
+
+
+def get_log_likelihoods(x, subject, trials, stateStep=0.1, timeStep=10):
+    # Log likelihood of each of the given trials from one subject, and its
+    # gradient with respect to x. As in run_analysis, trials with zero
+    # likelihood are left out of the NLL.
+    d, std = scale_parameters(x[0], x[2], timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
+    theta = x[1]
+    ratio = float(timeStep) / float(referenceTimeStep)
+    scaling = np.array([ratio, 1, np.sqrt(ratio)])
+
+    logLikelihoods = np.zeros(len(trials))
+    gradients = np.zeros((len(trials), 3))
+    for i, trial in enumerate(trials):
+        likelihood, gradient = analysis_per_trial_gradient(
+            optimize.rt[subject][trial], optimize.choice[subject][trial],
+            optimize.valueLeft[subject][trial],
+            optimize.valueRight[subject][trial],
+            optimize.fixItem[subject][trial], optimize.fixTime[subject][trial],
+            d, theta, std, timeStep=timeStep, stateStep=stateStep)
+        if likelihood != 0:
+            logLikelihoods[i] = np.log(likelihood) - stepCorrection
+            gradients[i] = gradient * scaling
+    return logLikelihoods, gradients
+
+
+def get_log_likelihoods_wrapper(params):
+    return get_log_likelihoods(*params)
+
+
+def estimate_nll(pool, x, trialSubsets, stateStep=0.1, timeStep=10):
+    # Estimate the NLL over all trials, and its gradient, from a subset of
+    # trials per subject. Each subject's total is its number of trials times
+    # the mean over its subset, so the standard error combines the sampling
+    # variance within each subject (with the finite population correction,
+    # which makes it zero when all trials are used).
+    subjects = sorted(trialSubsets.keys())
+    results = tracing.traced_map(pool, get_log_likelihoods_wrapper,
+        [(x, subject, trialSubsets[subject], stateStep, timeStep)
+        for subject in subjects])
+
+    NLL = 0
+    variance = 0
+    gradient = np.zeros(3)
+    gradientVariance = np.zeros(3)
+    for subject, (logLikelihoods, gradients) in zip(subjects, results):
+        numTotal = len(optimize.rt[subject])
+        numSampled = len(logLikelihoods)
+        correction = 1. - float(numSampled) / numTotal
+        NLL -= numTotal * np.mean(logLikelihoods)
+        gradient -= numTotal * np.mean(gradients, axis=0)
+        if numSampled > 1:
+            variance += (numTotal ** 2 * correction *
+                np.var(logLikelihoods, ddof=1) / numSampled)
+            gradientVariance += (numTotal ** 2 * correction *
+                np.var(gradients, axis=0, ddof=1) / numSampled)
+
+    estimate = collections.namedtuple('Estimate', ['NLL', 'SE', 'gradient',
+        'gradientSE'])
+    return estimate(NLL, np.sqrt(variance), gradient,
+        np.sqrt(gradientVariance))
+
+
+def minibatch_optimize(pool, x0, bounds, initialTrialsPerSubject=20,
+    growthFactor=2, learningRate=0.02, maxIterations=300, tolX=1e-3,
+    stateStep=0.1, timeStep=10, seed=0, verbose=True):
+    # Stochastic gradient descent (Adam) on minibatch estimates of the NLL.
+    # Each iteration draws a new subset of trials per subject. Far from the
+    # optimum the gradient is much larger than its standard error and small
+    # batches are enough; once the noise dominates the gradient the batch
+    # grows, until all trials are used. The search runs in coordinates
+    # normalized to the unit box given by the bounds.
+    randomState = np.random.RandomState(seed)
+    lower = np.array([b[0] for b in bounds], dtype=float)
+    upper = np.array([b[1] for b in bounds], dtype=float)
+    span = upper - lower
+    maxTrialsPerSubject = max([len(optimize.rt[subject])
+        for subject in optimize.rt.keys()])
+
+    u = (np.array(x0, dtype=float) - lower) / span
+    m = np.zeros(len(u))
+    v = np.zeros(len(u))
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+    trialsPerSubject = initialTrialsPerSubject
+    history = list()
+    for i in xrange(maxIterations):
+        x = lower + u * span
+        trialSubsets = get_trial_subsets(optimize.rt, trialsPerSubject,
+            seed=randomState.randint(2 ** 31 - 1))
+        estimate = estimate_nll(pool, x, trialSubsets, stateStep, timeStep)
+        history.append((i, trialsPerSubject, x, estimate.NLL, estimate.SE))
+        if verbose:
+            print("Iteration " + str(i) + " with " + str(trialsPerSubject) +
+                " trials per subject: NLL for " + str(x) + ": " +
+                str(estimate.NLL) + " +/- " + str(estimate.SE))
+
+        # Adam step on the gradient in normalized coordinates.
+        gradient = estimate.gradient * span
+        m = beta1 * m + (1 - beta1) * gradient
+        v = beta2 * v + (1 - beta2) * gradient ** 2
+        mHat = m / (1 - beta1 ** (i + 1))
+        vHat = v / (1 - beta2 ** (i + 1))
+        step = learningRate * mHat / (np.sqrt(vHat) + epsilon)
+        newU = np.clip(u - step, 0, 1)
+        stepSize = np.max(np.absolute(newU - u))
+        u = newU
+
+        fullBatch = trialsPerSubject >= maxTrialsPerSubject
+        if fullBatch and stepSize < tolX:
+            break
+        # Norm test: grow the batch once the gradient is no longer clearly
+        # distinguishable from the sampling noise.
+        gradientSE = estimate.gradientSE * span
+        if (not fullBatch and
+            np.linalg.norm(gradient) < np.linalg.norm(gradientSE)):
+            trialsPerSubject = min(trialsPerSubject * growthFactor,
+                maxTrialsPerSubject)
+
+    # The final optimum is confirmed on all trials.
+    x = lower + u * span
+    allTrials = get_trial_subsets(optimize.rt, None)
+    fullNLL = estimate_nll(pool, x, allTrials, stateStep, timeStep).NLL
+    if verbose:
+        print("NLL on all trials for " + str(x) + ": " + str(fullNLL))
+
+    result = collections.namedtuple('MinibatchResult', ['x', 'NLL',
+        'iterations', 'history'])
+    return result(x, fullNLL, len(history), history)
+
+
+def main(trace=False):
+    # Data must be loaded before the pool is created, so that the workers
+    # inherit it. Cluster workers on other hosts load it themselves.
+    if trace:
+        tracing.enable()
+    optimize.load_global_data()
+    pool = create_executor(setup=optimize.load_global_data)
+
+    res = minibatch_optimize(pool, initialGuess, searchBounds)
+    print("Optimal d: " + str(res.x[0]))
+    print("Optimal theta: " + str(res.x[1]))
+    print("Optimal std: " + str(res.x[2]))
+    print("Min NLL: " + str(res.NLL))
+
+
+if __name__ == '__main__':
+    main("--trace" in sys.argv[1:])
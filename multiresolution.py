@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+# multiresolution.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+import numpy as np
+
+
+# Discretization levels as (stateStep, timeStep), from coarsest to finest. The
+# last level is the resolution used everywhere else. State steps must divide the
+# barrier, so that the grid of states includes the zero state.
+defaultSchedule = [(0.25, 40), (0.2, 20), (0.1, 10)]
+
+# The model parameters d and std are defined for time steps of this size.
+referenceTimeStep = 10
+
+
+def scale_parameters(d, std, timeStep):
+    # Over a coarser time step the drift accumulates linearly and so does the
+    # variance of the noise, so the parameters are rescaled to describe the
+    # same process as at the reference time step.
+    ratio = float(timeStep) / float(referenceTimeStep)
+    return d * ratio, std * np.sqrt(ratio)
+
+
+def get_log_step_correction(timeStep):
+    # The likelihood of a trial is the probability of crossing the barrier
+    # during its last time step, which grows with the size of the step. This
+    # term is subtracted from each trial's log likelihood so that NLLs computed
+    # at different levels are comparable.
+    return np.log(float(timeStep) / float(referenceTimeStep))
+
+
+def run_multiresolution(fit_level, evaluate_level, x0,
+    schedule=defaultSchedule, verbose=True):
+    # fit_level(x0, stateStep, timeStep) runs the optimizer at one level,
+    # starting from x0, and returns the optimum and its NLL.
+    # evaluate_level(x, stateStep, timeStep) returns the NLL of x at one level.
+    levels = list()
+    level = collections.namedtuple('Level', ['stateStep', 'timeStep', 'x',
+        'NLL', 'discrepancy'])
+
+    x = x0
+    for stateStep, timeStep in schedule:
+        # Before refining, measure how much the NLL of the previous optimum
+        # changes when moving to this resolution.
+        discrepancy = None
+        if levels:
+            NLL = evaluate_level(x, stateStep, timeStep)
+            discrepancy = NLL - levels[-1].NLL
+            if verbose:
+                print("NLL discrepancy from (" + str(levels[-1].stateStep) +
+                    ", " + str(levels[-1].timeStep) + ") to (" +
+                    str(stateStep) + ", " + str(timeStep) + "): " +
+                    str(discrepancy))
+
+        # Each level is warm-started from the optimum of the previous one.
+        x, NLL = fit_level(x, stateStep, timeStep)
+        levels.append(level(stateStep, timeStep, x, NLL, discrepancy))
+        if verbose:
+            print("Optimum at (" + str(stateStep) + ", " + str(timeStep) +
+                "): " + str(x) + " with NLL " + str(NLL))
+
+    return levels
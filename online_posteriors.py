@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+# online_posteriors.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import csv
+import numpy as np
+import os
+import sys
+import time
+
+from handle_fixations import analysis_per_trial_models
+from posterior_engine import get_log_priors, update_log_posteriors
+
+
+def create_posterior_state(models, priors=None):
+    # The state of the online updater: the model grid, the current log
+    # posteriors, the number of trials consumed and the position reached in
+    # the trial stream.
+    state = dict()
+    state['models'] = [tuple(model) for model in models]
+    state['logPosteriors'] = get_log_priors(len(models), priors)
+    state['numTrials'] = 0
+    state['offset'] = 0
+    return state
+
+
+def update_posterior_state(state, trial, stateStep=0.1, timeStep=10):
+    # Consume one trial, given as (rt, choice, valueLeft, valueRight, fixItem,
+    # fixTime). The likelihoods of all models are computed in one batch and
+    # the update itself is a fixed number of operations per model.
+    rt, choice, valueLeft, valueRight, fixItem, fixTime = trial
+    likelihoods = analysis_per_trial_models(rt, choice, valueLeft, valueRight,
+        fixItem, fixTime, state['models'], timeStep=timeStep,
+        stateStep=stateStep)
+    state['logPosteriors'] = update_log_posteriors(state['logPosteriors'],
+        likelihoods)
+    state['numTrials'] += 1
+    return state
+
+
+def get_map_model(state):
+    # Model with the highest posterior, and its posterior.
+    best = int(np.argmax(state['logPosteriors']))
+    return state['models'][best], np.exp(state['logPosteriors'][best])
+
+
+def save_snapshot(state, snapshotFile):
+    # Format: a row with the number of trials consumed and the stream offset,
+    # followed by one row per model: d, theta, std, log posterior. The file is
+    # written under a temporary name and then renamed, so an interrupted save
+    # leaves the previous snapshot intact.
+    tempFile = snapshotFile + ".tmp"
+    with open(tempFile, "wb") as csvFile:
+        csvWriter = csv.writer(csvFile, delimiter=',', quotechar='|',
+            quoting=csv.QUOTE_MINIMAL)
+        csvWriter.writerow(["num_trials", "offset"])
+        csvWriter.writerow([state['numTrials'], state['offset']])
+        csvWriter.writerow(["d", "theta", "std", "log_posterior"])
+        for model, logPosterior in zip(state['models'],
+            state['logPosteriors']):
+            csvWriter.writerow([repr(float(v)) for v in model] +
+                [repr(float(logPosterior))])
+    os.rename(tempFile, snapshotFile)
+
+
+def load_snapshot(snapshotFile):
+    with open(snapshotFile, "rb") as csvFile:
+        csvReader = csv.reader(csvFile, delimiter=',')
+        csvReader.next()
+        row = csvReader.next()
+        numTrials, offset = int(row[0]), int(row[1])
+        csvReader.next()
+        models = list()
+        logPosteriors = list()
+        for row in csvReader:
+            models.append(tuple([float(v) for v in row[:3]]))
+            logPosteriors.append(float(row[3]))
+    state = create_posterior_state(models)
+    state['logPosteriors'] = np.array(logPosteriors)
+    state['numTrials'] = numTrials
+    state['offset'] = offset
+    return state
+
+
+def parse_trial(row):
+    # Format: parcode, trial, rt, choice, dist_left, dist_right, fix_item,
+    # fix_time, where the fixation items and durations are separated by
+    # spaces. Numbers may be written as floats (e.g. 496.000000), as in
+    # expdata.csv, and are read as floats like in load_data_from_csv, so that
+    # angular distances are transformed to the same values as elsewhere.
+    rt = float(row[2])
+    choice = int(float(row[3]))
+    valueLeft = np.absolute((np.absolute(float(row[4]))-15)/5)
+    valueRight = np.absolute((np.absolute(float(row[5]))-15)/5)
+    fixItem = np.array([int(float(v)) for v in row[6].split()])
+    fixTime = np.array([float(v) for v in row[7].split()])
+    return rt, choice, valueLeft, valueRight, fixItem, fixTime
+
+
+def tail_file(fileName, offset=0, pollInterval=1., maxIdleTime=None):
+    # Yield each complete line appended to the file, starting from the given
+    # byte offset, together with the offset just after it. A line is only
+    # yielded once its newline has been written. Stops after maxIdleTime
+    # seconds without new lines, or never if it is None.
+    with open(fileName, "rb") as f:
+        f.seek(offset)
+        buf = ""
+        idleTime = 0
+        while True:
+            data = f.read()
+            if not data:
+                if maxIdleTime is not None and idleTime >= maxIdleTime:
+                    return
+                time.sleep(pollInterval)
+                idleTime += pollInterval
+                continue
+            idleTime = 0
+            buf += data
+            lines = buf.split("\n")
+            buf = lines.pop()
+            for line in lines:
+                offset += len(line) + 1
+                yield line, offset
+
+
+def consume_stream(state, stream, snapshotFile=None, snapshotInterval=50,
+    stateStep=0.1, timeStep=10, verbose=True):
+    # Update the posteriors with each (line, offset) pair from the stream,
+    # e.g. from tail_file, saving a snapshot every snapshotInterval trials.
+    # Blank lines and the header line are skipped.
+    for line, offset in stream:
+        state['offset'] = offset
+        row = line.strip().split(',')
+        if not row[0] or row[0] == "parcode":
+            continue
+        update_posterior_state(state, parse_trial(row), stateStep, timeStep)
+        if verbose:
+            model, posterior = get_map_model(state)
+            print("Trial " + str(state['numTrials']) + ": best model " +
+                str(model) + " with posterior " + str(posterior))
+        if (snapshotFile is not None and
+            state['numTrials'] % snapshotInterval == 0):
+            save_snapshot(state, snapshotFile)
+    if snapshotFile is not None:
+        save_snapshot(state, snapshotFile)
+    return state
+
+
+def main(argv):
+    trialsFile = argv[0]
+    snapshotFile = trialsFile + ".snapshot"
+
+    # Restart from the last snapshot, if there is one.
+    if os.path.exists(snapshotFile):
+        state = load_snapshot(snapshotFile)
+        print("Resuming after " + str(state['numTrials']) + " trials...")
+    else:
+        rangeD = [0.004, 0.0045, 0.005]
+        rangeTheta = [0.3, 0.35, 0.4]
+        rangeStd = [0.08, 0.085, 0.09]
+        models = list()
+        for d in rangeD:
+            for theta in rangeTheta:
+                for std in rangeStd:
+                    models.append((d, theta, std))
+        state = create_posterior_state(models)
+
+    stream = tail_file(trialsFile, state['offset'])
+    consume_stream(state, stream, snapshotFile)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,11 +3,18 @@
 # optimize.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from scipy.optimize import basinhopping
+from scipy.optimize import basinhopping, minimize
 
 import numpy as np
+import sys
 
-from handle_fixations import load_data_from_csv, analysis_per_trial
+import instrumentation
+
+from handle_fixations import (load_data_from_csv, analysis_per_trial,
+    analysis_per_trial_gradient)
+from multiresolution import (defaultSchedule, referenceTimeStep,
+    run_multiresolution, get_log_step_correction, scale_parameters)
+from trial_sampling import get_trial_subsets, get_value_difference_strata
 
 
 # Global variables.
@@ -18,30 +25,116 @@ valueRight = dict()
 fixItem = dict()
 fixTime = dict()
 
+# Fixed trial subsets per subject, and NLLs already computed with them.
+trialSubsets = None
+cachedNLLs = dict()
+cachedGradients = dict()
+
+# Initial guess: d, theta, std.
+initialGuess = [0.0002, 0.5, 0.08]
+
+# Search bounds.
+xmin = [0.00005, 0., 0.05]
+xmax = [0.01, 1., 0.1]
+searchBounds = [(lower, upper) for lower, upper in zip(xmin, xmax)]
+
+
+def set_trial_subsets(trialsPerSubject=200, seed=0, stratified=False):
+    # Fix the trials used by run_analysis for each subject, so that repeated
+    # evaluations of the same parameters are deterministic and can be cached.
+    # Call again with a different seed to redraw the subsets.
+    global trialSubsets
+    strata = None
+    if stratified:
+        strata = get_value_difference_strata(valueLeft, valueRight)
+    trialSubsets = get_trial_subsets(rt, trialsPerSubject, seed, strata)
+    cachedNLLs.clear()
+    cachedGradients.clear()
+
+
+def get_trial_set(subject, trialsPerSubject):
+    # Without fixed subsets, a new random subset is drawn on every call.
+    if trialSubsets is not None:
+        return trialSubsets[subject]
+    trials = rt[subject].keys()
+    return np.random.choice(trials, trialsPerSubject, replace=False)
+
+
+def run_analysis(x, stateStep=0.1, timeStep=10):
+    key = (tuple(x), stateStep, timeStep)
+    if trialSubsets is not None and key in cachedNLLs:
+        return cachedNLLs[key]
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
+        instrumentation.reset()
 
-def run_analysis(x):
     trialsPerSubject = 200
-    d = x[0]
+    d, std = scale_parameters(x[0], x[2], timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
     theta = x[1]
-    std = x[2]
 
     logLikelihood = 0
     subjects = rt.keys()
     for subject in subjects:
-        trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
+        trialSet = get_trial_set(subject, trialsPerSubject)
         for trial in trialSet:
             likelihood = analysis_per_trial(rt[subject][trial],
                 choice[subject][trial], valueLeft[subject][trial],
                 valueRight[subject][trial], fixItem[subject][trial],
-                fixTime[subject][trial], d, theta, std=std)
+                fixTime[subject][trial], d, theta, std=std,
+                timeStep=timeStep, stateStep=stateStep)
             if likelihood != 0:
-                logLikelihood += np.log(likelihood)
+                logLikelihood += np.log(likelihood) - stepCorrection
     print("NLL for " + str(x) + ": " + str(-logLikelihood))
+    if trialSubsets is not None:
+        cachedNLLs[key] = -logLikelihood
+    if instrumentation.enabled:
+        instrumentation.dump_call('optimize.run_analysis', x, -logLikelihood,
+            startTime)
     return -logLikelihood
 
 
-def main():
+def run_analysis_gradient(x, stateStep=0.1, timeStep=10):
+    # Same as run_analysis, but also returns the gradient of the NLL with
+    # respect to x, for use with jac=True in scipy.
+    key = (tuple(x), stateStep, timeStep)
+    if trialSubsets is not None and key in cachedGradients:
+        return cachedGradients[key]
+    if instrumentation.enabled:
+        startTime = instrumentation.start_timer()
+        instrumentation.reset()
+
+    trialsPerSubject = 200
+    d, std = scale_parameters(x[0], x[2], timeStep)
+    stepCorrection = get_log_step_correction(timeStep)
+    theta = x[1]
+    ratio = float(timeStep) / float(referenceTimeStep)
+    scaling = np.array([ratio, 1, np.sqrt(ratio)])
+
+    logLikelihood = 0
+    gradient = np.zeros(3)
+    subjects = rt.keys()
+    for subject in subjects:
+        trialSet = get_trial_set(subject, trialsPerSubject)
+        for trial in trialSet:
+            likelihood, trialGradient = analysis_per_trial_gradient(
+                rt[subject][trial], choice[subject][trial],
+                valueLeft[subject][trial], valueRight[subject][trial],
+                fixItem[subject][trial], fixTime[subject][trial], d, theta,
+                std, timeStep=timeStep, stateStep=stateStep)
+            if likelihood != 0:
+                logLikelihood += np.log(likelihood) - stepCorrection
+                gradient += trialGradient * scaling
+    print("NLL for " + str(x) + ": " + str(-logLikelihood))
+    if trialSubsets is not None:
+        cachedGradients[key] = (-logLikelihood, -gradient)
+    if instrumentation.enabled:
+        instrumentation.dump_call('optimize.run_analysis_gradient', x,
+            -logLikelihood, startTime)
+    return -logLikelihood, -gradient
+
+
+def load_global_data(expdataFile="expdata.csv", fixationsFile="fixations.csv"):
     global rt
     global choice
     global valueLeft
@@ -50,7 +143,7 @@ def main():
     global fixTime
 
     # Load experimental data from CSV file and update global variables.
-    data = load_data_from_csv("expdata.csv", "fixations.csv")
+    data = load_data_from_csv(expdataFile, fixationsFile)
     rt = data.rt
     choice = data.choice
     distLeft = data.distLeft
@@ -70,19 +163,49 @@ def main():
             valueRight[subject][trial] = np.absolute((np.absolute(
                 distRight[subject][trial])-15)/5)
 
-    # Initial guess: d, theta, std.
-    x0 = [0.0002, 0.5, 0.08]
-
-    # Search bounds.
-    xmin = [0.00005, 0., 0.05]
-    xmax = [0.01, 1., 0.1]
-    bounds = [(lower, upper) for lower, upper in zip(xmin, xmax)]
 
-    # Optimize using Basinhopping algorithm.
-    minimizer_kwargs = dict(method="L-BFGS-B", bounds=bounds)
-    res = basinhopping(run_analysis, x0, minimizer_kwargs=minimizer_kwargs)
-    print res
+def load_global_data_and_subsets(trialsPerSubject=200, seed=0,
+    stratified=False):
+    # Everything run_analysis reads. Drivers call this before creating their
+    # pool, and give it as setup to create_executor for cluster workers on
+    # other hosts, which do not inherit the globals.
+    load_global_data()
+    set_trial_subsets(trialsPerSubject, seed, stratified)
+
+
+def main(multiresolution=False):
+    load_global_data()
+    # The same trials are used throughout the fit, which keeps the objective
+    # deterministic for the L-BFGS-B line searches.
+    set_trial_subsets()
+    x0 = initialGuess
+    bounds = searchBounds
+
+    if not multiresolution:
+        # Optimize using Basinhopping algorithm. The objective returns its
+        # gradient too, so each L-BFGS-B iteration needs a single pass over
+        # the trials instead of one per parameter for finite differences.
+        minimizer_kwargs = dict(method="L-BFGS-B", bounds=bounds, jac=True)
+        res = basinhopping(run_analysis_gradient, x0,
+            minimizer_kwargs=minimizer_kwargs)
+        print res
+        return
+
+    # Multi-resolution fitting: the global search runs on the coarsest state and
+    # time grids, and each finer level refines the previous optimum locally.
+    def fit_level(x, stateStep, timeStep):
+        minimizer_kwargs = dict(method="L-BFGS-B", bounds=bounds, jac=True,
+            args=(stateStep, timeStep))
+        if (stateStep, timeStep) == defaultSchedule[0]:
+            res = basinhopping(run_analysis_gradient, x,
+                minimizer_kwargs=minimizer_kwargs)
+        else:
+            res = minimize(run_analysis_gradient, x, **minimizer_kwargs)
+        return res.x, res.fun
+
+    levels = run_multiresolution(fit_level, run_analysis, x0)
+    print levels[-1]
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main("--multiresolution" in sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# posterior_engine.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from scipy.special import logsumexp
+
+import collections
+import numpy as np
+
+from handle_fixations import analysis_per_trial_models
+from tracing import traced_map
+
+
+def get_trial_list(rt, choice, valueLeft, valueRight, fixItem, fixTime,
+    trialSets):
+    # Flatten the trials in trialSets, a list of (subject, trials) pairs, into
+    # a list of (rt, choice, valueLeft, valueRight, fixItem, fixTime) tuples,
+    # in the order given.
+    trials = list()
+    for subject, trialSet in trialSets:
+        for trial in trialSet:
+            trials.append((rt[subject][trial], choice[subject][trial],
+                valueLeft[subject][trial], valueRight[subject][trial],
+                fixItem[subject][trial], fixTime[subject][trial]))
+    return trials
+
+
+def get_likelihoods(trials, models, stateStep=0.1, timeStep=10):
+    # Likelihood matrix of the given trials (rows) under each model (columns).
+    likelihoods = np.zeros((len(trials), len(models)))
+    for i, trial in enumerate(trials):
+        likelihoods[i] = analysis_per_trial_models(*(trial + (models,)),
+            timeStep=timeStep, stateStep=stateStep)
+    return likelihoods
+
+
+def get_likelihoods_wrapper(params):
+    return get_likelihoods(*params)
+
+
+def get_likelihood_matrix(pool, trials, models, numChunks=None,
+    stateStep=0.1, timeStep=10):
+    # The trials are split into contiguous chunks, and each worker computes
+    # the likelihoods of a chunk under all models at once. A few chunks per
+    # worker keep the pool balanced.
+    if numChunks is None:
+        numChunks = 4 * pool._processes
+    numChunks = max(min(numChunks, len(trials)), 1)
+    bounds = np.linspace(0, len(trials), numChunks + 1).astype(int)
+    chunks = [trials[bounds[i]:bounds[i+1]] for i in xrange(numChunks)]
+    results = traced_map(pool, get_likelihoods_wrapper,
+        [(chunk, models, stateStep, timeStep) for chunk in chunks])
+    return np.vstack(results)
+
+
+def get_log_priors(numModels, priors=None):
+    # Normalized log priors, uniform if none are given.
+    if priors is None:
+        priors = np.ones(numModels) / numModels
+    logPrior = np.log(np.array(priors, dtype=float))
+    return logPrior - logsumexp(logPrior)
+
+
+def update_log_posteriors(logPosterior, likelihoods):
+    # Bayesian update of the log posteriors with the likelihoods of one trial
+    # under each model. Trials with zero likelihood under every model are
+    # skipped. A model with zero likelihood for a trial is left unchanged by
+    # it (its likelihood is replaced by the marginal likelihood of the trial),
+    # as the discretization can give zero likelihoods to plausible models.
+    valid = likelihoods > 0
+    if not np.any(valid):
+        return logPosterior
+    logLikelihood = np.zeros(likelihoods.size)
+    logLikelihood[valid] = np.log(likelihoods[valid])
+    logLikelihood[~valid] = logsumexp(logPosterior[valid] +
+        logLikelihood[valid])
+    logPosterior = logPosterior + logLikelihood
+    return logPosterior - logsumexp(logPosterior)
+
+
+def compute_posteriors(likelihoods, models, priors=None):
+    # Sequential Bayesian updates over the rows of the likelihood matrix,
+    # carried out in log space. Row i of the trajectory holds the log
+    # posteriors after i trials.
+    numTrials, numModels = likelihoods.shape
+    logPosterior = get_log_priors(numModels, priors)
+    trajectory = np.zeros((numTrials + 1, numModels))
+    trajectory[0] = logPosterior
+    for i in xrange(numTrials):
+        logPosterior = update_log_posteriors(logPosterior, likelihoods[i])
+        trajectory[i+1] = logPosterior
+
+    posteriors = dict()
+    for model, logP in zip(models, logPosterior):
+        posteriors[model] = np.exp(logP)
+    result = collections.namedtuple('Posteriors', ['posteriors',
+        'logPosteriors', 'trajectory'])
+    return result(posteriors, logPosterior, trajectory)
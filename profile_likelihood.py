@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+# profile_likelihood.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from mapreduce_nll import run_mapreduce_nll
+
+
+# Models are (d, theta, std) tuples; the axes of a slice are given by their
+# index in the tuple.
+parameterNames = ["d", "theta", "std"]
+
+
+def get_model_key(model):
+    # Rounded so that the same point reached from different ranges, e.g. by
+    # np.arange, is evaluated once.
+    return tuple([round(float(value), 10) for value in model])
+
+
+def get_grid_models(ranges):
+    # All models in the product of one range per parameter.
+    models = list()
+    for d in ranges[0]:
+        for theta in ranges[1]:
+            for std in ranges[2]:
+                models.append(get_model_key((d, theta, std)))
+    return models
+
+
+def get_slice_models(fineRanges, coarseRanges):
+    # The 1-D slices of generate_parameter_plots: the fine range of each
+    # parameter crossed with the coarse ranges of the other two.
+    models = list()
+    for axis in xrange(3):
+        ranges = list(coarseRanges)
+        ranges[axis] = fineRanges[axis]
+        models.extend(get_grid_models(ranges))
+    return models
+
+
+def get_surface_models(axes, rangeX, rangeY, fixedModel):
+    # A 2-D surface over the parameters in axes, with the third parameter
+    # fixed at its value in fixedModel.
+    models = list()
+    for x in rangeX:
+        for y in rangeY:
+            model = list(fixedModel)
+            model[axes[0]] = x
+            model[axes[1]] = y
+            models.append(get_model_key(model))
+    return models
+
+
+def evaluate_models(pool, rt, choice, valueLeft, valueRight, fixItem, fixTime,
+    models, trialSets, NLLs=None, stateStep=0.1, timeStep=10):
+    # NLLs of the given models on a fixed set of trials, added to the NLLs
+    # dict (model to NLL). Models already in it are not evaluated again, so
+    # slices and surfaces which share points can be computed one after the
+    # other. All new models are evaluated in one batch.
+    if NLLs is None:
+        NLLs = dict()
+    newModels = sorted(set([get_model_key(model) for model in models]) -
+        set(NLLs.keys()))
+    if newModels:
+        res = run_mapreduce_nll(pool, rt, choice, valueLeft, valueRight,
+            fixItem, fixTime, newModels, trialSets, stateStep=stateStep,
+            timeStep=timeStep)
+        for model, NLL in zip(newModels, res.NLLs):
+            NLLs[model] = NLL
+    return NLLs
+
+
+def get_slice(NLLs, axis, values, fixedModel):
+    # NLLs along one parameter, with the other two fixed.
+    curve = list()
+    for value in values:
+        model = list(fixedModel)
+        model[axis] = value
+        curve.append(NLLs[get_model_key(model)])
+    return np.array(curve)
+
+
+def get_surface(NLLs, axes, rangeX, rangeY, fixedModel):
+    # NLLs over two parameters, as an array indexed by (y, x).
+    surface = np.zeros((len(rangeY), len(rangeX)))
+    for i, x in enumerate(rangeX):
+        for j, y in enumerate(rangeY):
+            model = list(fixedModel)
+            model[axes[0]] = x
+            model[axes[1]] = y
+            surface[j, i] = NLLs[get_model_key(model)]
+    return surface
+
+
+def plot_surface(surface, axes, rangeX, rangeY, title=None):
+    # Each cell is centered on its grid point, assuming evenly spaced ranges.
+    extent = list()
+    for r in [rangeX, rangeY]:
+        halfStep = (r[-1] - r[0]) / (2. * (len(r) - 1)) if len(r) > 1 else 0.5
+        extent.extend([r[0] - halfStep, r[-1] + halfStep])
+    fig = plt.figure()
+    heatmap = plt.imshow(surface, origin='lower', aspect='auto',
+        interpolation='nearest', extent=extent)
+    plt.colorbar(heatmap).set_label("Negative log likelihood")
+    plt.xlabel(parameterNames[axes[0]])
+    plt.ylabel(parameterNames[axes[1]])
+    if title is not None:
+        plt.title(title)
+    return fig
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+# pruning.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from multiprocessing import Value
+
+
+# Marker returned by NLL evaluations which were abandoned because their partial
+# NLL passed the bound. Since the NLL of such a model is at least the bound,
+# infinity keeps it ranked after every completed evaluation.
+PRUNED = float('inf')
+
+# Best complete NLL found so far, shared by the parent process and the pool
+# workers. Processes without it, such as cluster workers on other hosts, never
+# prune: a private bound would outlive reset_incumbent in the parent and could
+# come from NLLs which are not comparable with the current search.
+incumbent = None
+
+
+def create_incumbent():
+    # Create the shared incumbent in the parent process. It must be passed to
+    # the pool workers through init_incumbent, e.g.
+    # create_executor(initializer=init_incumbent, initargs=(incumbent,)).
+    sharedIncumbent = Value('d', PRUNED)
+    init_incumbent(sharedIncumbent)
+    return sharedIncumbent
+
+
+def init_incumbent(sharedIncumbent):
+    global incumbent
+    incumbent = sharedIncumbent
+
+
+def reset_incumbent():
+    if incumbent is not None:
+        incumbent.value = PRUNED
+
+
+def get_incumbent():
+    if incumbent is None:
+        return PRUNED
+    return incumbent.value
+
+
+def update_incumbent(NLL):
+    if incumbent is None:
+        return
+    with incumbent.get_lock():
+        if NLL < incumbent.value:
+            incumbent.value = NLL
+
+
+def is_pruned(NLL):
+    return NLL == PRUNED
+
+
+def exceeds_bound(partialNLL, pruneMargin):
+    # Every trial adds a non-negative amount to the NLL, so once the partial NLL
+    # passes the incumbent (plus a margin) the complete NLL will too. With the
+    # step correction this holds for time steps of at least the reference time
+    # step only, so pruned evaluations must not use finer ones.
+    return partialNLL > get_incumbent() + pruneMargin
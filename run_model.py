@@ -8,17 +8,18 @@ import numpy as np
 import sys
 
 from handle_fixations import load_data_from_csv, analysis_per_trial
+from trial_sampling import get_trial_subset
 
 
 def run_analysis(rt, choice, valueLeft, valueRight, fixItem, fixTime, d, theta,
-    std, useOddTrials=True, useEvenTrials=True):
+    std, useOddTrials=True, useEvenTrials=True, seed=0):
     trialsPerSubject = 1200
     logLikelihood = 0
     subjects = rt.keys()
     for subject in subjects:
         print("Running subject " + subject + "...")
         trials = rt[subject].keys()
-        trialSet = np.random.choice(trials, trialsPerSubject, replace=False)
+        trialSet = get_trial_subset(trials, trialsPerSubject, seed)
         for trial in trialSet:
             if not useOddTrials and trial % 2 != 0:
                 continue
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# simulation_summaries.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import numpy as np
+
+from handle_fixations import simulate_trials
+from tracing import traced_map
+
+
+# Value differences (left minus right) are mapped to bins 0 to 6.
+numValueDiffs = 7
+
+
+def create_summary(rtBins=None):
+    # Online accumulators of simulated trials, per value difference: choice
+    # counts, and the count, mean and sum of squared deviations (M2) of the
+    # RTs. If RT bin edges are given, an RT histogram is kept too, with RTs
+    # outside the edges counted in the first or last bin.
+    summary = dict()
+    summary['countTotal'] = np.zeros(numValueDiffs)
+    summary['countLeftChosen'] = np.zeros(numValueDiffs)
+    summary['rtMean'] = np.zeros(numValueDiffs)
+    summary['rtM2'] = np.zeros(numValueDiffs)
+    summary['rtBins'] = rtBins
+    if rtBins is not None:
+        summary['rtHist'] = np.zeros((numValueDiffs, len(rtBins) - 1))
+    return summary
+
+
+def combine_moments(countA, meanA, M2A, countB, meanB, M2B):
+    # Chan et al.'s update for the mean and M2 of the union of two samples.
+    count = countA + countB
+    safeCount = np.maximum(count, 1)
+    delta = meanB - meanA
+    mean = meanA + delta * countB / safeCount
+    M2 = M2A + M2B + delta ** 2 * countA * countB / safeCount
+    return count, mean, M2
+
+
+def update_summary(summary, valueLeft, valueRight, choice, rt):
+    # Add a batch of simulated trials, given as arrays, to the summary.
+    idx = (np.array(valueLeft) - np.array(valueRight) + 3).astype(int)
+    choice = np.array(choice)
+    rt = np.array(rt, dtype=float)
+    chosen = choice != 0
+    idx = idx[chosen]
+    rt = rt[chosen]
+
+    count = np.bincount(idx, minlength=numValueDiffs).astype(float)
+    mean = (np.bincount(idx, weights=rt, minlength=numValueDiffs) /
+        np.maximum(count, 1))
+    M2 = np.bincount(idx, weights=(rt - mean[idx]) ** 2,
+        minlength=numValueDiffs)
+    summary['countLeftChosen'] += np.bincount(idx,
+        weights=(choice[chosen] == -1), minlength=numValueDiffs)
+    summary['countTotal'], summary['rtMean'], summary['rtM2'] = (
+        combine_moments(summary['countTotal'], summary['rtMean'],
+        summary['rtM2'], count, mean, M2))
+
+    if summary['rtBins'] is not None:
+        rtBins = summary['rtBins']
+        rtBin = np.clip(np.searchsorted(rtBins, rt, side='right') - 1, 0,
+            len(rtBins) - 2)
+        np.add.at(summary['rtHist'], (idx, rtBin), 1)
+    return summary
+
+
+def merge_summaries(summaries):
+    # Summary of the union of the trials in the given summaries.
+    merged = create_summary(summaries[0]['rtBins'])
+    for summary in summaries:
+        merged['countLeftChosen'] += summary['countLeftChosen']
+        merged['countTotal'], merged['rtMean'], merged['rtM2'] = (
+            combine_moments(merged['countTotal'], merged['rtMean'],
+            merged['rtM2'], summary['countTotal'], summary['rtMean'],
+            summary['rtM2']))
+        if merged['rtBins'] is not None:
+            merged['rtHist'] += summary['rtHist']
+    return merged
+
+
+def get_choice_curve(summary):
+    # Probability of choosing left per value difference, and its standard
+    # error.
+    probLeftChosen = summary['countLeftChosen'] / summary['countTotal']
+    stdProbLeftChosen = np.sqrt((probLeftChosen * (1 - probLeftChosen)) /
+        summary['countTotal'])
+    return probLeftChosen, stdProbLeftChosen
+
+
+def get_rt_curve(summary):
+    # Mean RT per value difference, and its standard error.
+    meanRts = summary['rtMean']
+    stdRts = (np.sqrt(summary['rtM2'] / summary['countTotal']) /
+        np.sqrt(summary['countTotal']))
+    return meanRts, stdRts
+
+
+def run_simulation_summary(probLeftFixFirst, distTransition, distFirstFix,
+    distSecondFix, distThirdFix, distOtherFix, numTrials, trialConditions, d,
+    theta, std, rtBins=None, batchSize=10000, seed=None):
+    # Simulate numTrials trials per trial condition, in batches of at most
+    # batchSize trials which are added to the summary and then discarded, so
+    # memory does not grow with the number of trials.
+    randomState = np.random.RandomState(seed)
+    conditions = np.array(trialConditions)
+    valueLeft = np.absolute((np.absolute(conditions[:,0])-15)/5)
+    valueRight = np.absolute((np.absolute(conditions[:,1])-15)/5)
+
+    summary = create_summary(rtBins)
+    totalTrials = numTrials * len(trialConditions)
+    for start in xrange(0, totalTrials, batchSize):
+        batch = np.arange(start, min(start + batchSize, totalTrials)) % len(
+            trialConditions)
+        ones = np.ones(batch.size)
+        simul = simulate_trials(probLeftFixFirst, distTransition, distFirstFix,
+            distSecondFix, distThirdFix, distOtherFix, valueLeft[batch],
+            valueRight[batch], d * ones, theta * ones, std * ones,
+            seed=randomState.randint(2 ** 31 - 1))
+        update_summary(summary, valueLeft[batch], valueRight[batch],
+            simul.choice, simul.rt)
+    return summary
+
+
+def run_simulation_summary_wrapper(params):
+    return run_simulation_summary(*params)
+
+
+def run_parallel_simulation_summary(pool, probLeftFixFirst, distTransition,
+    distFirstFix, distSecondFix, distThirdFix, distOtherFix, numTrials,
+    trialConditions, d, theta, std, rtBins=None, batchSize=10000, seed=None):
+    # Split the trials per condition across the workers and merge their
+    # summaries.
+    numChunks = pool._processes
+    randomState = np.random.RandomState(seed)
+    bounds = np.linspace(0, numTrials, numChunks + 1).astype(int)
+    listParams = list()
+    for i in xrange(numChunks):
+        listParams.append((probLeftFixFirst, distTransition, distFirstFix,
+            distSecondFix, distThirdFix, distOtherFix, bounds[i+1] - bounds[i],
+            trialConditions, d, theta, std, rtBins, batchSize,
+            randomState.randint(2 ** 31 - 1)))
+    summaries = traced_map(pool, run_simulation_summary_wrapper, listParams)
+    return merge_summaries(summaries)
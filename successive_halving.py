@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# successive_halving.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+import numpy as np
+import sys
+
+import tracing
+
+from executors import create_executor
+from group_fitting import run_analysis_wrapper
+from handle_fixations import load_data_from_csv
+
+
+def successive_halving(pool, rt, choice, valueLeft, valueRight, fixItem,
+    fixTime, models, minTrialsPerSubject=25, eta=3, seed=0, useOddTrials=True,
+    useEvenTrials=True, verbose=True):
+    # The largest subset size needed to cover every trial of every subject.
+    maxTrialsPerSubject = max([len(rt[subject]) for subject in rt.keys()])
+
+    survivors = list(models)
+    trialsPerSubject = minTrialsPerSubject
+    rungs = list()
+    while True:
+        # On the last rung the survivors are scored on the full data.
+        lastRung = (trialsPerSubject >= maxTrialsPerSubject or
+            len(survivors) == 1)
+        if lastRung:
+            trialsPerSubject = None
+
+        # All models in a rung are scored on the same trials, since the subset
+        # is selected with a fixed seed.
+        listParams = list()
+        for model in survivors:
+            listParams.append((rt, choice, valueLeft, valueRight, fixItem,
+                fixTime, model[0], model[1], model[2], useOddTrials,
+                useEvenTrials, False, None, trialsPerSubject, seed))
+        results = tracing.traced_map(pool, run_analysis_wrapper, listParams)
+
+        likelihoods = dict(zip(survivors, results))
+        rungs.append((trialsPerSubject, likelihoods))
+        if verbose:
+            bestModel = min(likelihoods, key=likelihoods.get)
+            numTrials = "all" if lastRung else str(trialsPerSubject)
+            print("Scored " + str(len(survivors)) + " models on " + numTrials +
+                " trials per subject, best " + str(bestModel) +
+                " with NLL " + str(likelihoods[bestModel]))
+
+        if lastRung:
+            break
+
+        # Promote the best fraction of models to a larger trial subset.
+        survivors.sort(key=lambda m: likelihoods[m])
+        numSurvivors = max(int(np.ceil(len(survivors) / float(eta))), 1)
+        survivors = survivors[:numSurvivors]
+        trialsPerSubject *= eta
+
+    bestModel = min(likelihoods, key=likelihoods.get)
+    halving = collections.namedtuple('Halving', ['model', 'NLL', 'rungs'])
+    return halving(bestModel, likelihoods[bestModel], rungs)
+
+
+def main(trace=False):
+    if trace:
+        tracing.enable()
+    pool = create_executor()
+
+    # Load experimental data from CSV file.
+    data = load_data_from_csv("expdata.csv", "fixations.csv")
+    rt = data.rt
+    choice = data.choice
+    distLeft = data.distLeft
+    distRight = data.distRight
+    fixItem = data.fixItem
+    fixTime = data.fixTime
+
+    # Get item values.
+    valueLeft = dict()
+    valueRight = dict()
+    subjects = distLeft.keys()
+    for subject in subjects:
+        valueLeft[subject] = dict()
+        valueRight[subject] = dict()
+        trials = distLeft[subject].keys()
+        for trial in trials:
+            valueLeft[subject][trial] = np.absolute((np.absolute(
+                distLeft[subject][trial])-15)/5)
+            valueRight[subject][trial] = np.absolute((np.absolute(
+                distRight[subject][trial])-15)/5)
+
+    # Candidate models. Many more models than in the fixed grid searches can be
+    # afforded, since most of them are only scored on a few trials.
+    rangeD = np.linspace(0.001, 0.008, 8)
+    rangeTheta = np.linspace(0.1, 0.9, 9)
+    rangeStd = np.linspace(0.03, 0.1, 8)
+
+    models = list()
+    for d in rangeD:
+        for theta in rangeTheta:
+            for std in rangeStd:
+                models.append((d, theta, std))
+
+    print("Starting successive halving over " + str(len(models)) +
+        " models...")
+    halving = successive_halving(pool, rt, choice, valueLeft, valueRight,
+        fixItem, fixTime, models)
+
+    print("Finished successive halving!")
+    print("Optimal d: " + str(halving.model[0]))
+    print("Optimal theta: " + str(halving.model[1]))
+    print("Optimal std: " + str(halving.model[2]))
+    print("Min NLL: " + str(halving.NLL))
+
+
+if __name__ == '__main__':
+    main("--trace" in sys.argv[1:])
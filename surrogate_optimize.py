@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+# surrogate_optimize.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+from scipy.stats import norm
+
+import collections
+import csv
+import numpy as np
+import os
+
+import optimize
+from executors import create_executor
+from handle_fixations import get_dataset_hash
+from optimize import searchBounds
+from trial_sampling import get_trial_sets_hash
+
+
+# Columns of the history file: each evaluated point and its NLL, followed by
+# the settings of the search which a resumed search must share.
+historyFields = ["d", "theta", "std", "NLL", "dMin", "dMax", "thetaMin",
+    "thetaMax", "stdMin", "stdMax", "trialSetsHash", "datasetHash"]
+
+
+def get_run_settings(bounds, trialSets=None, datasetHash=None):
+    # Everything besides the point which the history of a resumed search must
+    # share with this one, in the order of the history columns: the bounds,
+    # which determine the normalized coordinates, and the trials and dataset
+    # the objective is evaluated on (empty if not given).
+    settings = list()
+    for bound in bounds:
+        settings.extend([float(bound[0]), float(bound[1])])
+    trialSetsHash = ""
+    if trialSets is not None:
+        trialSetsHash = get_trial_sets_hash(trialSets)
+    return settings + [trialSetsHash, datasetHash or ""]
+
+
+def load_history(historyFile, settings):
+    # Each row of the history file holds one evaluated point (d, theta, std),
+    # its NLL and the settings of the search. Points evaluated with other
+    # settings would be mixed with this search's, so they are an error.
+    points = list()
+    values = list()
+    if historyFile is None or not os.path.exists(historyFile):
+        return points, values
+    with open(historyFile, "rb") as csvFile:
+        csvReader = csv.reader(csvFile, delimiter=',')
+        if csvReader.next() != historyFields:
+            raise ValueError("History file " + historyFile + " does not have "
+                "the columns " + str(historyFields) + ".")
+        for row in csvReader:
+            rowSettings = [float(v) for v in row[4:-2]] + row[-2:]
+            if rowSettings != settings:
+                raise ValueError("History file " + historyFile + " was "
+                    "written with other settings: " + str(rowSettings) +
+                    " instead of " + str(settings) + ".")
+            points.append(tuple([float(v) for v in row[:3]]))
+            values.append(float(row[3]))
+    return points, values
+
+
+def save_history(historyFile, points, values, settings):
+    # Append new evaluations to the history file, creating it if needed.
+    if historyFile is None:
+        return
+    newFile = not os.path.exists(historyFile)
+    with open(historyFile, "ab") as csvFile:
+        csvWriter = csv.writer(csvFile, delimiter=',', quotechar='|',
+            quoting=csv.QUOTE_MINIMAL)
+        if newFile:
+            csvWriter.writerow(historyFields)
+        for point, value in zip(points, values):
+            csvWriter.writerow([repr(float(v)) for v in point] + [repr(value)] +
+                [repr(v) for v in settings[:-2]] + settings[-2:])
+
+
+def rbf_kernel(X1, X2, lengthScale):
+    sqDist = np.sum(((X1[:, np.newaxis, :] - X2[np.newaxis, :, :]) /
+        lengthScale) ** 2, axis=2)
+    return np.exp(-0.5 * sqDist)
+
+
+def fit_gaussian_process(X, y, noise=1e-2, lengthScales=(0.05, 0.1, 0.2, 0.4)):
+    # Gaussian process with a squared exponential kernel on standardized NLL
+    # values. The length scale is picked by maximizing the marginal likelihood.
+    yMean = np.mean(y)
+    yStd = np.std(y)
+    if yStd == 0:
+        yStd = 1.
+    yNorm = (y - yMean) / yStd
+
+    best = None
+    for lengthScale in lengthScales:
+        K = rbf_kernel(X, X, lengthScale) + noise * np.eye(len(X))
+        L = np.linalg.cholesky(K)
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, yNorm))
+        logMarginal = (-0.5 * np.dot(yNorm, alpha) -
+            np.sum(np.log(np.diag(L))))
+        if best is None or logMarginal > best[0]:
+            best = (logMarginal, lengthScale, L, alpha)
+
+    gp = collections.namedtuple('GP', ['X', 'lengthScale', 'L', 'alpha',
+        'yMean', 'yStd'])
+    return gp(X, best[1], best[2], best[3], yMean, yStd)
+
+
+def predict(gp, Xnew):
+    Ks = rbf_kernel(Xnew, gp.X, gp.lengthScale)
+    mean = np.dot(Ks, gp.alpha)
+    v = np.linalg.solve(gp.L, Ks.T)
+    var = np.maximum(1. - np.sum(v ** 2, axis=0), 1e-12)
+    return mean * gp.yStd + gp.yMean, np.sqrt(var) * gp.yStd
+
+
+def expected_improvement(mean, sd, bestValue, xi=0.):
+    # Expected decrease of the NLL below the best value seen so far.
+    z = (bestValue - mean - xi) / sd
+    return (bestValue - mean - xi) * norm.cdf(z) + sd * norm.pdf(z)
+
+
+def propose_batch(X, y, batchSize, randomState, numCandidates=2000):
+    # Choose a batch of points by expected improvement. After each choice the
+    # surrogate is refit with the predicted NLL at that point ("kriging
+    # believer"), so the rest of the batch explores elsewhere.
+    X = np.array(X)
+    y = np.array(y)
+    batch = list()
+    for i in xrange(batchSize):
+        gp = fit_gaussian_process(X, y)
+        candidates = randomState.uniform(size=(numCandidates, X.shape[1]))
+        mean, sd = predict(gp, candidates)
+        ei = expected_improvement(mean, sd, np.min(y))
+        best = candidates[np.argmax(ei)]
+        batch.append(best)
+        X = np.vstack([X, best])
+        y = np.append(y, predict(gp, best[np.newaxis, :])[0])
+    return batch
+
+
+def surrogate_optimize(pool, objective, bounds, numIterations=20, batchSize=9,
+    numInitialPoints=18, historyFile=None, seed=0, trialSets=None,
+    datasetHash=None, verbose=True):
+    # Bayesian optimization with a Gaussian process surrogate of the NLL. All
+    # evaluations are appended to the history file, and an existing history is
+    # used to resume the search if it has the same bounds, trial sets and
+    # dataset hash.
+    lower = np.array([b[0] for b in bounds], dtype=float)
+    upper = np.array([b[1] for b in bounds], dtype=float)
+    span = upper - lower
+
+    settings = get_run_settings(bounds, trialSets, datasetHash)
+    points, values = load_history(historyFile, settings)
+    if verbose and points:
+        print("Resuming from " + str(len(points)) + " evaluations...")
+    # A resumed search draws different candidates from the original one.
+    randomState = np.random.RandomState(seed + len(points))
+
+    # Start from a random design if there are too few evaluations.
+    if len(points) < numInitialPoints:
+        numPoints = numInitialPoints - len(points)
+        newPoints = [tuple(lower + u * span)
+            for u in randomState.uniform(size=(numPoints, len(bounds)))]
+        newValues = pool.map(objective, newPoints)
+        save_history(historyFile, newPoints, newValues, settings)
+        points.extend(newPoints)
+        values.extend(newValues)
+
+    for i in xrange(numIterations):
+        # The surrogate works in coordinates normalized to the unit box.
+        X = [(np.array(p) - lower) / span for p in points]
+        batch = propose_batch(X, values, batchSize, randomState)
+        newPoints = [tuple(lower + u * span) for u in batch]
+        newValues = pool.map(objective, newPoints)
+        save_history(historyFile, newPoints, newValues, settings)
+        points.extend(newPoints)
+        values.extend(newValues)
+
+        if verbose:
+            best = int(np.argmin(values))
+            print("Iteration " + str(i) + ": best " + str(points[best]) +
+                " with NLL " + str(values[best]))
+
+    best = int(np.argmin(values))
+    result = collections.namedtuple('SurrogateResult', ['x', 'NLL', 'points',
+        'values'])
+    return result(points[best], values[best], points, values)
+
+
+def main():
+    # Data must be loaded before the pool is created, so that the workers
+    # inherit it. Cluster workers on other hosts load it themselves.
+    optimize.load_global_data_and_subsets()
+    pool = create_executor(setup=optimize.load_global_data_and_subsets)
+
+    res = surrogate_optimize(pool, optimize.run_analysis, searchBounds,
+        batchSize=pool._processes, historyFile="surrogate_history.csv",
+        trialSets=optimize.trialSubsets, datasetHash=get_dataset_hash())
+    print("Optimal d: " + str(res.x[0]))
+    print("Optimal theta: " + str(res.x[1]))
+    print("Optimal std: " + str(res.x[2]))
+    print("Min NLL: " + str(res.NLL))
+
+
+if __name__ == '__main__':
+    main()
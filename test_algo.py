@@ -3,12 +3,11 @@
 # test_algo.py
 # Author: Gabriela Tavares, gtavares@caltech.edu
 
-from multiprocessing import Pool
-
 import csv
 import numpy as np
 import operator
 
+from executors import create_executor
 from handle_fixations import (load_data_from_csv, analysis_per_trial,
     get_empirical_distributions, run_simulations)
 
@@ -30,8 +29,7 @@ def run_analysis_wrapper(params):
 
 
 def main():
-    numThreads = 8
-    pool = Pool(numThreads)
+    pool = create_executor()
 
     # Load experimental data from CSV file.
     data = load_data_from_csv("expdata.csv", "fixations.csv")
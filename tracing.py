@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+# tracing.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import cPickle
+import json
+import os
+import sys
+import time
+
+
+# Tracing is off unless enabled, in which case every pool task submitted
+# through traced_map is recorded and the trace is written to outputFile in
+# Chrome trace event format (open it in chrome://tracing or Perfetto).
+enabled = False
+outputFile = None
+events = list()
+numMaps = 0
+
+
+def enable(fileName="trace.json"):
+    global enabled
+    global outputFile
+    global numMaps
+    enabled = True
+    outputFile = fileName
+    numMaps = 0
+    del events[:]
+    add_process_name(os.getpid(), "main")
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def get_time():
+    # Trace timestamps are in microseconds. All processes run on the same
+    # machine, so their wall clocks agree.
+    return time.time() * 1e6
+
+
+def add_process_name(pid, name):
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+        'args': {'name': name}})
+
+
+def get_pickled_size(obj):
+    # Size in bytes of the object as pickled by the pool, and the time taken
+    # to pickle it.
+    startTime = get_time()
+    size = len(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+    return size, get_time() - startTime
+
+
+def run_traced_task(params):
+    func, args, taskId = params
+    startTime = get_time()
+    result = func(args)
+    endTime = get_time()
+    resultSize, resultPickleTime = get_pickled_size(result)
+    return result, (taskId, os.getpid(), startTime, endTime, resultSize,
+        resultPickleTime)
+
+
+def traced_map(pool, func, listParams, name=None):
+    # pool.map, recording for every task when it was submitted, when it
+    # started and ended on its worker, and the size and pickling time of its
+    # arguments and result.
+    global numMaps
+    if not enabled:
+        return pool.map(func, listParams)
+    if name is None:
+        name = getattr(func, '__name__', 'task')
+    mapId = numMaps
+    numMaps += 1
+    parentPid = os.getpid()
+
+    submitTime = get_time()
+    tasks = list()
+    argSizes = list()
+    for taskId, params in enumerate(listParams):
+        task = (func, params, taskId)
+        argSizes.append(get_pickled_size(task))
+        tasks.append(task)
+    pickleTime = sum([t for size, t in argSizes])
+    events.append({'name': 'pickle arguments', 'cat': 'serialization',
+        'ph': 'X', 'pid': parentPid, 'tid': 0, 'ts': submitTime,
+        'dur': pickleTime, 'args': {'map': mapId,
+        'bytes': sum([size for size, t in argSizes])}})
+
+    results = pool.map(run_traced_task, tasks)
+    endTime = get_time()
+    events.append({'name': 'pool.map ' + name, 'cat': 'map', 'ph': 'X',
+        'pid': parentPid, 'tid': 0, 'ts': submitTime,
+        'dur': endTime - submitTime, 'args': {'map': mapId,
+        'numTasks': len(tasks), 'numWorkers': pool._processes}})
+
+    workers = set([e['pid'] for e in events if e['ph'] == 'M'])
+    for result, (taskId, pid, startTime, taskEndTime, resultSize,
+        resultPickleTime) in results:
+        if pid not in workers:
+            add_process_name(pid, "worker " + str(pid))
+            workers.add(pid)
+        events.append({'name': name, 'cat': 'task', 'ph': 'X', 'pid': pid,
+            'tid': 0, 'ts': startTime, 'dur': taskEndTime - startTime,
+            'args': {'map': mapId, 'task': taskId,
+            'argBytes': argSizes[taskId][0],
+            'argPickleTime': argSizes[taskId][1],
+            'queueTime': startTime - submitTime}})
+        events.append({'name': 'pickle result', 'cat': 'serialization',
+            'ph': 'X', 'pid': pid, 'tid': 0, 'ts': taskEndTime,
+            'dur': resultPickleTime, 'args': {'map': mapId, 'task': taskId,
+            'bytes': resultSize}})
+
+    # The trace is rewritten after every map, so an interrupted run still
+    # leaves a usable trace.
+    save_trace()
+    return [result for result, info in results]
+
+
+def save_trace(fileName=None):
+    if fileName is None:
+        fileName = outputFile
+    with open(fileName, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def get_utilization(traceEvents):
+    # For every map in a trace: its wall time, the busy time of each worker,
+    # and the ratio between the longest task and the median task, which is
+    # large when a few slow tasks hold up the map.
+    maps = dict()
+    for event in traceEvents:
+        if event['ph'] != 'X' or event.get('cat') not in ['map', 'task']:
+            continue
+        mapId = event['args']['map']
+        if mapId not in maps:
+            maps[mapId] = {'tasks': list(), 'busy': dict()}
+        if event['cat'] == 'map':
+            maps[mapId]['name'] = event['name']
+            maps[mapId]['wallTime'] = event['dur']
+            maps[mapId]['numWorkers'] = event['args']['numWorkers']
+        else:
+            maps[mapId]['tasks'].append(event['dur'])
+            maps[mapId]['busy'][event['pid']] = (
+                maps[mapId]['busy'].get(event['pid'], 0) + event['dur'])
+
+    utilization = list()
+    for mapId in sorted(maps.keys()):
+        m = maps[mapId]
+        # Maps without tasks, e.g. when every GA individual is cached, are
+        # reported with zero utilization.
+        if not m['tasks'] or m['wallTime'] <= 0:
+            utilization.append((mapId, m['name'], m['wallTime'], 0., 0))
+            continue
+        tasks = sorted(m['tasks'])
+        median = tasks[len(tasks) // 2]
+        utilization.append((mapId, m['name'], m['wallTime'],
+            sum(m['busy'].values()) / (m['wallTime'] * m['numWorkers']),
+            tasks[-1] / median if median > 0 else 0))
+    return utilization
+
+
+def main(argv):
+    # Print the utilization of each map in a trace file.
+    fileName = argv[0] if argv else "trace.json"
+    with open(fileName, "r") as f:
+        traceEvents = json.load(f)['traceEvents']
+    for mapId, name, wallTime, utilization, tailRatio in get_utilization(
+        traceEvents):
+        print(str(mapId) + " " + name + ": " + str(wallTime / 1e6) +
+            " s, utilization " + str(utilization) + ", longest/median task " +
+            str(tailRatio))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# trial_sampling.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import hashlib
+import numpy as np
+
+
+def get_trial_subset(trials, numTrials, seed=0, strata=None):
+    # Select a fixed subset of trials for a given seed. Without strata, smaller
+    # subsets are contained in larger ones. With strata (a dict mapping each
+    # trial to a label), every stratum contributes trials in proportion to its
+    # size. numTrials set to None selects all trials.
+    trials = sorted(trials)
+    randomState = np.random.RandomState(seed)
+    if numTrials is None or numTrials >= len(trials):
+        return np.array(trials)
+    if strata is None:
+        return randomState.permutation(trials)[:numTrials]
+
+    labels = sorted(set([strata[trial] for trial in trials]))
+    groups = [[t for t in trials if strata[t] == label] for label in labels]
+    quotas = np.array([numTrials * len(group) / float(len(trials))
+        for group in groups])
+    counts = np.floor(quotas).astype(int)
+    # The trials left over after rounding down go to the strata with the
+    # largest remainders.
+    numLeft = numTrials - np.sum(counts)
+    for i in np.argsort(counts - quotas, kind='mergesort')[:numLeft]:
+        counts[i] += 1
+
+    subset = list()
+    for group, count in zip(groups, counts):
+        subset.extend(randomState.permutation(group)[:count])
+    return np.array(sorted(subset))
+
+
+def get_trial_subsets(rt, trialsPerSubject, seed=0, strata=None):
+    # Fixed subset of trials for each subject. Drawing again with a different
+    # seed gives a new, equally fixed, set of subsets.
+    trialSubsets = dict()
+    for subject in rt.keys():
+        subjectStrata = None
+        if strata is not None:
+            subjectStrata = strata[subject]
+        trialSubsets[subject] = get_trial_subset(rt[subject].keys(),
+            trialsPerSubject, seed, subjectStrata)
+    return trialSubsets
+
+
+def get_value_difference_strata(valueLeft, valueRight):
+    # Stratify trials by the absolute value difference between the items.
+    strata = dict()
+    for subject in valueLeft.keys():
+        strata[subject] = dict()
+        for trial in valueLeft[subject].keys():
+            strata[subject][trial] = np.absolute(valueLeft[subject][trial] -
+                valueRight[subject][trial])
+    return strata
+
+
+def get_trial_sets_hash(trialSets):
+    # Identifies the trials of each subject, e.g. to check that a resumed
+    # run uses the same trials.
+    sha1 = hashlib.sha1()
+    for subject in sorted(trialSets.keys()):
+        sha1.update(str(subject) + ":" + ",".join([str(trial)
+            for trial in sorted(trialSets[subject])]) + ";")
+    return sha1.hexdigest()
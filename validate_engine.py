@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# validate_engine.py
+# Author: Gabriela Tavares, gtavares@caltech.edu
+
+import collections
+import numpy as np
+import os
+import sys
+import time
+
+import ddm
+from benchmarks import get_synthetic_dists
+from handle_fixations import (load_data_from_csv, analysis_per_trial,
+    analysis_per_trial_gradient, analysis_per_trial_models, simulate_trials)
+from posterior_engine import get_trial_list
+
+
+# Largest accepted difference between the reference and fast likelihoods,
+# relative to the reference likelihood, and between their NLLs per model.
+defaultTolerance = 1e-8
+
+# Likelihoods below this value are compared in absolute terms only.
+minLikelihood = 1e-100
+
+
+def get_model_grid():
+    models = list()
+    for d in [0.002, 0.005]:
+        for theta in [0.3, 0.7]:
+            for std in [0.05, 0.08]:
+                models.append((d, theta, std))
+    return models
+
+
+def get_real_trials(numTrials=25, seed=0, expdataFile="expdata.csv",
+    fixationsFile="fixations.csv"):
+    # Trials sampled uniformly across subjects, as (rt, choice, valueLeft,
+    # valueRight, fixItem, fixTime) tuples.
+    data = load_data_from_csv(expdataFile, fixationsFile)
+    pairs = list()
+    for subject in sorted(data.rt.keys()):
+        for trial in sorted(data.rt[subject].keys()):
+            pairs.append((subject, trial))
+    randomState = np.random.RandomState(seed)
+    idx = randomState.choice(len(pairs), min(numTrials, len(pairs)),
+        replace=False)
+
+    valueLeft = dict()
+    valueRight = dict()
+    for subject in data.rt.keys():
+        valueLeft[subject] = dict()
+        valueRight[subject] = dict()
+        for trial in data.rt[subject].keys():
+            valueLeft[subject][trial] = np.absolute((np.absolute(
+                data.distLeft[subject][trial])-15)/5)
+            valueRight[subject][trial] = np.absolute((np.absolute(
+                data.distRight[subject][trial])-15)/5)
+    return get_trial_list(data.rt, data.choice, valueLeft, valueRight,
+        data.fixItem, data.fixTime, [(pairs[i][0], [pairs[i][1]])
+        for i in idx])
+
+
+def get_synthetic_trials(models, numTrialsPerModel=5, seed=0):
+    # Trials simulated from each model, with random item values.
+    randomState = np.random.RandomState(seed)
+    numTrials = numTrialsPerModel * len(models)
+    params = np.array(models).repeat(numTrialsPerModel, axis=0)
+    valueLeft = randomState.randint(0, 4, numTrials)
+    valueRight = randomState.randint(0, 4, numTrials)
+    simul = simulate_trials(*(get_synthetic_dists(seed) + (valueLeft,
+        valueRight, params[:,0], params[:,1], params[:,2])), seed=seed)
+
+    trials = list()
+    for i in xrange(numTrials):
+        fixations = simul.fixTrial == i
+        trials.append((simul.rt[i], simul.choice[i], valueLeft[i],
+            valueRight[i], simul.fixItem[fixations],
+            simul.fixTime[fixations]))
+    return trials
+
+
+def get_nlls(likelihoods):
+    # NLL per model (column), leaving out zero likelihoods as run_analysis
+    # does.
+    logLikelihoods = np.zeros(likelihoods.shape)
+    valid = likelihoods > 0
+    logLikelihoods[valid] = np.log(likelihoods[valid])
+    return -np.sum(logLikelihoods, axis=0)
+
+
+def compare_likelihoods(reference, fast, referenceTime, fastTime):
+    # Both arguments are likelihood matrices with one row per trial and one
+    # column per model.
+    absDiff = np.absolute(fast - reference)
+    relDiff = absDiff / np.maximum(np.absolute(reference), minLikelihood)
+    relDiff[np.absolute(reference) < minLikelihood] = 0
+    comparison = collections.namedtuple('Comparison', ['maxAbsDiff',
+        'maxRelDiff', 'nllDiffs', 'referenceTime', 'fastTime', 'speedup'])
+    return comparison(np.max(absDiff), np.max(relDiff),
+        np.absolute(get_nlls(fast) - get_nlls(reference)), referenceTime,
+        fastTime, referenceTime / fastTime)
+
+
+def validate_fixation_engines(trials, models, stateStep=0.1, timeStep=10):
+    # Compare handle_fixations.analysis_per_trial with the batched engine
+    # (all models at once) and with the gradient engine.
+    numTrials = len(trials)
+    reference = np.zeros((numTrials, len(models)))
+    startTime = time.time()
+    for i, trial in enumerate(trials):
+        for j, (d, theta, std) in enumerate(models):
+            # The reference modifies the fixation durations in place.
+            reference[i,j] = analysis_per_trial(*(trial[:5] +
+                (np.array(trial[5]), d, theta)), std=std, timeStep=timeStep,
+                stateStep=stateStep)
+    referenceTime = time.time() - startTime
+
+    batched = np.zeros((numTrials, len(models)))
+    startTime = time.time()
+    for i, trial in enumerate(trials):
+        batched[i] = analysis_per_trial_models(*(trial + (models,)),
+            timeStep=timeStep, stateStep=stateStep)
+    batchedTime = time.time() - startTime
+
+    gradient = np.zeros((numTrials, len(models)))
+    startTime = time.time()
+    for i, trial in enumerate(trials):
+        for j, (d, theta, std) in enumerate(models):
+            gradient[i,j] = analysis_per_trial_gradient(*(trial +
+                (d, theta, std)), timeStep=timeStep, stateStep=stateStep)[0]
+    gradientTime = time.time() - startTime
+
+    results = collections.OrderedDict()
+    results['analysis_per_trial_models'] = compare_likelihoods(reference,
+        batched, referenceTime, batchedTime)
+    results['analysis_per_trial_gradient'] = compare_likelihoods(reference,
+        gradient, referenceTime, gradientTime)
+    return results
+
+
+def validate_ddm_engine(trials, models, stateStep=0.1, timeStep=10):
+    # Compare ddm.analysis_per_trial with the batched engine. A trial with a
+    # single fixation on the left item, lasting the whole RT, and theta equal
+    # to one has the same drift as the DDM. Only the RT, choice and values of
+    # the trials are used.
+    ddmModels = sorted(set([(d, std) for d, theta, std in models]))
+    engineModels = [(d, 1., std) for d, std in ddmModels]
+    numTrials = len(trials)
+
+    reference = np.zeros((numTrials, len(ddmModels)))
+    startTime = time.time()
+    for i, trial in enumerate(trials):
+        for j, (d, std) in enumerate(ddmModels):
+            reference[i,j] = ddm.analysis_per_trial(*(trial[:4] + (d, std)),
+                timeStep=timeStep, stateStep=stateStep)
+    referenceTime = time.time() - startTime
+
+    batched = np.zeros((numTrials, len(ddmModels)))
+    startTime = time.time()
+    for i, trial in enumerate(trials):
+        batched[i] = analysis_per_trial_models(*(trial[:4] +
+            (np.array([1]), np.array([trial[0]]), engineModels)),
+            timeStep=timeStep, stateStep=stateStep)
+    batchedTime = time.time() - startTime
+
+    results = collections.OrderedDict()
+    results['ddm'] = compare_likelihoods(reference, batched, referenceTime,
+        batchedTime)
+    return results
+
+
+def check_results(results, tolerance=defaultTolerance):
+    # Names of the engines whose differences exceed the tolerance.
+    failures = list()
+    for name, comparison in results.iteritems():
+        if (comparison.maxRelDiff > tolerance or
+            np.max(comparison.nllDiffs) > tolerance):
+            failures.append(name)
+    return failures
+
+
+def main(argv):
+    tolerance = defaultTolerance
+    for arg in argv:
+        if arg.startswith("--tolerance="):
+            tolerance = float(arg.split("=")[1])
+
+    models = get_model_grid()
+    trialSets = collections.OrderedDict()
+    trialSets['synthetic'] = get_synthetic_trials(models)
+    if os.path.exists("expdata.csv") and os.path.exists("fixations.csv"):
+        trialSets['real'] = get_real_trials()
+    else:
+        print("Data files not found, skipping real trials.")
+
+    failures = list()
+    for setName, trials in trialSets.iteritems():
+        print("Validating on " + str(len(trials)) + " " + setName +
+            " trials...")
+        results = validate_fixation_engines(trials, models)
+        results.update(validate_ddm_engine(trials, models))
+        for name, comparison in results.iteritems():
+            print(setName + " " + name + ": max abs diff " +
+                str(comparison.maxAbsDiff) + ", max rel diff " +
+                str(comparison.maxRelDiff) + ", speedup " +
+                str(comparison.speedup))
+            print("    NLL diff per model: " + str(comparison.nllDiffs))
+        failures.extend([setName + " " + name
+            for name in check_results(results, tolerance)])
+
+    if failures:
+        print("FAILED (tolerance " + str(tolerance) + "): " +
+            ", ".join(failures))
+        sys.exit(1)
+    print("All engines match the reference (tolerance " + str(tolerance) +
+        ").")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])